@@ -0,0 +1,234 @@
+"""
+Structured logging for the backend.
+
+- One JSON object per line (LOG_FORMAT=text for a readable local console),
+  written by a QueueListener thread: request handlers only pay for an enqueue.
+- request_id / route are attached from contextvars set by
+  RequestContextMiddleware; an incoming X-Request-ID is reused and every
+  response echoes it.
+- DEBUG/INFO records are sampled per request with per-route rates
+  (LOG_SAMPLE_RATE=1.0, LOG_SAMPLE_RATES="/api/chat=0.1,/api/tts=0").
+  WARNING and above are always kept.
+- Bearer tokens, JWTs, Google API keys and private keys are scrubbed from
+  every line. User-authored text should go through redact(), which logs only
+  its length and a short hash unless LOG_USER_TEXT=1.
+"""
+import atexit
+import contextvars
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_route: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("route", default=None)
+_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("log_sampled", default=True)
+
+_SECRET_PATTERNS = [
+    (re.compile(r"(?i)bearer\s+[A-Za-z0-9\-._~+/]+=*"), "Bearer [REDACTED]"),
+    (re.compile(r"eyJ[A-Za-z0-9_-]{5,}\.[A-Za-z0-9_-]{5,}\.[A-Za-z0-9_-]*"), "[JWT]"),
+    (re.compile(r"AIza[0-9A-Za-z\-_]{35}"), "[API_KEY]"),
+    (re.compile(r"-----BEGIN [A-Z ]*PRIVATE KEY-----.*?-----END [A-Z ]*PRIVATE KEY-----", re.S), "[PRIVATE_KEY]"),
+]
+
+LOG_USER_TEXT = os.getenv("LOG_USER_TEXT", "") == "1"
+
+
+def scrub_secrets(text: str) -> str:
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact(text) -> str:
+    """User text → `<N chars #hash>` (same text, same hash), unless LOG_USER_TEXT=1."""
+    if text is None:
+        return "<none>"
+    text = str(text)
+    if LOG_USER_TEXT:
+        return text
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+    return f"<{len(text)} chars #{digest}>"
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def _parse_sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for item in spec.split(","):
+        if "=" in item:
+            prefix, rate = item.split("=", 1)
+            rates[prefix.strip()] = float(rate)
+    return rates
+
+
+class SamplingPolicy:
+    """Per-route sampling rate, longest matching path prefix wins."""
+
+    def __init__(self, default: float, per_route: dict[str, float]):
+        self.default = default
+        self._routes = sorted(per_route.items(), key=lambda kv: len(kv[0]), reverse=True)
+
+    def rate_for(self, path: str) -> float:
+        for prefix, rate in self._routes:
+            if path.startswith(prefix):
+                return rate
+        return self.default
+
+    def sample(self, path: str) -> bool:
+        rate = self.rate_for(path)
+        return rate >= 1.0 or random.random() < rate
+
+
+sampling = SamplingPolicy(
+    float(os.getenv("LOG_SAMPLE_RATE", "1.0")),
+    _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")),
+)
+
+
+class _ContextFilter(logging.Filter):
+    """Runs in the calling thread: attaches request context and applies sampling."""
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and not _sampled.get():
+            return False
+        record.request_id = _request_id.get()
+        record.route = _route.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Like QueueHandler, but keeps the traceback in exc_text instead of merging it into msg."""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "request_id", "route"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": scrub_secrets(record.getMessage()),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+            entry["route"] = record.route
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = scrub_secrets(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        rid = getattr(record, "request_id", None)
+        line = f"{self.formatTime(record, '%H:%M:%S')} {record.levelname:<7} [{rid or '-'}] {record.getMessage()}"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return scrub_secrets(line)
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(stream=None):
+    """Install the queue-backed handler on the `lifecho` logger. Safe to call twice."""
+    global _listener
+    logger = logging.getLogger("lifecho")
+    if _listener is not None:
+        return logger
+
+    sink = logging.StreamHandler(stream or sys.stdout)
+    sink.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT") == "text" else JsonFormatter())
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(_ContextFilter())
+
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, sink)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return logger
+
+
+def shutdown_logging():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        for handler in list(logging.getLogger("lifecho").handlers):
+            logging.getLogger("lifecho").removeHandler(handler)
+
+
+class RequestContextMiddleware:
+    """ASGI middleware: request id + route + sampling decision, plus one access line per request."""
+
+    def __init__(self, app):
+        self.app = app
+        self.log = logging.getLogger("lifecho.access")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        path = scope.get("path", "")
+        tokens = (
+            _request_id.set(request_id),
+            _route.set(path),
+            _sampled.set(sampling.sample(path)),
+        )
+        status = {"code": 500}
+        start = time.perf_counter()
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            self.log.info(
+                "%s %s %d", scope.get("method"), path, status["code"],
+                extra={"duration_ms": round((time.perf_counter() - start) * 1000, 1)},
+            )
+            _sampled.reset(tokens[2])
+            _route.reset(tokens[1])
+            _request_id.reset(tokens[0])
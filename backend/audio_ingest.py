@@ -0,0 +1,184 @@
+"""
+Audio ingestion for multimodal Gemini calls.
+
+The chat page sends every voice turn twice: first to /api/transcribe so the
+user can confirm the text, then to /api/chat. Both used to decode the whole
+recording and wrap it in an inline protobuf Blob, which costs request memory
+and serialization time that grow with the recording.
+
+    recording = await audio_ingestor.add(audio_base64, mime_type)   # decode + sha256, nothing upstream yet
+    part = await audio_ingestor.part(recording)                      # preprocess, then inline or upload, once
+    ... later request ...
+    recording = audio_ingestor.get(audio_id)                         # same recording, no re-upload
+
+- Recordings up to inline_max_bytes stay in memory and go inline (AudioPart).
+- Larger ones are base64-decoded chunk by chunk into a temp file, preprocessed
+  file-to-file, and sent with the resumable file API straight from disk; the
+  returned file handle is what goes into `contents`.
+- Recordings are keyed by content hash. /api/transcribe returns the id
+  (`audio_id`) and /api/chat accepts it, so the confirm-then-send flow reuses
+  the upload instead of shipping the bytes again. Entries expire after
+  ttl_seconds (well inside Gemini's 48 h file lifetime) and are bounded by
+  count and in-memory bytes; temp files go with them.
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from audio_preprocess import AudioPreprocessor
+from metrics import AUDIO_INGEST
+from providers import AudioPart, FileUploadUnsupportedError, TextProvider
+from resilience import SingleFlight
+
+logger = logging.getLogger("lifecho.audio")
+
+_DECODE_CHUNK = 1024 * 1024  # base64 characters per step; a multiple of 4 decodes independently
+
+
+@dataclass
+class Recording:
+    audio_id: str
+    mime_type: str
+    size: int
+    data: Optional[bytes] = None    # small recordings, until materialized
+    path: Optional[Path] = None     # large recordings, until uploaded
+    part: Any = None                # AudioPart or uploaded file handle, once materialized
+    created_at: float = 0.0
+
+    @property
+    def resident_bytes(self) -> int:
+        if isinstance(self.part, AudioPart):
+            return len(self.part.data)
+        return len(self.data) if self.data is not None else 0
+
+
+class AudioIngestor:
+    def __init__(self, preprocessor: AudioPreprocessor, text_provider: Callable[[], TextProvider],
+                 inline_max_bytes: int = 4 * 1024 * 1024, ttl_seconds: float = 3600.0,
+                 max_entries: int = 256, max_resident_bytes: int = 64 * 1024 * 1024,
+                 spool_dir: Optional[Path] = None):
+        self.preprocessor = preprocessor
+        self.text_provider = text_provider  # a getter: tests and load tests swap main1.providers
+        self.inline_max_bytes = inline_max_bytes
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.max_resident_bytes = max_resident_bytes
+        self.spool_dir = spool_dir
+        self._entries: "OrderedDict[str, Recording]" = OrderedDict()
+        self._inflight = SingleFlight()
+
+    # --- decoding ---
+
+    def _decode_to_memory(self, audio_base64: str) -> tuple[str, bytes]:
+        data = base64.b64decode(audio_base64)
+        return hashlib.sha256(data).hexdigest(), data
+
+    def _decode_to_file(self, audio_base64: str) -> tuple[str, int, Path]:
+        h = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(prefix="lifecho-audio-", dir=self.spool_dir, delete=False) as f:
+            try:
+                for start in range(0, len(audio_base64), _DECODE_CHUNK):
+                    chunk = base64.b64decode(audio_base64[start:start + _DECODE_CHUNK])
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                Path(f.name).unlink(missing_ok=True)
+                raise
+        return h.hexdigest(), size, Path(f.name)
+
+    async def add(self, audio_base64: str, mime_type: str) -> Recording:
+        """Decode (off the event loop) and register a recording; an identical one already held is reused."""
+        if len(audio_base64) * 3 // 4 <= self.inline_max_bytes:
+            digest, data = await asyncio.to_thread(self._decode_to_memory, audio_base64)
+            recording = Recording(digest[:32], mime_type, len(data), data=data, created_at=time.monotonic())
+        else:
+            digest, size, path = await asyncio.to_thread(self._decode_to_file, audio_base64)
+            recording = Recording(digest[:32], mime_type, size, path=path, created_at=time.monotonic())
+
+        existing = self.get(recording.audio_id)
+        if existing is not None:
+            self._discard(recording)
+            return existing
+        self._entries[recording.audio_id] = recording
+        self._evict()
+        return recording
+
+    def get(self, audio_id: str) -> Optional[Recording]:
+        recording = self._entries.get(audio_id)
+        if recording is None:
+            return None
+        if time.monotonic() - recording.created_at > self.ttl:
+            self._discard(self._entries.pop(audio_id))
+            return None
+        self._entries.move_to_end(audio_id)
+        return recording
+
+    # --- materializing ---
+
+    async def part(self, recording: Recording) -> Any:
+        """The content part for this recording: inline AudioPart or file handle, built at most once."""
+        if recording.part is not None:
+            AUDIO_INGEST.inc(mode="reused")
+            return recording.part
+        if recording.audio_id in self._inflight:
+            AUDIO_INGEST.inc(mode="reused")
+        # /api/transcribe and /api/chat may ask at once; one leaving must not cancel the other's upload
+        return await self._inflight.do(recording.audio_id, lambda: self._materialize(recording))
+
+    async def _materialize(self, recording: Recording) -> Any:
+        if recording.data is not None:
+            data, mime_type = await self.preprocessor.process(recording.data, recording.mime_type)
+            recording.part = AudioPart(mime_type=mime_type, data=data)
+            recording.data = None
+            AUDIO_INGEST.inc(mode="inline")
+            self._evict()
+            return recording.part
+
+        path, mime_type = await self.preprocessor.process_file(recording.path, recording.mime_type)
+        mode = "upload"
+        try:
+            recording.part = await self.text_provider().upload_file(str(path), mime_type)
+        except FileUploadUnsupportedError:
+            # provider 没有文件 API：大录音也只能内联发送
+            recording.part = AudioPart(mime_type=mime_type, data=await asyncio.to_thread(path.read_bytes))
+            mode = "inline"
+            self._evict()
+        finally:
+            if path != recording.path:
+                path.unlink(missing_ok=True)
+        self._discard(recording)  # the upload / inline part is the copy now
+        AUDIO_INGEST.inc(mode=mode)
+        logger.info("录音%s: %d 字节, id=%s", "通过文件 API 上传" if mode == "upload" else "内联发送（provider 不支持文件 API）",
+                    recording.size, recording.audio_id)
+        return recording.part
+
+    # --- bookkeeping ---
+
+    def _discard(self, recording: Recording):
+        if recording.path is not None:
+            recording.path.unlink(missing_ok=True)
+            recording.path = None
+
+    def _evict(self):
+        now = time.monotonic()
+        for audio_id in [k for k, r in self._entries.items() if now - r.created_at > self.ttl]:
+            self._discard(self._entries.pop(audio_id))
+        resident = sum(r.resident_bytes for r in self._entries.values())
+        while self._entries and (len(self._entries) > self.max_entries or resident > self.max_resident_bytes):
+            _, oldest = self._entries.popitem(last=False)
+            resident -= oldest.resident_bytes
+            self._discard(oldest)
+
+    def close(self):
+        for recording in self._entries.values():
+            self._discard(recording)
+        self._entries.clear()
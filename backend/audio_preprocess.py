@@ -0,0 +1,137 @@
+"""
+Audio preprocessing for browser recordings sent to /api/chat and /api/transcribe.
+
+MediaRecorder hands us stereo 48 kHz Opus/WebM (or AAC on Safari) at
+~128 kbps, with the silence before the user starts talking and after they
+stop. Gemini only needs speech, so before the bytes go upstream we run
+
+    mono 16 kHz -> trim leading / trailing silence -> Opus 24 kbps (voip) in Ogg
+
+through ffmpeg subprocesses, at most `max_workers` at a time so a burst of
+uploads cannot fork-bomb the box. Anything that goes wrong (no ffmpeg,
+undecodable input, timeout, output not smaller, nothing but silence) keeps
+the original recording — preprocessing is an optimisation, never a new way
+to fail a turn.
+"""
+import asyncio
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from metrics import AUDIO_PREPROCESS_BYTES, FALLBACKS
+
+logger = logging.getLogger("lifecho.audio")
+
+OUTPUT_MIME_TYPE = "audio/ogg"
+
+# -45 dB with 0.2 s kept around speech; areverse trims the tail with the same filter
+_TRIM = "silenceremove=start_periods=1:start_threshold={threshold}:start_silence=0.2"
+
+
+def find_ffmpeg() -> Optional[str]:
+    return os.getenv("FFMPEG_BINARY") or shutil.which("ffmpeg")
+
+
+class AudioPreprocessor:
+    def __init__(self, ffmpeg: Optional[str] = None, max_workers: Optional[int] = None, timeout: float = 20.0,
+                 min_bytes: int = 8 * 1024, bitrate: str = "24k", sample_rate: int = 16000,
+                 silence_threshold: str = "-45dB", compression_level: int = 2, enabled: bool = True):
+        self.ffmpeg = ffmpeg
+        self.max_workers = max_workers or max(2, os.cpu_count() or 2)
+        self.timeout = timeout
+        self.min_bytes = min_bytes
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.silence_threshold = silence_threshold
+        self.compression_level = compression_level
+        self.enabled = enabled and ffmpeg is not None
+        self._slots = asyncio.Semaphore(self.max_workers)
+        if enabled and ffmpeg is None:
+            logger.warning("未找到 ffmpeg，音频预处理已关闭（设置 FFMPEG_BINARY 或安装 ffmpeg）")
+
+    def command(self, source: str = "pipe:0", target: str = "pipe:1") -> list[str]:
+        trim = _TRIM.format(threshold=self.silence_threshold)
+        # downmix / resample first so the silence filters touch 1/6 of the samples;
+        # libopus' default complexity 10 costs ~2x the CPU for no audible gain at 16 kHz speech
+        filters = (f"aresample={self.sample_rate},aformat=channel_layouts=mono,"
+                   f"{trim},areverse,{trim},areverse")
+        return [
+            self.ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin",
+            "-i", source,
+            "-vn", "-af", filters,
+            "-c:a", "libopus", "-b:a", self.bitrate, "-application", "voip",
+            "-compression_level", str(self.compression_level),
+            "-f", "ogg", "-y", target,
+        ]
+
+    async def _run(self, data: Optional[bytes] = None, source: str = "pipe:0", target: str = "pipe:1") -> bytes:
+        async with self._slots:
+            proc = await asyncio.create_subprocess_exec(
+                *self.command(source, target),
+                stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(data), self.timeout)
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        if proc.returncode != 0:
+            raise RuntimeError(err.decode("utf-8", "replace").strip()[-300:] or f"ffmpeg exit {proc.returncode}")
+        return out
+
+    async def process(self, data: bytes, mime_type: str) -> tuple[bytes, str]:
+        """Return (bytes, mime_type) to send upstream; the input unchanged whenever preprocessing doesn't pay."""
+        if not self.enabled or len(data) < self.min_bytes:
+            return data, mime_type
+        try:
+            out = await self._run(data)
+        except asyncio.TimeoutError:
+            FALLBACKS.inc(kind="audio_preprocess.timeout")
+            logger.warning("音频预处理超时（%d 字节），使用原始录音", len(data))
+            return data, mime_type
+        except (OSError, RuntimeError) as e:
+            FALLBACKS.inc(kind="audio_preprocess.error")
+            logger.warning("音频预处理失败，使用原始录音: %s", e)
+            return data, mime_type
+        if not out or len(out) >= len(data):
+            # empty: the whole clip was below the threshold; let the model decide what it heard
+            FALLBACKS.inc(kind="audio_preprocess.kept_original")
+            return data, mime_type
+        AUDIO_PREPROCESS_BYTES.inc(len(data), stage="in")
+        AUDIO_PREPROCESS_BYTES.inc(len(out), stage="out")
+        logger.debug("音频预处理: %d -> %d 字节 (%s -> %s)", len(data), len(out), mime_type, OUTPUT_MIME_TYPE)
+        return out, OUTPUT_MIME_TYPE
+
+    async def process_file(self, source: Path, mime_type: str) -> tuple[Path, str]:
+        """File-to-file variant for large recordings: (path, mime_type), the source itself if nothing better came out.
+
+        A new file is written next to the source; the caller owns (and deletes) both.
+        """
+        if not self.enabled:
+            return source, mime_type
+        target = source.with_name(source.name + ".ogg")
+        try:
+            await self._run(source=str(source), target=str(target))
+        except asyncio.TimeoutError:
+            FALLBACKS.inc(kind="audio_preprocess.timeout")
+            logger.warning("音频预处理超时（%s），使用原始录音", source.name)
+            target.unlink(missing_ok=True)
+            return source, mime_type
+        except (OSError, RuntimeError) as e:
+            FALLBACKS.inc(kind="audio_preprocess.error")
+            logger.warning("音频预处理失败，使用原始录音: %s", e)
+            target.unlink(missing_ok=True)
+            return source, mime_type
+        size_in, size_out = source.stat().st_size, target.stat().st_size if target.exists() else 0
+        if not size_out or size_out >= size_in:
+            FALLBACKS.inc(kind="audio_preprocess.kept_original")
+            target.unlink(missing_ok=True)
+            return source, mime_type
+        AUDIO_PREPROCESS_BYTES.inc(size_in, stage="in")
+        AUDIO_PREPROCESS_BYTES.inc(size_out, stage="out")
+        return target, OUTPUT_MIME_TYPE
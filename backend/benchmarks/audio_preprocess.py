@@ -0,0 +1,149 @@
+"""
+Payload size and turn latency with / without recording preprocessing.
+
+Usage (from backend/, needs ffmpeg on PATH or FFMPEG_BINARY):
+    python benchmarks/audio_preprocess.py
+    python benchmarks/audio_preprocess.py --speech 3 8 20 --uplink-mbps 2 --text-ms 800
+
+Each sample mimics a MediaRecorder clip: stereo 48 kHz Opus/WebM at 128 kbps
+with ~1.5 s of room noise before the user speaks and ~2 s after. The turn
+is an in-process /api/chat call against the fake text provider, with the
+upload to Gemini modelled as payload / uplink bandwidth, so the numbers
+show where the time goes: preprocessing CPU vs bytes on the wire.
+"""
+import argparse
+import array
+import asyncio
+import base64
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+os.environ.setdefault("LIFECHO_PROVIDERS", "fake")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+from audio_preprocess import AudioPreprocessor, find_ffmpeg  # noqa: E402
+from providers import AudioPart, TextProvider, fake_providers  # noqa: E402
+
+RATE = 48000
+
+
+def synth_pcm(speech_seconds: float, lead: float = 1.5, tail: float = 2.0, seed: int = 0) -> bytes:
+    """Stereo s16le: low room noise, then a voiced, syllable-modulated signal, then noise again."""
+    rng = random.Random(seed)
+    samples = array.array("h")
+    total = int((lead + speech_seconds + tail) * RATE)
+    start, end = int(lead * RATE), int((lead + speech_seconds) * RATE)
+    pitch = 140.0
+    for i in range(total):
+        t = i / RATE
+        value = rng.gauss(0, 30)  # ~ -60 dBFS room noise
+        if start <= i < end:
+            pitch += rng.uniform(-0.05, 0.05)
+            envelope = max(0.0, math.sin(2 * math.pi * 4 * t)) ** 0.5  # ~4 syllables / s
+            voiced = sum(math.sin(2 * math.pi * pitch * k * t) / k for k in (1, 2, 3, 5))
+            value += 6000 * envelope * voiced
+        v = int(max(-32768, min(32767, value)))
+        samples.append(v)
+        samples.append(v)
+    return samples.tobytes()
+
+
+def browser_recording(ffmpeg: str, pcm: bytes) -> bytes:
+    return subprocess.run(
+        [ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "s16le", "-ar", str(RATE), "-ac", "2", "-i", "pipe:0",
+         "-c:a", "libopus", "-b:a", "128k", "-f", "webm", "pipe:1"],
+        input=pcm, stdout=subprocess.PIPE, check=True,
+    ).stdout
+
+
+def ogg_seconds(data: bytes) -> float:
+    """Duration from the last Ogg page's granule position (Opus granules are 48 kHz samples)."""
+    page = data.rfind(b"OggS")
+    return int.from_bytes(data[page + 6:page + 14], "little") / 48000 if page >= 0 else 0.0
+
+
+class UplinkTextProvider(TextProvider):
+    """Fake text provider that first 'uploads' inline audio at a fixed bandwidth."""
+
+    def __init__(self, inner: TextProvider, bytes_per_second: float):
+        self.inner = inner
+        self.bytes_per_second = bytes_per_second
+
+    async def generate(self, contents, **kwargs):
+        payload = sum(len(part.data) for part in contents if isinstance(part, AudioPart))
+        await asyncio.sleep(payload / self.bytes_per_second)
+        return await self.inner.generate(contents, **kwargs)
+
+    async def upload_file(self, path):
+        return await self.inner.upload_file(path)
+
+
+async def chat_turn_ms(client, recording: bytes) -> float:
+    t0 = time.perf_counter()
+    resp = await client.post("/api/chat", json={
+        "context": "今天在打工的店里和店长一起做了新的架子", "tone": "Normal", "mentorRole": "店長", "turn": 6,
+        "history": [{"role": "model", "content": "今日はどうでしたか？"}, {"role": "user", "content": "(voice)"}],
+        "audio_base64": base64.b64encode(recording).decode(), "audio_mime_type": "audio/webm",
+    })
+    resp.raise_for_status()
+    return (time.perf_counter() - t0) * 1000
+
+
+async def run(args, ffmpeg: str):
+    import httpx
+    import main1
+
+    fakes = fake_providers(text_latency=args.text_ms / 1000, tts_latency=args.tts_ms / 1000, seed=args.seed)
+    fakes.text = UplinkTextProvider(fakes.text, args.uplink_mbps * 1e6 / 8)
+    main1.providers = fakes
+    main1.rate_limiter.enabled = False
+    on = AudioPreprocessor(ffmpeg)
+    off = AudioPreprocessor(ffmpeg, enabled=False)
+
+    print(f"{'speech s':>9}{'audio s':>9}{'sent s':>8}{'input KB':>10}{'output KB':>11}{'ratio':>7}"
+          f"{'prep ms':>9}{'turn raw ms':>13}{'turn prep ms':>14}")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main1.app), base_url="http://bench",
+                                 timeout=120) as client:
+        for seconds in args.speech:
+            pcm = synth_pcm(seconds, seed=args.seed)
+            recording = browser_recording(ffmpeg, pcm)
+            prep = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                out, _ = await on.process(recording, "audio/webm")
+                prep.append((time.perf_counter() - t0) * 1000)
+            turns = {}
+            for name, preprocessor in (("raw", off), ("prep", on)):
+                main1.audio_preprocessor = preprocessor
+                turns[name] = statistics.median([await chat_turn_ms(client, recording) for _ in range(args.repeat)])
+            print(f"{seconds:>9.1f}{len(pcm) / 4 / RATE:>9.1f}{ogg_seconds(out):>8.1f}"
+                  f"{len(recording) / 1024:>10.1f}{len(out) / 1024:>11.1f}"
+                  f"{len(out) / len(recording):>7.2f}{statistics.median(prep):>9.1f}"
+                  f"{turns['raw']:>13.1f}{turns['prep']:>14.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--speech", type=float, nargs="+", default=[3, 8, 20], help="seconds of speech per sample")
+    ap.add_argument("--uplink-mbps", type=float, default=5.0, help="modelled server -> Gemini bandwidth")
+    ap.add_argument("--text-ms", type=float, default=800)
+    ap.add_argument("--tts-ms", type=float, default=300)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    ffmpeg = find_ffmpeg()
+    if ffmpeg is None:
+        sys.exit("ffmpeg not found: install it or set FFMPEG_BINARY")
+    asyncio.run(run(args, ffmpeg))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Time from sending a chat turn to the first playable audio.
+
+Usage (from backend/):
+    python benchmarks/chat_tts.py [--turns 20] [--text-ms 1500] [--tts-ms 400]
+
+Serves main1.app with uvicorn on a local port (ASGITransport would buffer
+the streamed body) against fake providers: the text fake streams its JSON
+with the first chunk after 35% of the latency, the TTS fake takes
+tts-ms for a ~20 character sentence. Three modes:
+
+    whole      CHAT_STREAM_TTS=0: parse the full answer, then one TTS call
+    pipelined  sentence TTS overlapping the stream, still one JSON response
+    ndjson     pipelined + Accept: application/x-ndjson, first audio event
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+os.environ.setdefault("LIFECHO_PROVIDERS", "fake")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+os.environ["RATE_LIMIT_ENABLED"] = "0"
+
+HISTORY = [
+    {"role": "model", "content": "今日はどうでしたか？"},
+    {"role": "user", "content": "えっと、今日はアルバイトで、那个店長が新しい棚を作ったんです"},
+]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def first_audio_ms(client, n: int, ndjson: bool) -> tuple[float, float]:
+    """(ms to first audio, ms to complete result) for one turn."""
+    body = {"tone": "Normal", "mentorRole": "店長", "history": HISTORY + [{"role": "user", "content": f"#{n}"}]}
+    t0 = time.perf_counter()
+    if not ndjson:
+        resp = await client.post("/api/chat", json=body)
+        resp.raise_for_status()
+        done = (time.perf_counter() - t0) * 1000
+        return done, done
+    first = None
+    async with client.stream("POST", "/api/chat", json=body, headers={"Accept": "application/x-ndjson"}) as resp:
+        async for line in resp.aiter_lines():
+            event = json.loads(line)
+            if first is None and (event["type"] == "audio" or event.get("reply_audio")):
+                first = (time.perf_counter() - t0) * 1000
+    return first, (time.perf_counter() - t0) * 1000
+
+
+async def run(args):
+    import httpx
+    import uvicorn
+
+    import main1
+    from providers import fake_providers
+
+    main1.providers = fake_providers(text_latency=args.text_ms / 1000, tts_latency=args.tts_ms / 1000,
+                                     seed=args.seed)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main1.app, host="127.0.0.1", port=port, log_level="critical"))
+    serving = asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    print(f"{'mode':<11}{'first audio p50':>17}{'p95':>9}{'result p50':>12}")
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            for mode in ("whole", "pipelined", "ndjson"):
+                main1.CHAT_STREAM_TTS = mode != "whole"
+                firsts, results = [], []
+                for n in range(args.turns):
+                    first, done = await first_audio_ms(client, n, ndjson=mode == "ndjson")
+                    firsts.append(first)
+                    results.append(done)
+                print(f"{mode:<11}{percentile(firsts, 50):>14.0f} ms{percentile(firsts, 95):>6.0f} ms"
+                      f"{percentile(results, 50):>9.0f} ms")
+    finally:
+        server.should_exit = True
+        await serving
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--turns", type=int, default=20)
+    ap.add_argument("--text-ms", type=float, default=1500, help="fake Gemini latency for the whole answer")
+    ap.add_argument("--tts-ms", type=float, default=400, help="fake TTS latency for a ~20 character sentence")
+    ap.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
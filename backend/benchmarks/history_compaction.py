@@ -0,0 +1,126 @@
+"""
+Chat prompt size and latency against turn count, with and without history compaction.
+
+Usage (from backend/):
+    python benchmarks/history_compaction.py [--turns 48] [--base-ms 400] [--us-per-token 150] [--read-ms 300]
+
+Drives main1._chat_turn through a growing conversation (about 80
+characters per user message) against the fake text provider, wrapped so
+every call costs base-ms + us-per-token x prompt tokens: a model of
+prefill-dominated latency, since the fake itself does not get slower with
+longer prompts. read-ms is the pause before the user's next message, in
+which the next fold's summary is prefetched. Prompt tokens use the same
+estimate as history_compaction.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from history_compaction import estimate_tokens  # noqa: E402
+
+os.environ.setdefault("LIFECHO_PROVIDERS", "fake")
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+os.environ["CHAT_STREAM_TTS"] = "0"
+os.environ["MODEL_CACHE_PATH"] = str(Path(tempfile.mkdtemp()) / "model_cache.db")
+
+USER_LINES = [
+    "えっと、今日はアルバイトで、那个店長が新しい棚を作ったんです。お客さんも手伝ってくれて、すごく楽しかったです。",
+    "そのあと友達とカフェに行って、季節限定のパフェを食べました。甘すぎなくて、ちょうどよかったです。",
+    "夜は家で日本語の勉強をしました。敬語の使い方がまだ難しいけど、少しずつ慣れてきた気がします。",
+]
+
+
+class PrefillLatency:
+    """Delegates to a text provider, sleeping base + per-token time for each prompt first."""
+
+    def __init__(self, inner, base_ms: float, us_per_token: float, summary_chars: int):
+        self.inner = inner
+        self.summary_chars = summary_chars
+        self.base = base_ms / 1000
+        self.per_token = us_per_token / 1e6
+        self.prompts: list[tuple[str, int]] = []
+
+    async def generate(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        parts = [c for c in contents if isinstance(c, str)] + [system_instruction or ""]
+        parts += [p for m in history or [] for p in m["parts"] if isinstance(p, str)]
+        tokens = sum(estimate_tokens(p) for p in parts)
+        kind = "fold" if "压缩" in (system_instruction or "") else "chat"
+        self.prompts.append((kind, tokens))
+        await asyncio.sleep(self.base + self.per_token * tokens)
+        if kind == "fold":
+            return "店長と棚を作った話。" * (self.summary_chars // 10)  # a summary as long as the prompt allows
+        return await self.inner.generate(contents, system_instruction=system_instruction, history=history,
+                                         json_mode=json_mode)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+
+async def conversation(main1, turns: int, read_ms: float, wrapped: PrefillLatency) -> list[tuple[int, int, float]]:
+    """[(turn, chat prompt tokens, ms)] for one conversation of `turns` user messages."""
+    from main1 import ChatRequest, Message
+    history = [Message(role="model", content="今日はどうでしたか？何か面白いことがありましたか？")]
+    rows = []
+    for n in range(1, turns + 1):
+        history.append(Message(role="user", content=f"{USER_LINES[n % len(USER_LINES)]}（{n}）"))
+        request = ChatRequest(context="アルバイトの話", tone="Normal", mentorRole="店長", turn=turns + 1,
+                              history=list(history))
+        wrapped.prompts.clear()
+        t0 = time.perf_counter()
+        result = await main1._chat_turn(request)
+        ms = (time.perf_counter() - t0) * 1000
+        chat_tokens = next(t for kind, t in wrapped.prompts if kind == "chat")
+        body = result.body if hasattr(result, "body") else None
+        reply = __import__("json").loads(body)["reply"] if body else result["reply"]
+        history.append(Message(role="model", content=reply))
+        rows.append((n, chat_tokens, ms))
+        await asyncio.sleep(read_ms / 1000)
+    return rows
+
+
+async def run(args):
+    import main1
+    from providers import fake_providers
+
+    results = {}
+    for mode in ("verbatim", "compacted"):
+        main1.providers = fake_providers(text_latency=0, tts_latency=0, seed=args.seed)
+        wrapped = PrefillLatency(main1.providers.text, args.base_ms, args.us_per_token, main1.HISTORY_SUMMARY_CHARS)
+        main1.providers.text = wrapped
+        main1.history_compactor.enabled = mode == "compacted"
+        main1.history_compactor.close()
+        main1.model_cache.enabled = False  # every fold is a real (modelled) call
+        results[mode] = await conversation(main1, args.turns, args.read_ms, wrapped)
+
+    print(f"budget {main1.HISTORY_BUDGETS['chat']} tokens, keep {main1.history_compactor.keep_messages // 2} turns, "
+          f"fold every {main1.history_compactor.fold_messages // 2} turns\n")
+    print(f"{'turn':>4}{'verbatim tok':>14}{'ms':>8}{'compacted tok':>15}{'ms':>8}")
+    for (n, vt, vms), (_, ct, cms) in zip(results["verbatim"], results["compacted"]):
+        if n in (1, 2, 4) or n % 4 == 0:
+            print(f"{n:>4}{vt:>14}{vms:>8.0f}{ct:>15}{cms:>8.0f}")
+    for mode, rows in results.items():
+        tail = rows[len(rows) // 2:]
+        print(f"{mode:>10}: mean of the last {len(tail)} turns "
+              f"{statistics.mean(t for _, t, _ in tail):.0f} tokens, {statistics.mean(ms for *_, ms in tail):.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=48)
+    parser.add_argument("--base-ms", type=float, default=400)
+    parser.add_argument("--us-per-token", type=float, default=150)
+    parser.add_argument("--read-ms", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark journal export / import on a synthetic user.
+
+Usage (from backend/):
+    python benchmarks/journal_archive.py [--entries 10000] [--media-kb 4]
+
+Runs against a throwaway DB and uploads dir; nothing touches journals.db.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main1  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from journal_store import SqliteJournalRepository  # noqa: E402
+
+USER_ID = "bench-user"
+
+
+def seed(entries: int, media_kb: int):
+    blob = os.urandom(media_kb * 1024)
+    rows = []
+    for i in range(entries):
+        date = f"20{20 + i // 3650:02d}-{(i // 300) % 12 + 1:02d}-{(i // 10) % 28 + 1:02d}"
+        session_num = i % 10 + 1
+        jid = f"{date}-{session_num}-{i}"
+        rel = f"{USER_ID}/{date}/{jid}"
+        entry_dir = main1.UPLOADS_DIR / rel
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        (entry_dir / "thumbnail.png").write_bytes(blob)
+        turns = [{"user_raw_text": "えっと、今日は", "reply": "そうなんだ！", "reply_audio_path": None}] * 6
+        rows.append(dict(zip(main1.JOURNAL_COLUMNS, (
+            jid, date, session_num, USER_ID, f"title {i}", "日記" * 80, "日记" * 80,
+            json.dumps([{"speaker": "先輩", "content": "なるほど"}] * 6, ensure_ascii=False),
+            None, None, None, f"{rel}/thumbnail.png", "今天发生的事情", "先輩", "Gentle", 6,
+            "2026-01-01T00:00:00", json.dumps(turns, ensure_ascii=False),
+        ))))
+    asyncio.run(main1.journal_repo.insert_many([rows]))
+
+
+async def export_to(path: Path):
+    with open(path, "wb") as out:
+        async for chunk in main1._iter_journal_archive(USER_ID):
+            out.write(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=10_000)
+    parser.add_argument("--media-kb", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main1.journal_repo = SqliteJournalRepository(Path(tmp) / "bench.db")
+        main1.UPLOADS_DIR = Path(tmp) / "uploads"
+        main1.UPLOADS_DIR.mkdir()
+        main1.app.dependency_overrides[main1.get_current_user_id] = lambda: USER_ID
+        client = TestClient(main1.app)
+
+        t0 = time.perf_counter()
+        seed(args.entries, args.media_kb)
+        print(f"seeded {args.entries} entries in {time.perf_counter() - t0:.2f}s")
+
+        archive = Path(tmp) / "export.zip"
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        # Drive the response generator directly: TestClient buffers whole bodies,
+        # which would hide whether the export itself streams.
+        asyncio.run(export_to(archive))
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size_mb = archive.stat().st_size / 1e6
+        print(f"export: {elapsed:.2f}s, {size_mb:.1f} MB, {args.entries / elapsed:.0f} entries/s, "
+              f"peak traced memory {peak / 1e6:.1f} MB")
+
+        # Import into a second user so session numbering starts clean
+        main1.app.dependency_overrides[main1.get_current_user_id] = lambda: USER_ID + "-restore"
+        t0 = time.perf_counter()
+        with open(archive, "rb") as f:
+            resp = client.post("/api/journal/import", content=f.read(),
+                               headers={"Content-Type": "application/zip"})
+        elapsed = time.perf_counter() - t0
+        print(f"import: {elapsed:.2f}s, {resp.json()}, {args.entries / elapsed:.0f} entries/s")
+
+
+if __name__ == "__main__":
+    main()
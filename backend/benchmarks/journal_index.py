@@ -0,0 +1,87 @@
+"""
+Related-journal lookups against index size.
+
+Usage (from backend/):
+    python benchmarks/journal_index.py [--entries 100 1000 10000] [--queries 200] [--k 5]
+
+Builds one user's index on a throwaway directory from synthetic journals
+(sentences drawn from a small pool, about 300 characters each), then times
+save-time embedding + append and /related-style top-k queries through
+JournalIndex. The first query after a rebuild maps the file; the rest hit
+the cached memmap like a warm worker.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from journal_index import JournalIndex  # noqa: E402
+
+USER_ID = "bench-user"
+SENTENCES = [
+    "今日はアルバイトで店長と新しい棚を作った。", "友達とカフェで季節限定のパフェを食べた。",
+    "夜は日本語の敬語を勉強した。", "雨の中、駅まで走って電車に間に合った。", "母と電話で一時間も話した。",
+    "図書館で小説を二冊借りた。", "先輩にプレゼンの練習を見てもらった。", "公園で猫に会って写真を撮った。",
+    "新しいレシピでカレーを作ってみた。", "試験の結果が出て、ほっとした。", "久しぶりにジムで走った。",
+    "バスを間違えて、知らない町に着いた。",
+]
+
+
+def journals(n: int, rng: random.Random):
+    for i in range(n):
+        yield {"id": f"j{i}", "diary_ja": "".join(rng.choices(SENTENCES, k=12)), "entry_text": ""}
+
+
+async def run(sizes: list[int], queries: int, k: int, seed: int):
+    print(f"{'entries':>8}{'file KB':>10}{'rebuild s':>11}{'add ms':>9}{'query p50 ms':>14}{'p95 ms':>9}")
+    for n in sizes:
+        rng = random.Random(seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            index = JournalIndex(Path(tmp))
+            rows = list(journals(n, rng))
+
+            async def batches():
+                for start in range(0, len(rows), 200):
+                    yield rows[start:start + 200]
+
+            t0 = time.perf_counter()
+            await index.rebuild(USER_ID, batches())
+            rebuild = time.perf_counter() - t0
+
+            adds = []
+            for row in journals(20, random.Random(seed + 1)):
+                t0 = time.perf_counter()
+                await index.add(USER_ID, f"new-{row['id']}", row["diary_ja"])
+                adds.append((time.perf_counter() - t0) * 1000)
+
+            timings = []
+            for _ in range(queries):
+                journal_id = f"j{rng.randrange(n)}"
+                t0 = time.perf_counter()
+                matches = await index.related(USER_ID, journal_id, k)
+                timings.append((time.perf_counter() - t0) * 1000)
+                assert matches is not None and len(matches) == k
+            timings.sort()
+            size_kb = sum(p.stat().st_size for p in Path(tmp).rglob("vectors.f16")) / 1024
+            print(f"{n:>8}{size_kb:>10.0f}{rebuild:>11.2f}{statistics.median(adds):>9.2f}"
+                  f"{statistics.median(timings):>14.2f}{timings[int(len(timings) * 0.95) - 1]:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args.entries, args.queries, args.k, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Asyncio load test: replays realistic chat sessions and finalization flows.
+
+One virtual user = detect_roles + generate_avatar, an opening /api/chat call
+plus six user turns (the sixth returns FINISHED), then the finalization flow
+the chat page runs: summarize -> generate_podcast_and_diary ->
+generate_podcast_audio -> generate_image (-> journal/save with --token).
+
+Usage (from backend/):
+    # in-process against fake providers (no network, no credentials)
+    python benchmarks/loadtest.py --users 20 --sessions 3
+    python benchmarks/loadtest.py --users 50 --text-ms 800 --image-ms 4000 --tts-ms 300 --failure-rate 0.02
+    python benchmarks/loadtest.py --failure-rate 0.05 --slow-rate 0.05 --no-resilience   # baseline under flakiness
+
+    # against a running server (start it with LIFECHO_PROVIDERS=fake for offline runs)
+    python benchmarks/loadtest.py --base-url http://127.0.0.1:8000 --users 20
+
+Reports p50/p95/p99 latency and requests/sec per endpoint, plus session totals.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+USER_TURNS = [
+    "えっと、今日はアルバイトで、那个店長が新しい棚を作ったんです",
+    "午後三時ぐらいです。お客さんが少ない時間でした",
+    "私は木を切るのを手伝いました。ちょっと難しかった",
+    "店長はすごく優しくて、就是、ゆっくり教えてくれました",
+    "完成した時、みんなで写真を撮りました",
+    "楽しかったです。また何か作りたいなと思いました",
+]
+SEED_TOPICS = ["今天在打工的店里和店长一起做了新的架子", "和朋友去了新开的咖啡店", "第一次用日语做了报告"]
+ROLES = ["店長", "先輩", "田中先生"]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.sessions: list[float] = []
+
+    async def call(self, client: httpx.AsyncClient, name: str, method: str, url: str, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            resp = await client.request(method, url, **kwargs)
+            ok = resp.status_code < 400
+            body = resp.json() if ok else None
+            if isinstance(body, dict) and body.get("status") == "ERROR":
+                ok = False
+        except (httpx.HTTPError, ValueError):
+            ok, body = False, None
+        self.latencies[name].append(time.perf_counter() - t0)
+        if not ok:
+            self.errors[name] += 1
+        return body
+
+
+async def run_session(client: httpx.AsyncClient, rec: Recorder, rng: random.Random, token: str = None):
+    """One user's full session; rate-limited calls (429/503) count as errors."""
+    started = time.perf_counter()
+    topic = rng.choice(SEED_TOPICS)
+    role = rng.choice(ROLES)
+    base = {"context": topic, "tone": rng.choice(["Gentle", "Normal", "Serious"]), "mentorRole": role, "turn": 6}
+
+    await rec.call(client, "detect_roles", "POST", "/api/detect_roles", json={"text": topic})
+    await rec.call(client, "generate_avatar", "POST", "/api/generate_avatar", json={"role": role})
+
+    history: list[dict] = []
+    communication_raw: list = []
+    res = await rec.call(client, "chat", "POST", "/api/chat", json={**base, "history": history})
+    if res:
+        history.append({"role": "model", "content": res.get("reply", "")})
+    for text in USER_TURNS:
+        history.append({"role": "user", "content": text})
+        res = await rec.call(client, "chat", "POST", "/api/chat", json={
+            **base, "history": history, "previous_communication_raw": communication_raw,
+        })
+        if not res:
+            continue
+        communication_raw = res.get("communication_raw") or communication_raw
+        history.append({"role": "model", "content": res.get("reply", "")})
+        if res.get("status") == "FINISHED":
+            break
+
+    summary = await rec.call(client, "summarize", "POST", "/api/summarize", json={**base, "history": history}) or {}
+    final = await rec.call(client, "generate_podcast_and_diary", "POST", "/api/generate_podcast_and_diary", json={
+        **{k: base[k] for k in ("context", "tone", "mentorRole")},
+        "communication_raw": communication_raw,
+        "refined_summary_ja": summary.get("diary_ja", ""),
+        "refined_summary_zh": summary.get("diary_zh", ""),
+    }) or {}
+    audio = {}
+    if final.get("script"):
+        audio = await rec.call(client, "generate_podcast_audio", "POST", "/api/generate_podcast_audio",
+                               json={"script": final["script"]}) or {}
+    images = await rec.call(client, "generate_image", "POST", "/api/generate_image", json={**base, "history": history}) or {}
+
+    if token:
+        scenes = images.get("scenes") or []
+        await rec.call(client, "journal_save", "POST", "/api/journal/save",
+                       headers={"Authorization": f"Bearer {token}"}, json={
+                           "date": time.strftime("%Y-%m-%d"),
+                           "title": (final.get("diary") or {}).get("title", ""),
+                           "diary_ja": summary.get("diary_ja", ""),
+                           "diary_zh": summary.get("diary_zh", ""),
+                           "podcast_script": final.get("script", []),
+                           "podcast_audio_base64": audio.get("audio_base64"),
+                           "scene_1_base64": scenes[0].get("image_base64") if scenes else None,
+                           "scene_2_base64": scenes[1].get("image_base64") if len(scenes) > 1 else None,
+                           "entry_text": topic,
+                           "role": role,
+                           "tone": base["tone"],
+                           "rounds": len(USER_TURNS),
+                           "chat_turns": communication_raw,
+                       })
+    rec.sessions.append(time.perf_counter() - started)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+def report(rec: Recorder, wall: float):
+    print(f"{'endpoint':<28}{'n':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+    total = 0
+    for name, values in rec.latencies.items():
+        total += len(values)
+        print(f"{name:<28}{len(values):>6}{rec.errors[name]:>5}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{len(values) / wall:>9.2f}")
+    s = rec.sessions
+    print(f"\n{len(s)} sessions in {wall:.1f}s — {total / wall:.2f} req/s, {len(s) / wall * 60:.1f} sessions/min")
+    if s:
+        print(f"session p50={percentile(s, 50):.1f}s p95={percentile(s, 95):.1f}s "
+              f"p99={percentile(s, 99):.1f}s mean={statistics.mean(s):.1f}s")
+
+
+def build_in_process_transport(args) -> httpx.ASGITransport:
+    os.environ["LIFECHO_PROVIDERS"] = "fake"
+    os.environ["TRUST_PROXY_HEADERS"] = "1"  # each virtual user gets its own X-Forwarded-For / bucket
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")  # keep the report readable
+    import main1
+    from providers import fake_providers
+    from resilience import with_resilience
+
+    fakes = fake_providers(
+        text_latency=args.text_ms / 1000, image_latency=args.image_ms / 1000, tts_latency=args.tts_ms / 1000,
+        failure_rate=args.failure_rate, empty_rate=args.empty_rate,
+        slow_rate=args.slow_rate, concurrency=args.upstream_capacity, seed=args.seed,
+    )
+    main1.providers = fakes if args.no_resilience else with_resilience(fakes)
+    main1.rate_limiter.enabled = not args.no_rate_limit
+    if args.token:
+        # journal writes go to a throwaway SQLite file / uploads dir, auth is bypassed
+        from journal_store import SqliteJournalRepository
+
+        scratch = Path(tempfile.mkdtemp(prefix="lifecho-loadtest-"))
+        main1.UPLOADS_DIR = scratch / "uploads"
+        main1.journal_repo = SqliteJournalRepository(scratch / "journals.db")
+        main1.app.dependency_overrides[main1.get_current_user_id] = lambda: "loadtest-user"
+    return httpx.ASGITransport(app=main1.app)
+
+
+async def main_async(args):
+    transport = None if args.base_url else build_in_process_transport(args)
+    base_url = args.base_url or "http://loadtest"
+    rec = Recorder()
+
+    async def virtual_user(n: int):
+        rng = random.Random(args.seed * 1000 + n)
+        client = httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout,
+                                   headers={"X-Forwarded-For": f"10.0.{n // 250}.{n % 250}"})
+        async with client:
+            await asyncio.sleep(rng.uniform(0, args.ramp))
+            for _ in range(args.sessions):
+                await run_session(client, rec, rng, args.token)
+
+    done = asyncio.Event()
+
+    async def abuser(n: int):
+        # one IP hammering the most expensive endpoint until the real users finish
+        client = httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout,
+                                   headers={"X-Forwarded-For": f"10.66.0.{n}"})
+        async with client:
+            while not done.is_set():
+                await asyncio.gather(*(rec.call(client, "abuser_avatar", "POST", "/api/generate_avatar",
+                                                json={"role": f"spam{i}"}) for i in range(8)))
+                await asyncio.sleep(0.1)  # pushy, but not a busy loop
+
+    started = time.perf_counter()
+    abusers = [asyncio.ensure_future(abuser(n)) for n in range(args.abusers)]
+    await asyncio.gather(*(virtual_user(n) for n in range(args.users)))
+    done.set()
+    await asyncio.gather(*abusers)
+    report(rec, time.perf_counter() - started)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base-url", help="target server; default runs main1.app in-process with fake providers")
+    ap.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    ap.add_argument("--abusers", type=int, default=0, help="extra clients flooding /api/generate_avatar")
+    ap.add_argument("--sessions", type=int, default=1, help="sessions per virtual user")
+    ap.add_argument("--ramp", type=float, default=1.0, help="spread user start over this many seconds")
+    ap.add_argument("--token", help="bearer token for /api/journal/save (in-process: any value, auth is overridden)")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--text-ms", type=float, default=800, help="fake Gemini text latency (in-process only)")
+    ap.add_argument("--image-ms", type=float, default=4000, help="fake image latency (in-process only)")
+    ap.add_argument("--tts-ms", type=float, default=300, help="fake TTS latency (in-process only)")
+    ap.add_argument("--failure-rate", type=float, default=0.0, help="fake upstream 503 rate (in-process only)")
+    ap.add_argument("--empty-rate", type=float, default=0.0, help="fake empty-candidates rate (in-process only)")
+    ap.add_argument("--upstream-capacity", type=int, help="fake calls served at once per provider (in-process only)")
+    ap.add_argument("--slow-rate", type=float, default=0.0, help="fake straggler rate, 8x latency (in-process only)")
+    ap.add_argument("--no-rate-limit", action="store_true", help="disable admission control (in-process only)")
+    ap.add_argument("--no-resilience", action="store_true", help="call the fakes without retry/hedging/breaker")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Cost of the instrumentation added to one /api/chat turn.
+
+Usage (from backend/):
+    python benchmarks/metrics_overhead.py [--iterations 200000]
+    OTEL_ENABLED=1 python benchmarks/metrics_overhead.py   # include no-op OTel spans
+
+A chat turn touches ~6 timed() stages, one parse observe, one request
+histogram observe and at most a couple of counters. The budget is 1% of
+the fastest realistic turn (one Gemini call + one TTS call, ~800 ms).
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import metrics  # noqa: E402
+
+TURN_SECONDS = 0.8
+
+
+def per_call(fn, n) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n
+
+
+def one_turn():
+    for stage in ("chat.gemini", "chat.tts", "tts.synthesize", "chat.serialize", "chat.upload_audio", "chat.x"):
+        with metrics.timed(stage):
+            pass
+    metrics.STAGE_SECONDS.observe(0.0003, stage="chat.parse")
+    metrics.REQUEST_SECONDS.observe(0.9, method="POST", route="/api/chat", status="200")
+    metrics.FALLBACKS.inc(kind="chat.json_brace_extract")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+    n = args.iterations
+
+    def empty_timed():
+        with metrics.timed("bench"):
+            pass
+
+    timed_cost = per_call(empty_timed, n)
+    observe_cost = per_call(lambda: metrics.STAGE_SECONDS.observe(0.1, stage="bench"), n)
+    turn_cost = per_call(one_turn, n // 10)
+    print(f"OTel spans: {'on' if metrics._tracer is not None else 'off'}")
+    print(f"timed() block:          {timed_cost * 1e6:7.2f} µs")
+    print(f"histogram observe:      {observe_cost * 1e6:7.2f} µs")
+    print(f"one chat turn's worth:  {turn_cost * 1e6:7.2f} µs "
+          f"= {turn_cost / TURN_SECONDS:.4%} of a {TURN_SECONDS * 1000:.0f} ms turn (budget 1%)")
+    t0 = time.perf_counter()
+    body = metrics.REGISTRY.expose()
+    print(f"/metrics render:        {(time.perf_counter() - t0) * 1000:7.2f} ms ({len(body)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
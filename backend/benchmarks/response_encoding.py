@@ -0,0 +1,128 @@
+"""
+JSON rendering and response compression on the API's real payload shapes.
+
+Usage (from backend/):
+    python benchmarks/response_encoding.py [--repeat 50]
+
+Journal detail and month list come from the real routes (seeded throwaway
+DB, TestClient). Media replies are built the way the routes build them, with
+random bytes standing in for MP3 / PNG data (which is just as incompressible).
+For each payload: render time with the stdlib JSONResponse vs
+FastJSONResponse, then gzip-6 / brotli-4 size and CPU, and what
+CompressionMiddleware actually sends.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main1  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from http_encoding import CompressionMiddleware, FastJSONResponse, brotli, orjson  # noqa: E402
+from journal_store import SqliteJournalRepository  # noqa: E402
+
+USER_ID = "bench-user"
+TURNS = [
+    ("えっと、今日は店長と一緒に新しいメニューの試食をしたんだけど", "へえ、いいね！どんなメニューだったの？",
+     "诶，不错嘛！是什么样的菜单？", "Oh nice! What kind of menu was it?"),
+    ("カレーうどんとか、季節限定のパフェとか", "季節限定のパフェ、すごく気になる！味はどうだった？",
+     "季节限定的芭菲，好在意！味道怎么样？", "A seasonal parfait sounds great! How did it taste?"),
+    ("甘すぎなくてちょうどよかった。でも値段がちょっと高いかも", "なるほどね。お客さんの反応も楽しみだね",
+     "原来如此。也很期待客人的反应呢", "I see. Looking forward to the customers' reaction."),
+] * 3
+
+
+def seed_journals(count: int):
+    turns = [{"user_raw_text": u, "user_ja": u, "reply": r, "translation": zh, "translation_en": en,
+              "suggestion": "「ちょっと高いかもしれません」と言うと自然です", "reply_audio_path": f"x/reply_audio_{i}.mp3"}
+             for i, (u, r, zh, en) in enumerate(TURNS)]
+    script = [{"speaker": "先輩" if i % 2 else "わたし", "content": t[1]} for i, t in enumerate(TURNS * 2)]
+    rows = []
+    for i in range(count):
+        date = f"2026-03-{i % 28 + 1:02d}"
+        rows.append(dict(zip(main1.JOURNAL_COLUMNS, (
+            f"{date}-{i // 28 + 1}", date, i // 28 + 1, USER_ID, f"店長と新メニューの試食 {i}",
+            "今日は店長と一緒に新しいメニューの試食をした。" * 12, "今天和店长一起试吃了新菜单。" * 12,
+            json.dumps(script, ensure_ascii=False), "x/podcast.mp3", "x/scene_1.png", "x/scene_2.png",
+            "x/thumbnail.png", "今天和店长一起试吃了新菜单", "店長", "Gentle", 9, "2026-03-01T00:00:00",
+            json.dumps(turns, ensure_ascii=False),
+        ))))
+    asyncio.run(main1.journal_repo.insert_many([rows]))
+
+
+def media_payloads() -> dict:
+    b64 = lambda n: base64.b64encode(os.urandom(n)).decode("ascii")  # noqa: E731
+    communication = [{"role": "user" if i % 2 else "model", "content": t[i % 2], "translation": t[2]}
+                     for i, t in enumerate(TURNS * 2)]
+    return {
+        "chat reply (40 KB mp3)": {"status": "CONTINUE", "reply": TURNS[0][1], "translation": TURNS[0][2],
+                                   "translation_en": TURNS[0][3], "suggestion": "", "user_ja": TURNS[0][0],
+                                   "reply_audio": b64(40_000), "communication_raw": communication},
+        "image (1.2 MB png)": {"status": "SUCCESS", "image_base64": b64(1_200_000)},
+        "podcast audio (2.5 MB mp3)": {"status": "SUCCESS", "audio_base64": b64(2_500_000), "podcast_id": "0" * 32},
+    }
+
+
+def ms(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    print(f"orjson: {orjson.__version__ if orjson else 'not installed'}, brotli: {'yes' if brotli else 'no'}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main1.journal_repo = SqliteJournalRepository(Path(tmp) / "bench.db")
+        main1.app.dependency_overrides[main1.get_current_user_id] = lambda: USER_ID
+        seed_journals(60)
+        with TestClient(main1.app) as client:
+            payloads = {
+                "journal detail": client.get("/api/journal/2026-03-01-1").json(),
+                "journal list (60)": client.get("/api/journal/list?year=2026&month=3").json(),
+            }
+            wire = client.get("/api/journal/2026-03-01-1", headers={"Accept-Encoding": "br, gzip"})
+            print(f"GET /api/journal/{{id}}: Content-Encoding={wire.headers.get('content-encoding')}, "
+                  f"Vary={wire.headers.get('vary')}")
+    payloads.update(media_payloads())
+
+    middleware = CompressionMiddleware(None)
+    print(f"\n{'payload':<28}{'bytes':>10}{'stdlib ms':>11}{'orjson ms':>11}"
+          f"{'gzip':>9}{'gz ms':>8}{'br':>9}{'br ms':>8}   sent")
+    for name, payload in payloads.items():
+        body = FastJSONResponse(payload).body
+        assert json.loads(body) == json.loads(JSONResponse(payload).body)
+        stdlib_ms = ms(lambda: JSONResponse(payload), args.repeat)
+        fast_ms = ms(lambda: FastJSONResponse(payload), args.repeat)
+        gz = middleware.compress(body, "gzip")
+        gz_ms = ms(lambda: middleware.compress(body, "gzip"), max(3, args.repeat // 5))
+        if brotli is not None:
+            br = middleware.compress(body, "br")
+            br_ms = ms(lambda: middleware.compress(body, "br"), max(3, args.repeat // 5))
+        else:
+            br, br_ms = b"", float("nan")
+        if len(body) < middleware.minimum_size or not middleware._worth_it(body):
+            sent = f"identity {len(body)}"
+        else:
+            sent = f"{'br' if brotli else 'gzip'} {len(br or gz)} ({1 - len(br or gz) / len(body):.0%} saved)"
+        print(f"{name:<28}{len(body):>10}{stdlib_ms:>11.2f}{fast_ms:>11.2f}"
+              f"{len(gz):>9}{gz_ms:>8.2f}{len(br):>9}{br_ms:>8.2f}   {sent}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Precision / recall and latency of the local role detector.
+
+Usage (from backend/):
+    python benchmarks/role_detection.py                  # against the labelled corpus below
+    python benchmarks/role_detection.py --live           # also against Gemini (/api/detect_roles in model mode)
+    python benchmarks/role_detection.py --verbose        # print every disagreement
+
+Scores are computed over the texts the detector answers by itself (confident);
+the rest fall back to Gemini and are reported as the fallback rate. A
+predicted role matches a reference role when one contains the other, so
+田中さん / 田中 and friends / friend count as agreement.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from role_detector import RoleDetector  # noqa: E402
+
+# (text, roles a careful human would list), mixed zh / ja / en seed texts like the input page gets
+CORPUS = [
+    ("今天在打工的店里和店长一起做了新的架子", ["店长"]),
+    ("和朋友去了新开的咖啡店", ["朋友"]),
+    ("第一次用日语做了报告", []),
+    ("今天王老师表扬了我的作文", ["王老师"]),
+    ("周末和爸爸妈妈去爬山了", ["爸爸", "妈妈"]),
+    ("小李说明天的会议取消了", ["小李"]),
+    ("室友半夜打游戏吵得我睡不着", ["室友"]),
+    ("面试官问了我很多关于日本的问题", ["面试官"]),
+    ("今天一个人去看了电影", []),
+    ("下雨了，在家看书", []),
+    ("和男朋友吵架了，心情不好", ["男朋友"]),
+    ("陈经理让我重新写报告", ["陈经理"]),
+    ("奶奶做的饺子特别好吃", ["奶奶"]),
+    ("跟同事一起加班到十点", ["同事"]),
+    ("快递员把包裹放错了地方", ["快递员"]),
+    ("他今天又迟到了", ["他"]),
+    ("昨日山田さんと部長に会いました", ["山田さん", "部長"]),
+    ("先輩にラーメンを奢ってもらった", ["先輩"]),
+    ("母と一緒に買い物に行った", ["母"]),
+    ("バイト仲間と花火を見た", ["バイト仲間"]),
+    ("ゆきちゃんの誕生日パーティーだった", ["ゆきちゃん"]),
+    ("田中先生に日本語の発音を直してもらった", ["田中先生"]),
+    ("母国の料理を作ってみた", []),
+    ("お客さんに道を聞かれた", ["お客さん"]),
+    ("今日は一日中勉強した", []),
+    ("マイクさんと英語で話した", ["マイクさん"]),
+    ("彼女と映画を見に行った", ["彼女"]),
+    ("My boss asked me to stay late", ["boss"]),
+    ("Went hiking with my best friend and her sister", ["best friend", "sister"]),
+    ("Studied alone at the library all day", []),
+    ("Tanaka-san taught me how to make onigiri", ["Tanaka-san"]),
+    ("Had dinner with Mr. Suzuki after class", ["Mr. Suzuki"]),
+    ("The moment I saw the sunset I felt calm", []),
+    ("Talked with someone on the train about anime", ["someone"]),
+    ("和闺蜜去了箱根，还遇到了一个很热情的司机", ["闺蜜", "司机"]),
+    ("今天和老张一起钓鱼", ["老张"]),
+    ("一个小时就做完了作业", []),
+    ("店長さんがケーキをくれた", ["店長"]),
+    ("弟弟考上了大学", ["弟弟"]),
+    ("和刘阿姨聊了很久", ["刘阿姨"]),
+    # time / common words before a title are not names
+    ("昨日先輩とご飯を食べた", ["先輩"]),
+    ("今日店長に怒られた", ["店長"]),
+    ("明日部長と会議", ["部長"]),
+    ("毎日先生に会う", ["先生"]),
+    ("会社の部長と飲みに行った", ["部長"]),
+    ("山田先輩に資料を見てもらった", ["山田先輩"]),
+    ("I met my friend Tom at the station", ["Tom"]),
+    ("My coworker Lisa brought cookies", ["Lisa"]),
+    # bare kin characters, companions after 和 / 跟 / 同, names the patterns do not know
+    ("我妈今天做饭", ["妈"]),
+    ("今天和老王去钓鱼", ["老王"]),
+    ("我哥送了我一本书", ["哥"]),
+    ("老妈寄来了家乡的特产", ["老妈"]),
+    ("王哥请我们吃了烤肉", ["王哥"]),
+    ("和阿强一起吃了火锅", ["阿强"]),
+    ("同小美去逛街", ["小美"]),
+    ("Ran into Sarah at the station", ["Sarah"]),
+    ("It rained all Sunday so I stayed in", []),
+]
+
+
+def same_role(a: str, b: str) -> bool:
+    a, b = a.lower(), b.lower()
+    return a in b or b in a
+
+
+def score(pairs) -> tuple[float, float, list]:
+    """Micro precision / recall of predicted vs reference roles."""
+    tp = fp = fn = 0
+    misses = []
+    for text, predicted, reference in pairs:
+        matched = [p for p in predicted if any(same_role(p, r) for r in reference)]
+        found = [r for r in reference if any(same_role(p, r) for p in predicted)]
+        tp += len(matched)
+        fp += len(predicted) - len(matched)
+        fn += len(reference) - len(found)
+        if len(matched) != len(predicted) or len(found) != len(reference):
+            misses.append((text, predicted, reference))
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 1.0
+    return precision, recall, misses
+
+
+def per_call_us(detector: RoleDetector, texts: list[str], iterations: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            detector.detect(text)
+    return (time.perf_counter() - t0) / (iterations * len(texts)) * 1e6
+
+
+async def model_roles(texts: list[str]) -> list[list[str]]:
+    """What Gemini answers for each text, through the real route (model mode, cache bypassed)."""
+    import httpx
+
+    os.environ["ROLE_DETECT_MODE"] = "model"
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    import main1
+
+    main1.ROLE_DETECT_MODE = "model"
+    main1.rate_limiter.enabled = False
+    out = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main1.app), base_url="http://bench",
+                                 timeout=120) as client:
+        for text in texts:
+            resp = await client.post("/api/detect_roles", json={"text": text},
+                                     headers={"Cache-Control": "no-cache"})
+            out.append([str(r) for r in resp.json().get("roles", [])])
+    return out
+
+
+def report(name: str, pairs, verbose: bool):
+    precision, recall, misses = score(pairs)
+    print(f"{name:<10} n={len(pairs):<4} precision={precision:.3f} recall={recall:.3f}")
+    if verbose:
+        for text, predicted, reference in misses:
+            print(f"    {text}\n        local={predicted} reference={reference}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--iterations", type=int, default=2000)
+    ap.add_argument("--live", action="store_true", help="compare with Gemini output (needs GOOGLE_API_KEY)")
+    ap.add_argument("--verbose", action="store_true")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    detector = RoleDetector()
+    build_ms = (time.perf_counter() - t0) * 1000
+    texts = [text for text, _ in CORPUS]
+    detections = [detector.detect(text) for text in texts]
+    local = [(text, d.roles, gold) for (text, gold), d in zip(CORPUS, detections) if d.confident]
+
+    print(f"automaton build {build_ms:.1f} ms, detect {per_call_us(detector, texts, args.iterations):.1f} µs/text")
+    print(f"answered locally {len(local)}/{len(CORPUS)} "
+          f"(fallback rate {1 - len(local) / len(CORPUS):.1%})")
+    report("vs gold", local, args.verbose)
+
+    if args.live:
+        reference = asyncio.run(model_roles(texts))
+        live = [(text, d.roles, ref) for text, d, ref in zip(texts, detections, reference) if d.confident]
+        report("vs gemini", live, args.verbose)
+        report("gemini", [(text, ref, gold) for (text, gold), ref in zip(CORPUS, reference)], args.verbose)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Throughput vs. gunicorn worker count.
+
+Usage (from backend/, needs gunicorn + uvicorn-worker):
+    python benchmarks/scaling.py
+    python benchmarks/scaling.py --workers 1 2 4 8 --seconds 10 --clients 4 --concurrency 16
+
+For each worker count this starts `gunicorn main1:app -c gunicorn.conf.py`
+against fake providers with every database / cache in a fresh temp
+directory, waits for /readyz, then drives it from --clients load generator
+processes (each an asyncio loop with --concurrency requests in flight) for
+--seconds. The default request is /api/detect_roles answered by the local
+matcher: no upstream wait, so the server is CPU bound and requests/sec
+should grow with workers until the cores (shared with the load generators)
+run out. Also reports how many times the journal schema was migrated
+(should be exactly 1 per fresh database, whatever the worker count).
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+BODY = {"text": "今天和店长还有小李一起去看了电影，然后跟先輩吃了饭"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def load_client(url: str, path: str, seconds: float, concurrency: int, out):
+    import asyncio
+
+    import httpx
+
+    async def run():
+        latencies, errors = [], 0
+        deadline = time.perf_counter() + seconds
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=url, timeout=30, limits=limits) as client:
+            async def worker():
+                nonlocal errors
+                while time.perf_counter() < deadline:
+                    t0 = time.perf_counter()
+                    try:
+                        resp = await client.post(path, json=BODY)
+                        if resp.status_code != 200:
+                            errors += 1
+                    except httpx.HTTPError:
+                        errors += 1
+                    latencies.append(time.perf_counter() - t0)
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, errors
+
+    out.put(asyncio.run(run()))
+
+
+def run_workers(n: int, args) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="lifecho-scaling-") as tmp:
+        tmp = Path(tmp)
+        env = dict(
+            os.environ,
+            PORT=str(port), WEB_CONCURRENCY=str(n), LIFECHO_PROVIDERS="fake", RATE_LIMIT_ENABLED="0",
+            LOG_LEVEL="INFO", JOURNAL_SQLITE_PATH=str(tmp / "journals.db"),
+            SHARED_STATE_PATH=str(tmp / "shared_state.db"), MODEL_CACHE_PATH=str(tmp / "model_cache.db"),
+            SPEECH_CACHE_DIR=str(tmp / "tts_cache"), PODCAST_AUDIO_DIR=str(tmp / "podcasts"),
+        )
+        log_path = tmp / "server.log"
+        with open(log_path, "w") as log:
+            server = subprocess.Popen([sys.executable, "-m", "gunicorn", "main1:app", "-c", "gunicorn.conf.py"],
+                                      cwd=BACKEND, env=env, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                import httpx
+                url = f"http://127.0.0.1:{port}"
+                deadline = time.time() + 60
+                while True:
+                    try:
+                        if httpx.get(url + "/readyz", timeout=1).status_code == 200:
+                            break
+                    except httpx.HTTPError:
+                        pass
+                    if time.time() > deadline or server.poll() is not None:
+                        raise RuntimeError(f"server with {n} workers did not become ready:\n{log_path.read_text()[-2000:]}")
+                    time.sleep(0.2)
+                time.sleep(1.0)  # let every worker finish its warm-up
+
+                queue = multiprocessing.Queue()
+                clients = [multiprocessing.Process(target=load_client,
+                                                   args=(url, args.path, args.seconds, args.concurrency, queue))
+                           for _ in range(args.clients)]
+                t0 = time.perf_counter()
+                for c in clients:
+                    c.start()
+                results = [queue.get() for _ in clients]
+                wall = time.perf_counter() - t0
+                for c in clients:
+                    c.join()
+            finally:
+                server.terminate()
+                server.wait(30)
+        latencies = sorted(x for lat, _ in results for x in lat)
+        log_text = log_path.read_text()
+    return {
+        "workers": n,
+        "rps": len(latencies) / wall,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        "errors": sum(e for _, e in results),
+        "migrations": log_text.count("journal schema migrated"),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    ap.add_argument("--seconds", type=float, default=8.0)
+    ap.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                    help="load generator processes")
+    ap.add_argument("--concurrency", type=int, default=8, help="requests in flight per load generator")
+    ap.add_argument("--path", default="/api/detect_roles")
+    args = ap.parse_args()
+
+    print(f"cores: {os.cpu_count()}, load generators: {args.clients} x {args.concurrency}")
+    print(f"{'workers':>8}{'req/s':>10}{'speedup':>9}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}{'migrations':>12}")
+    base = None
+    for n in args.workers:
+        r = run_workers(n, args)
+        base = base or r["rps"]
+        print(f"{n:>8}{r['rps']:>10.0f}{r['rps'] / base:>8.2f}x{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}"
+              f"{r['errors']:>8}{r['migrations']:>12}")
+
+
+if __name__ == "__main__":
+    main()
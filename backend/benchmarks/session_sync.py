@@ -0,0 +1,120 @@
+"""
+Bytes written per chat session sync: whole-snapshot upsert vs JSON Patch deltas.
+
+Usage (from backend/):
+    python benchmarks/session_sync.py [--turns 12] [--audio-kb 40]
+
+Builds a CachedSession-shaped document the way the chat page does (every
+turn adds a turn with base64 reply audio, two history entries and the
+communication_raw pair) and syncs it after each turn:
+
+- upsert: the whole JSON document, which is what the page writes today
+- delta:  PATCH through SessionSync on a throwaway SQLite DB; counts the
+  op-log row, media files written, and compacted snapshots
+
+Random bytes stand in for the MP3 data (base64 of MP3 is just as
+incompressible).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from journal_store import SqliteJournalRepository  # noqa: E402
+from session_sync import SessionSync  # noqa: E402
+
+USER_ID = "bench-user"
+
+
+class CountingRepository(SqliteJournalRepository):
+    def __init__(self, path):
+        super().__init__(path)
+        self.written = 0
+
+    async def append_chat_session_ops(self, user_id, base_version, ops, updated_at):
+        self.written += len(ops.encode("utf-8"))
+        return await super().append_chat_session_ops(user_id, base_version, ops, updated_at)
+
+    async def replace_chat_session(self, user_id, snapshot, updated_at):
+        self.written += len(snapshot.encode("utf-8"))
+        return await super().replace_chat_session(user_id, snapshot, updated_at)
+
+    async def compact_chat_session(self, user_id, version, snapshot):
+        self.written += len(snapshot.encode("utf-8"))
+        await super().compact_chat_session(user_id, version, snapshot)
+
+
+def turn_ops(i: int, audio_kb: int) -> list[dict]:
+    user = f"えっと、今日は店長と一緒に新しいメニューの試食をしたんだけど ({i})"
+    reply = f"へえ、いいね！どんなメニューだったの？ ({i})"
+    turn = {"user_raw_text": user, "user_ja": user, "reply": reply, "translation": "诶，不错嘛！是什么样的菜单？",
+            "translation_en": "Oh nice! What kind of menu was it?", "suggestion": "",
+            "reply_audio": base64.b64encode(b"ID3" + os.urandom(audio_kb * 1024)).decode("ascii")}
+    return [
+        {"op": "add", "path": "/turns/-", "value": turn},
+        {"op": "add", "path": "/history/-", "value": {"role": "user", "content": user}},
+        {"op": "add", "path": "/history/-", "value": {"role": "model", "content": reply}},
+        {"op": "add", "path": "/communication_raw/-", "value": {"role": "user", "content": user}},
+        {"op": "add", "path": "/communication_raw/-", "value": {"role": "model", "content": reply}},
+        {"op": "replace", "path": "/round", "value": i + 1},
+        {"op": "replace", "path": "/updated_at", "value": f"2026-10-18T12:{i:02d}:00"},
+    ]
+
+
+def media_bytes(media_dir: Path) -> int:
+    return sum(p.stat().st_size for p in media_dir.rglob("*") if p.is_file())
+
+
+async def run(turns: int, audio_kb: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = CountingRepository(Path(tmp) / "bench.db")
+        media_dir = Path(tmp) / "media"
+        sync = SessionSync(lambda: repo, media_dir)
+        doc = {"role": "店長", "tone": "Gentle", "round": 0, "updated_at": "", "turns": [], "history": [],
+               "communication_raw": []}
+        version = await sync.put(USER_ID, doc)
+        upsert_total = delta_total = 0
+        print(f"{'turn':>4}{'upsert bytes':>14}{'delta bytes':>13}{'ms':>8}")
+        for i in range(turns):
+            ops = turn_ops(i, audio_kb)
+            doc = json.loads(json.dumps(doc))
+            for op in ops:  # the document the page would upsert
+                if op["op"] == "add":
+                    doc[op["path"].split("/")[1]].append(op["value"])
+                else:
+                    doc[op["path"].split("/")[1]] = op["value"]
+            upsert = len(json.dumps(doc, ensure_ascii=False).encode("utf-8"))
+
+            before = repo.written + media_bytes(media_dir)
+            t0 = time.perf_counter()
+            version = await sync.patch(USER_ID, version, ops)
+            elapsed = (time.perf_counter() - t0) * 1000
+            delta = repo.written + media_bytes(media_dir) - before
+            upsert_total += upsert
+            delta_total += delta
+            print(f"{i + 1:>4}{upsert:>14}{delta:>13}{elapsed:>8.1f}")
+
+        restored = (await sync.get(USER_ID, inline_media=True))["snapshot"]
+        assert restored == doc, "round trip mismatch"
+        print(f"\ntotal: upsert {upsert_total} bytes, delta {delta_total} bytes "
+              f"({delta_total / upsert_total:.1%}); round trip with inline_media=1 matches")
+        await repo.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--audio-kb", type=int, default=40)
+    args = parser.parse_args()
+    asyncio.run(run(args.turns, args.audio_kb))
+
+
+if __name__ == "__main__":
+    main()
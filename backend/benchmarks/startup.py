@@ -0,0 +1,72 @@
+"""
+Import-time profile of main1.
+
+Usage (from backend/):
+    python benchmarks/startup.py [--top 15]
+
+Runs `python -X importtime -c "import main1"` in a fresh interpreter, prints
+the total and the slowest modules by cumulative time, then times a
+TestClient lifespan until /readyz stops returning 503.
+"""
+import argparse
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def profile_imports(top: int):
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main1"],
+        cwd=BACKEND_DIR, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - t0
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m:
+            self_us, cumulative_us, indent, name = m.groups()
+            # only direct imports of main1 and their children one level down
+            if len(indent) <= 3:
+                entries.append((int(cumulative_us), int(self_us), name))
+    main = next((e for e in entries if e[2] == "main1"), None)
+    print(f"interpreter + import main1: {wall:.2f}s wall")
+    if main:
+        print(f"main1 cumulative {main[0] / 1e6:.3f}s (self {main[1] / 1e6:.3f}s)")
+    print(f"\nslowest top-level imports:")
+    for cumulative, self_us, name in sorted(entries, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:9.1f} ms  {name}")
+
+
+def time_readiness():
+    sys.path.insert(0, str(BACKEND_DIR))
+    t0 = time.perf_counter()
+    import main1
+    from fastapi.testclient import TestClient
+    imported = time.perf_counter() - t0
+    with TestClient(main1.app) as client:
+        started = time.perf_counter()
+        while client.get("/readyz").status_code == 503 and main1._warmup_state["state"] in ("pending", "running"):
+            time.sleep(0.01)
+        ready = time.perf_counter() - started
+        body = client.get("/readyz").json()
+    print(f"\nimport in-process: {imported:.2f}s, lifespan warm-up until readiness settled: {ready:.2f}s")
+    for name, comp in body["components"].items():
+        print(f"  {name}: {comp}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    profile_imports(args.top)
+    time_readiness()
+
+
+if __name__ == "__main__":
+    main()
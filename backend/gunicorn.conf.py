@@ -0,0 +1,59 @@
+"""
+gunicorn settings for the multi-worker mode (see Procfile):
+
+    gunicorn main1:app -c gunicorn.conf.py
+    WEB_CONCURRENCY=4 gunicorn main1:app -c gunicorn.conf.py
+
+- uvicorn workers; with uvicorn[standard] installed they run on uvloop and
+  httptools automatically ("auto" loop / http).
+- WEB_CONCURRENCY workers, default one per core (at most 8). main1 reads the
+  same variable: rate-limit buckets move to the shared SQLite file and
+  UPSTREAM_CONCURRENCY is split between the workers.
+- The journal schema is migrated once here in the master, before any worker
+  is forked; the workers find it at the current version and skip it.
+- The app is not preloaded: the Google SDK clients (gRPC) must be created
+  after the fork, which main1 does lazily anyway.
+"""
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY") or min(8, os.cpu_count() or 1))
+os.environ["WEB_CONCURRENCY"] = str(workers)  # inherited by the workers
+worker_class = "uvicorn_worker.UvicornWorker"
+# image generation may take up to 120 s upstream, plus retries
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    from dotenv import load_dotenv
+
+    from journal_store import create_journal_repository
+
+    load_dotenv()
+    repo = create_journal_repository(
+        os.getenv("JOURNAL_DATABASE_URL"),
+        Path(os.getenv("JOURNAL_SQLITE_PATH", str(Path(__file__).parent / "journals.db"))),
+    )
+
+    async def migrate():
+        try:
+            await repo.migrate()
+        finally:
+            await repo.close()
+
+    # app_logging's queue listener must not start in the master (forked workers would inherit a dead one)
+    journal_log = logging.getLogger("lifecho.journal")
+    handler = logging.StreamHandler()
+    journal_log.addHandler(handler)
+    journal_log.setLevel(logging.INFO)
+    try:
+        asyncio.run(migrate())
+    finally:
+        journal_log.removeHandler(handler)
+        journal_log.setLevel(logging.NOTSET)
+    server.log.info("journal schema ready; starting %d workers", workers)
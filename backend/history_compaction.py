@@ -0,0 +1,140 @@
+"""
+Token-budgeted history compaction for long chats.
+
+Every chat turn sends the whole conversation to Gemini (as chat history,
+or as one history_context string next to a recording), and summarize /
+refine_summary / scene prompts / podcast script paste it verbatim, so prompt
+tokens and latency grow with `turn`. A route asks for its history within a
+token budget:
+
+    compacted = await history_compactor.compact(messages, budget, session=context)
+    text = "\\n".join(compacted.lines(lambda role, content: f"{role}: {content}"))
+
+- under budget: the messages come back untouched (no summary), so short
+  chats render the same prompt as before and keep their model cache keys
+- over budget: the last keep_turns turns stay verbatim, everything older
+  is folded into a rolling summary rendered as the first line
+
+Folds happen in steps of fold_turns turns, so the folded prefix only changes
+every few turns and its summary is reused in between. A new fold summarizes
+the previous summary plus the messages added since (incremental) when that
+summary is known, otherwise the whole prefix in one call. Summaries are
+cached per session by prefix hash, and the call that would need one next
+turn can be started in the background (prefetch) while the user is reading
+the reply. If summarizing fails the oldest messages are simply dropped.
+
+Token counts are estimates: one token per CJK character, one per four
+other characters, which is close to Gemini's tokenizer on this mixed
+Japanese / Chinese / English text and needs no tokenizer download.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from metrics import FALLBACKS, HISTORY_COMPACTION
+
+logger = logging.getLogger("lifecho.history")
+
+Message = tuple[str, str]  # (role, content)
+
+
+def estimate_tokens(text: str) -> int:
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _message_tokens(message: Message) -> int:
+    return estimate_tokens(message[1]) + 4  # role label and separators
+
+
+@dataclass
+class CompactedHistory:
+    summary: Optional[str]
+    recent: list[Message]
+    folded: int = 0  # messages folded into summary
+
+    def lines(self, line: Callable[[str, str], str], summary_label: str = "[之前对话的摘要]") -> list[str]:
+        out = [f"{summary_label} {self.summary}"] if self.summary else []
+        return out + [line(role, content) for role, content in self.recent]
+
+    def tokens(self) -> int:
+        return (estimate_tokens(self.summary) if self.summary else 0) + sum(map(_message_tokens, self.recent))
+
+
+class HistoryCompactor:
+    def __init__(self, summarize: Callable[[Optional[str], list[Message]], Awaitable[str]], keep_turns: int = 4,
+                 fold_turns: int = 4, cache_size: int = 1024, enabled: bool = True):
+        self.summarize = summarize  # (previous summary or None, messages to fold) -> new summary
+        self.keep_messages = 2 * keep_turns
+        self.fold_messages = 2 * max(1, fold_turns)
+        self.cache_size = cache_size
+        self.enabled = enabled
+        self._summaries: "OrderedDict[str, asyncio.Task]" = OrderedDict()
+
+    @staticmethod
+    def _prefix_key(session: str, messages: list[Message]) -> str:
+        payload = json.dumps([session, messages], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _fold_point(self, messages: list[Message], budget: int) -> int:
+        """How many leading messages to fold: 0 if the history fits the budget."""
+        if not self.enabled or sum(map(_message_tokens, messages)) <= budget:
+            return 0
+        foldable = len(messages) - self.keep_messages
+        return max(0, foldable // self.fold_messages * self.fold_messages)
+
+    def _summary_task(self, session: str, prefix: list[Message]) -> asyncio.Task:
+        key = self._prefix_key(session, prefix)
+        task = self._summaries.get(key)
+        if task is not None and not (task.done() and (task.cancelled() or task.exception())):
+            self._summaries.move_to_end(key)
+            HISTORY_COMPACTION.inc(result="reused")
+            return task
+
+        previous = None
+        start = 0
+        if len(prefix) > self.fold_messages:
+            before = self._summaries.get(self._prefix_key(session, prefix[:-self.fold_messages]))
+            if before is not None and before.done() and not before.cancelled() and not before.exception():
+                previous, start = before.result(), len(prefix) - self.fold_messages
+        HISTORY_COMPACTION.inc(result="incremental" if previous else "full")
+        task = asyncio.ensure_future(self.summarize(previous, prefix[start:]))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # a failed prefetch nobody awaited
+        self._summaries[key] = task
+        while len(self._summaries) > self.cache_size:
+            _, evicted = self._summaries.popitem(last=False)
+            if not evicted.done():
+                evicted.cancel()
+        return task
+
+    async def compact(self, messages: list[Message], budget: int, session: str = "") -> CompactedHistory:
+        fold = self._fold_point(messages, budget)
+        if fold == 0:
+            return CompactedHistory(None, list(messages))
+        try:
+            summary = await asyncio.shield(self._summary_task(session, messages[:fold]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            FALLBACKS.inc(kind="history_compaction.error")
+            logger.warning("历史摘要失败，丢弃最早的 %d 条消息: %s: %s", fold, type(e).__name__, e)
+            return CompactedHistory(None, list(messages[fold:]), fold)
+        compacted = CompactedHistory(summary, list(messages[fold:]), fold)
+        logger.debug("历史压缩: %d 条消息 -> 摘要 + %d 条, 约 %d tokens",
+                     len(messages), len(compacted.recent), compacted.tokens())
+        return compacted
+
+    def prefetch(self, messages: list[Message], budget: int, session: str = ""):
+        """Start the summary compact() will need for messages, without waiting for it."""
+        fold = self._fold_point(messages, budget)
+        if fold:
+            self._summary_task(session, messages[:fold])
+
+    def close(self):
+        for task in self._summaries.values():
+            task.cancel()
+        self._summaries.clear()
@@ -0,0 +1,145 @@
+"""
+Output image optimization for generated scenes and avatars.
+
+The image model answers with a 1-2 MB PNG (1024px+, sometimes with text
+chunks / ICC profiles), which used to go to the client as base64 and, for
+scenes, into uploads/ verbatim. Before an image leaves the server it is
+
+    decode -> downscale to the display size -> WebP (or AVIF) at a quality target
+
+with no metadata carried over (EXIF, XMP, ICC, PNG text chunks). Encoding
+runs in worker threads (Pillow releases the GIL), at most max_workers at a
+time, so a burst of image replies never blocks the event loop.
+
+Anything that does not pay keeps the original bytes: Pillow missing,
+undecodable data, an encoder error, output not smaller, or input that is
+already WebP / AVIF at display size (re-encoding would only lose quality).
+Callers that want the model's original as well (re-editing, printing) ask
+for it with keep_original.
+"""
+import asyncio
+import base64
+import io
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from metrics import FALLBACKS, IMAGE_OPTIMIZE_BYTES
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # optional: images pass through unchanged
+    Image = None
+
+logger = logging.getLogger("lifecho.image")
+
+MIME_TYPES = {"webp": "image/webp", "avif": "image/avif", "png": "image/png", "jpeg": "image/jpeg"}
+EXTENSIONS = {mime: ext for ext, mime in MIME_TYPES.items()}
+
+
+def sniff_image_type(data: bytes) -> str:
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return "application/octet-stream"
+
+
+@dataclass
+class OptimizedImage:
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    original: Optional[bytes] = None  # only with keep_original
+    original_mime_type: Optional[str] = None
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - len(self.data)
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS.get(self.mime_type, "bin")
+
+    def report(self) -> dict:
+        """Fields merged into API replies: what was sent and how much it saved."""
+        out = {"mime_type": self.mime_type, "bytes": len(self.data),
+               "original_bytes": self.original_bytes, "saved_bytes": self.saved_bytes}
+        if self.original is not None:
+            out["original_base64"] = base64.b64encode(self.original).decode("utf-8")
+            out["original_mime_type"] = self.original_mime_type
+        return out
+
+
+class ImageOptimizer:
+    def __init__(self, output_format: str = "webp", webp_quality: int = 80, avif_quality: int = 60,
+                 max_workers: Optional[int] = None, min_bytes: int = 16 * 1024, enabled: bool = True):
+        if output_format == "avif" and Image is not None and not features.check("avif"):
+            logger.warning("Pillow 不支持 AVIF 编码，图片改用 WebP")
+            output_format = "webp"
+        self.output_format = output_format
+        self.webp_quality = webp_quality
+        self.avif_quality = avif_quality
+        self.min_bytes = min_bytes
+        self.enabled = enabled and Image is not None
+        self._slots = asyncio.Semaphore(max_workers or max(2, os.cpu_count() or 2))
+        if enabled and Image is None:
+            logger.warning("未安装 Pillow，生成的图片不做压缩")
+
+    def encode(self, data: bytes, max_size: int) -> tuple[bytes, str]:
+        """Blocking: (bytes, mime_type) of the downscaled, re-encoded image; raises on undecodable input."""
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)  # keep the orientation the EXIF we are dropping described
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+            if img.mode == "RGBA" and img.getextrema()[3][0] == 255:
+                img = img.convert("RGB")  # fully opaque: no alpha plane to encode
+            if max(img.size) > max_size:
+                img.thumbnail((max_size, max_size), Image.LANCZOS)
+            out = io.BytesIO()
+            # a fresh save only writes what is passed: no exif / icc_profile / xmp
+            if self.output_format == "avif":
+                img.save(out, "AVIF", quality=self.avif_quality, speed=6)
+            else:
+                img.save(out, "WEBP", quality=self.webp_quality, method=4)
+        return out.getvalue(), MIME_TYPES[self.output_format]
+
+    def _needs_work(self, data: bytes, mime_type: str, max_size: int) -> bool:
+        if mime_type not in ("image/webp", "image/avif"):
+            return True
+        try:
+            with Image.open(io.BytesIO(data)) as img:  # header only
+                return max(img.size) > max_size
+        except Exception:
+            return False
+
+    async def optimize(self, data: bytes, max_size: int, keep_original: bool = False,
+                       kind: str = "image") -> OptimizedImage:
+        """The image to send / store; the input unchanged whenever optimizing doesn't pay."""
+        mime_type = sniff_image_type(data)
+        result = OptimizedImage(data, mime_type, len(data))
+        if keep_original:
+            result.original, result.original_mime_type = data, mime_type
+        if not self.enabled or len(data) < self.min_bytes or not self._needs_work(data, mime_type, max_size):
+            return result
+        try:
+            async with self._slots:
+                out, out_type = await asyncio.to_thread(self.encode, data, max_size)
+        except Exception as e:
+            FALLBACKS.inc(kind="image_optimize.error")
+            logger.warning("图片压缩失败，使用原图: %s: %s", type(e).__name__, e)
+            return result
+        if len(out) >= len(data):
+            FALLBACKS.inc(kind="image_optimize.kept_original")
+            return result
+        IMAGE_OPTIMIZE_BYTES.inc(len(data), kind=kind, stage="in")
+        IMAGE_OPTIMIZE_BYTES.inc(len(out), kind=kind, stage="out")
+        result.data, result.mime_type = out, out_type
+        logger.info("%s 图片压缩: %d -> %d 字节 (节省 %d, %s -> %s)",
+                    kind, len(data), len(out), result.saved_bytes, mime_type, out_type)
+        return result
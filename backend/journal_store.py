@@ -0,0 +1,836 @@
+"""
+Journal storage backends.
+
+main1.py only talks to the journals table (and the chat session sync
+tables, see session_sync.py) through a JournalRepository.
+journal_days keeps per-(user, date) aggregates for the calendar; it is
+updated in the same transaction as every journals insert.
+Set JOURNAL_DATABASE_URL to a postgres:// DSN to share one database between
+replicas (asyncpg, pooled); otherwise journals live in the local SQLite file.
+
+Migrations are versioned (SCHEMA_VERSION) and serialized across processes
+(a lock file next to the SQLite database / a Postgres advisory lock), so with
+several workers starting at once the schema is created exactly once.
+"""
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Optional
+
+logger = logging.getLogger("lifecho.journal")
+
+# bump together with a new step in _create_schema / POSTGRES_SCHEMA
+# v2: chat_session_snapshots / chat_session_ops
+# v3: journal_days (calendar aggregates, backfilled from journals)
+# v4: (user_id, created_at, id) index for the timeline; NULL created_at backfilled
+# v5: journals keyed by (user_id, id) instead of id alone
+SCHEMA_VERSION = 5
+_MIGRATION_LOCK_ID = 0x11FEC40  # pg_advisory_xact_lock key
+
+JOURNAL_COLUMNS = (
+    "id", "date", "session_num", "user_id", "title", "diary_ja", "diary_zh",
+    "podcast_script", "podcast_audio_path", "scene_1_path", "scene_2_path",
+    "thumbnail_path", "entry_text", "role", "tone", "rounds", "created_at", "chat_turns",
+)
+
+# Columns the month calendar needs; keeps list queries off the large text columns.
+JOURNAL_LIST_COLUMNS = ("id", "date", "session_num", "rounds", "thumbnail_path", "title")
+JOURNAL_DAY_COLUMNS = ("date", "entries", "rounds", "thumbnail_path")
+JOURNAL_TIMELINE_COLUMNS = JOURNAL_LIST_COLUMNS + ("created_at",)
+
+
+class JournalConflictError(Exception):
+    """An inserted row collides with an existing journal id."""
+
+
+def _chat_session(row, ops) -> dict:
+    return {
+        "version": row["version"],
+        "snapshot_version": row["snapshot_version"],
+        "snapshot": row["snapshot"],
+        "updated_at": row["updated_at"],
+        "ops": [(r["version"], r["ops"]) for r in ops],
+    }
+
+
+class JournalRepository(ABC):
+    """Async access to journals rows. Rows are plain dicts keyed by JOURNAL_COLUMNS."""
+
+    schema_ready = False
+
+    @abstractmethod
+    async def migrate(self):
+        """Create / upgrade the schema. Idempotent; also run lazily before the first query."""
+
+    @abstractmethod
+    async def session_counts(self, user_id: str, date: Optional[str] = None) -> dict[str, int]:
+        """Number of entries per date for user_id (only `date` if given)."""
+
+    @abstractmethod
+    async def insert_many(self, batches: Iterable[list[dict]]) -> int:
+        """Insert every batch in a single transaction; returns the row count.
+
+        `batches` may do blocking work (file IO) while it is iterated, so
+        implementations consume it off the event loop.
+        """
+
+    async def insert(self, record: dict):
+        await self.insert_many([[record]])
+
+    @abstractmethod
+    async def list_month(self, user_id: str, year: int, month: int) -> list[dict]:
+        """JOURNAL_LIST_COLUMNS for one month, ordered by date, session_num."""
+
+    @abstractmethod
+    async def timeline(self, user_id: str, limit: int, before: Optional[tuple[str, str]] = None) -> list[dict]:
+        """JOURNAL_TIMELINE_COLUMNS, newest first: at most limit rows after the (created_at, id) key `before`."""
+
+    @abstractmethod
+    async def calendar(self, user_id: str, year: int) -> list[dict]:
+        """JOURNAL_DAY_COLUMNS for every day of year that has entries, ordered by date."""
+
+    @abstractmethod
+    async def get(self, user_id: str, journal_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def iter_user(self, user_id: str, batch_size: int) -> AsyncIterator[list[dict]]:
+        """Every row for user_id, streamed in batches of at most batch_size."""
+
+    # --- chat session sync: a compacted JSON snapshot plus the op log after it ---
+
+    @abstractmethod
+    async def load_chat_session(self, user_id: str) -> Optional[dict]:
+        """{"version", "snapshot_version", "snapshot", "updated_at", "ops": [(version, ops_json), ...]}, read consistently."""
+
+    @abstractmethod
+    async def append_chat_session_ops(self, user_id: str, base_version: int, ops: str, updated_at: str) -> bool:
+        """Store ops as version base_version + 1 if the session is still at base_version (compare-and-set)."""
+
+    @abstractmethod
+    async def replace_chat_session(self, user_id: str, snapshot: str, updated_at: str) -> int:
+        """Replace the whole snapshot (dropping the op log); returns the new version."""
+
+    @abstractmethod
+    async def compact_chat_session(self, user_id: str, version: int, snapshot: str):
+        """Store snapshot as the state at version and delete the ops it folds in."""
+
+    @abstractmethod
+    async def delete_chat_session(self, user_id: str):
+        ...
+
+    async def close(self):
+        pass
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Exclusive lock between processes (POSIX); a no-op where fcntl is missing (single-process dev)."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _month_prefix(year: int, month: int) -> str:
+    return f"{year}-{str(month).zfill(2)}%"
+
+
+def _year_range(year: int) -> tuple[str, str]:
+    # dates are "YYYY-MM-DD" text: a range on the (user_id, date) key, not LIKE
+    return f"{year:04d}-", f"{year + 1:04d}-"
+
+
+def _insert_sql(placeholder) -> str:
+    return (
+        f"INSERT INTO journals ({', '.join(JOURNAL_COLUMNS)}) "
+        f"VALUES ({', '.join(placeholder(i) for i in range(1, len(JOURNAL_COLUMNS) + 1))})"
+    )
+
+
+def _day_upsert_sql(placeholder) -> str:
+    # the thumbnail shown for a day is the one of its latest entry that has one
+    return (
+        "INSERT INTO journal_days (user_id, date, entries, rounds, thumbnail_path, thumbnail_session) "
+        f"VALUES ({placeholder(1)}, {placeholder(2)}, 1, {placeholder(3)}, {placeholder(4)}, "
+        f"CASE WHEN {placeholder(4)} IS NULL THEN 0 ELSE {placeholder(5)} END) "
+        "ON CONFLICT (user_id, date) DO UPDATE SET "
+        "entries = journal_days.entries + 1, "
+        "rounds = journal_days.rounds + excluded.rounds, "
+        "thumbnail_path = CASE WHEN excluded.thumbnail_path IS NOT NULL "
+        "AND excluded.thumbnail_session >= journal_days.thumbnail_session "
+        "THEN excluded.thumbnail_path ELSE journal_days.thumbnail_path END, "
+        "thumbnail_session = CASE WHEN excluded.thumbnail_path IS NOT NULL "
+        "AND excluded.thumbnail_session >= journal_days.thumbnail_session "
+        "THEN excluded.thumbnail_session ELSE journal_days.thumbnail_session END"
+    )
+
+
+def _day_params(r: dict) -> tuple:
+    return r.get("user_id"), r.get("date"), r.get("rounds") or 0, r.get("thumbnail_path"), r.get("session_num") or 0
+
+
+# keyset pagination: seek on the (user_id, created_at, id) index, never OFFSET
+_TIMELINE_ORDER = "ORDER BY created_at DESC, id DESC LIMIT"
+_CREATED_AT_BACKFILL_SQL = "UPDATE journals SET created_at = date || 'T00:00:00' WHERE created_at IS NULL"
+
+_DAYS_BACKFILL_SQL = """
+INSERT INTO journal_days (user_id, date, entries, rounds, thumbnail_path, thumbnail_session)
+SELECT j.user_id, j.date, COUNT(*), COALESCE(SUM(j.rounds), 0),
+       (SELECT t.thumbnail_path FROM journals t
+        WHERE t.user_id = j.user_id AND t.date = j.date AND t.thumbnail_path IS NOT NULL
+        ORDER BY t.session_num DESC LIMIT 1),
+       COALESCE((SELECT MAX(t.session_num) FROM journals t
+                 WHERE t.user_id = j.user_id AND t.date = j.date AND t.thumbnail_path IS NOT NULL), 0)
+FROM journals j
+WHERE j.user_id IS NOT NULL
+GROUP BY j.user_id, j.date
+"""
+
+
+# ------------------------------------------------------------
+# SQLite
+# ------------------------------------------------------------
+
+# user_id stays nullable here: rows saved before accounts existed have none
+_SQLITE_JOURNALS_TABLE = """
+    CREATE TABLE {name} (
+        id TEXT NOT NULL,
+        date TEXT NOT NULL,
+        session_num INTEGER NOT NULL,
+        user_id TEXT,
+        title TEXT,
+        diary_ja TEXT,
+        diary_zh TEXT,
+        podcast_script TEXT,
+        podcast_audio_path TEXT,
+        scene_1_path TEXT,
+        scene_2_path TEXT,
+        thumbnail_path TEXT,
+        entry_text TEXT,
+        role TEXT,
+        tone TEXT,
+        rounds INTEGER DEFAULT 0,
+        created_at TEXT,
+        chat_turns TEXT,
+        PRIMARY KEY (user_id, id)
+    )
+"""
+
+class SqliteJournalRepository(JournalRepository):
+    """Local file backend. Blocking sqlite3 calls run in worker threads over a small connection pool."""
+
+    def __init__(self, path: Path, pool_size: int = 4):
+        self.path = Path(path)
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._migrate_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def _migrate(self):
+        with self._migrate_lock:
+            if self.schema_ready:
+                return
+            with _file_lock(self.path.with_name(self.path.name + ".migrate.lock")):
+                with self._conn() as conn:
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < SCHEMA_VERSION:
+                    self._create_schema()
+                    with self._conn() as conn:
+                        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                        conn.commit()
+                    logger.info("journal schema migrated: v%d -> v%d (%s)", version, SCHEMA_VERSION, self.path.name)
+            self.schema_ready = True
+
+    def _create_schema(self):
+        with self._conn() as conn:
+            # WAL lets the list/get readers run while a save or import is writing
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SQLITE_JOURNALS_TABLE.format(name="IF NOT EXISTS journals"))
+            for column in ("chat_turns", "user_id"):  # DBs created before these columns existed
+                try:
+                    conn.execute(f"ALTER TABLE journals ADD COLUMN {column} TEXT")
+                except sqlite3.OperationalError:
+                    pass
+            key = [r["name"] for r in sorted(conn.execute("PRAGMA table_info(journals)"), key=lambda r: r["pk"])
+                   if r["pk"]]
+            if key != ["user_id", "id"]:
+                # ids are per user (date-session): up to v4 id alone was the key, so one account's
+                # archive could not be imported into another. SQLite cannot alter a primary key.
+                conn.execute("BEGIN")
+                conn.execute("DROP TABLE IF EXISTS journals_rebuild")
+                conn.execute(_SQLITE_JOURNALS_TABLE.format(name="journals_rebuild"))
+                columns = ", ".join(JOURNAL_COLUMNS)
+                conn.execute(f"INSERT INTO journals_rebuild ({columns}) SELECT {columns} FROM journals")
+                conn.execute("DROP TABLE journals")  # drops its indexes too: recreated below
+                conn.execute("ALTER TABLE journals_rebuild RENAME TO journals")
+                conn.commit()
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_journals_date ON journals(date)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_journals_user ON journals(user_id)")
+            conn.execute(_CREATED_AT_BACKFILL_SQL)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_journals_user_created ON journals(user_id, created_at, id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS journal_days (
+                    user_id TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    entries INTEGER NOT NULL,
+                    rounds INTEGER NOT NULL,
+                    thumbnail_path TEXT,
+                    thumbnail_session INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, date)
+                )
+            """)
+            # recomputed from journals: also repairs the aggregate of a DB that skipped a version
+            conn.execute("DELETE FROM journal_days")
+            conn.execute(_DAYS_BACKFILL_SQL)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_session_snapshots (
+                    user_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    snapshot_version INTEGER NOT NULL,
+                    snapshot TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_session_ops (
+                    user_id TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    ops TEXT NOT NULL,
+                    PRIMARY KEY (user_id, version)
+                )
+            """)
+            conn.commit()
+
+    # --- sync implementations, always called via asyncio.to_thread ---
+
+    def _session_counts(self, user_id, date):
+        sql = "SELECT date, entries FROM journal_days WHERE user_id = ?"
+        params: tuple = (user_id,)
+        if date is not None:
+            sql += " AND date = ?"
+            params += (date,)
+        with self._conn() as conn:
+            return {r["date"]: r["entries"] for r in conn.execute(sql, params)}
+
+    def _insert_many(self, batches):
+        sql = _insert_sql(lambda i: "?")
+        day_sql = _day_upsert_sql(lambda i: f"?{i}")
+        total = 0
+        with self._conn() as conn:
+            conn.execute("BEGIN")
+            try:
+                for batch in batches:
+                    conn.executemany(sql, [tuple(r.get(c) for c in JOURNAL_COLUMNS) for r in batch])
+                    conn.executemany(day_sql, [_day_params(r) for r in batch])
+                    total += len(batch)
+            except sqlite3.IntegrityError as e:
+                raise JournalConflictError(str(e)) from e
+            conn.commit()
+        return total
+
+    def _list_month(self, user_id, year, month):
+        with self._conn() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(JOURNAL_LIST_COLUMNS)} FROM journals "
+                "WHERE date LIKE ? AND user_id = ? ORDER BY date, session_num",
+                (_month_prefix(year, month), user_id),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def _timeline(self, user_id, limit, before):
+        sql = f"SELECT {', '.join(JOURNAL_TIMELINE_COLUMNS)} FROM journals WHERE user_id = ?"
+        params: tuple = (user_id,)
+        if before is not None:
+            sql += " AND (created_at, id) < (?, ?)"
+            params += tuple(before)
+        with self._conn() as conn:
+            rows = conn.execute(f"{sql} {_TIMELINE_ORDER} ?", params + (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def _calendar(self, user_id, year):
+        with self._conn() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(JOURNAL_DAY_COLUMNS)} FROM journal_days "
+                "WHERE user_id = ? AND date >= ? AND date < ? ORDER BY date",
+                (user_id, *_year_range(year)),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def _get(self, user_id, journal_id):
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT * FROM journals WHERE id = ? AND user_id = ?",
+                (journal_id, user_id),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _load_chat_session(self, user_id):
+        with self._conn() as conn:
+            conn.execute("BEGIN")  # snapshot and op log from the same point in time
+            row = conn.execute(
+                "SELECT version, snapshot_version, snapshot, updated_at FROM chat_session_snapshots WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+            ops = [] if row is None else conn.execute(
+                "SELECT version, ops FROM chat_session_ops WHERE user_id = ? AND version > ? ORDER BY version",
+                (user_id, row["snapshot_version"]),
+            ).fetchall()
+            conn.commit()
+        return None if row is None else _chat_session(row, ops)
+
+    def _append_chat_session_ops(self, user_id, base_version, ops, updated_at):
+        with self._conn() as conn:
+            if base_version == 0:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO chat_session_snapshots "
+                    "(user_id, version, snapshot_version, snapshot, updated_at) VALUES (?, 1, 0, 'null', ?)",
+                    (user_id, updated_at),
+                )
+            else:
+                cur = conn.execute(
+                    "UPDATE chat_session_snapshots SET version = version + 1, updated_at = ? "
+                    "WHERE user_id = ? AND version = ?",
+                    (updated_at, user_id, base_version),
+                )
+            if cur.rowcount != 1:
+                conn.rollback()
+                return False
+            conn.execute(
+                "INSERT INTO chat_session_ops (user_id, version, ops) VALUES (?, ?, ?)",
+                (user_id, base_version + 1, ops),
+            )
+            conn.commit()
+        return True
+
+    def _replace_chat_session(self, user_id, snapshot, updated_at):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO chat_session_snapshots (user_id, version, snapshot_version, snapshot, updated_at) "
+                "VALUES (?, 1, 1, ?, ?) ON CONFLICT (user_id) DO UPDATE SET "
+                "version = chat_session_snapshots.version + 1, "
+                "snapshot_version = chat_session_snapshots.version + 1, "
+                "snapshot = excluded.snapshot, updated_at = excluded.updated_at",
+                (user_id, snapshot, updated_at),
+            )
+            version = conn.execute(
+                "SELECT version FROM chat_session_snapshots WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+            conn.execute("DELETE FROM chat_session_ops WHERE user_id = ? AND version <= ?", (user_id, version))
+            conn.commit()
+        return version
+
+    def _compact_chat_session(self, user_id, version, snapshot):
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE chat_session_snapshots SET snapshot = ?, snapshot_version = ? "
+                "WHERE user_id = ? AND snapshot_version < ? AND version >= ?",
+                (snapshot, version, user_id, version, version),
+            )
+            if cur.rowcount == 1:
+                conn.execute("DELETE FROM chat_session_ops WHERE user_id = ? AND version <= ?", (user_id, version))
+            conn.commit()
+
+    def _delete_chat_session(self, user_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM chat_session_snapshots WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM chat_session_ops WHERE user_id = ?", (user_id,))
+            conn.commit()
+
+    # --- async interface ---
+
+    async def migrate(self):
+        if not self.schema_ready:
+            await asyncio.to_thread(self._migrate)
+
+    async def session_counts(self, user_id, date=None):
+        await self.migrate()
+        return await asyncio.to_thread(self._session_counts, user_id, date)
+
+    async def insert_many(self, batches):
+        await self.migrate()
+        return await asyncio.to_thread(self._insert_many, batches)
+
+    async def list_month(self, user_id, year, month):
+        await self.migrate()
+        return await asyncio.to_thread(self._list_month, user_id, year, month)
+
+    async def timeline(self, user_id, limit, before=None):
+        await self.migrate()
+        return await asyncio.to_thread(self._timeline, user_id, limit, before)
+
+    async def calendar(self, user_id, year):
+        await self.migrate()
+        return await asyncio.to_thread(self._calendar, user_id, year)
+
+    async def get(self, user_id, journal_id):
+        await self.migrate()
+        return await asyncio.to_thread(self._get, user_id, journal_id)
+
+    async def iter_user(self, user_id, batch_size):
+        await self.migrate()
+        # A dedicated connection, not a pool slot: a slow export download must
+        # not starve the request handlers.
+        conn = await asyncio.to_thread(self._connect)
+        try:
+            cursor = await asyncio.to_thread(
+                conn.execute,
+                "SELECT * FROM journals WHERE user_id = ? ORDER BY date, session_num",
+                (user_id,),
+            )
+            while True:
+                rows = await asyncio.to_thread(cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield [dict(r) for r in rows]
+        finally:
+            conn.close()
+
+    async def load_chat_session(self, user_id):
+        await self.migrate()
+        return await asyncio.to_thread(self._load_chat_session, user_id)
+
+    async def append_chat_session_ops(self, user_id, base_version, ops, updated_at):
+        await self.migrate()
+        return await asyncio.to_thread(self._append_chat_session_ops, user_id, base_version, ops, updated_at)
+
+    async def replace_chat_session(self, user_id, snapshot, updated_at):
+        await self.migrate()
+        return await asyncio.to_thread(self._replace_chat_session, user_id, snapshot, updated_at)
+
+    async def compact_chat_session(self, user_id, version, snapshot):
+        await self.migrate()
+        await asyncio.to_thread(self._compact_chat_session, user_id, version, snapshot)
+
+    async def delete_chat_session(self, user_id):
+        await self.migrate()
+        await asyncio.to_thread(self._delete_chat_session, user_id)
+
+    async def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# ------------------------------------------------------------
+# Postgres (asyncpg)
+# ------------------------------------------------------------
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journals (
+    id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    session_num INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    title TEXT,
+    diary_ja TEXT,
+    diary_zh TEXT,
+    podcast_script TEXT,
+    podcast_audio_path TEXT,
+    scene_1_path TEXT,
+    scene_2_path TEXT,
+    thumbnail_path TEXT,
+    entry_text TEXT,
+    role TEXT,
+    tone TEXT,
+    rounds INTEGER DEFAULT 0,
+    created_at TEXT,
+    chat_turns TEXT,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS idx_journals_user_date ON journals(user_id, date, session_num);
+CREATE INDEX IF NOT EXISTS idx_journals_user_created ON journals(user_id, created_at, id);
+CREATE TABLE IF NOT EXISTS journal_days (
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    entries INTEGER NOT NULL,
+    rounds INTEGER NOT NULL,
+    thumbnail_path TEXT,
+    thumbnail_session INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date)
+);
+CREATE TABLE IF NOT EXISTS chat_session_snapshots (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    snapshot_version INTEGER NOT NULL,
+    snapshot TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_session_ops (
+    user_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    ops TEXT NOT NULL,
+    PRIMARY KEY (user_id, version)
+);
+"""
+
+# primary key columns of journals, in key order
+_POSTGRES_JOURNALS_KEY_SQL = """
+SELECT array_agg(a.attname::text ORDER BY array_position(i.indkey::int2[], a.attnum))
+FROM pg_index i
+JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+WHERE i.indrelid = 'journals'::regclass AND i.indisprimary
+"""
+
+_SENTINEL = object()
+
+
+class PostgresJournalRepository(JournalRepository):
+    """Shared backend for multi-replica deployments. The pool is created on first use."""
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    import asyncpg
+                    pool = await asyncpg.create_pool(
+                        self.dsn, min_size=self.min_size, max_size=self.max_size
+                    )
+                    async with pool.acquire() as conn:
+                        await self._migrate(conn)
+                    self._pool = pool
+                    self.schema_ready = True
+        return self._pool
+
+    @staticmethod
+    async def _migrate(conn):
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK_ID)
+            await conn.execute("CREATE TABLE IF NOT EXISTS lifecho_schema (version INTEGER NOT NULL)")
+            version = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM lifecho_schema")
+            if version < SCHEMA_VERSION:
+                await conn.execute(POSTGRES_SCHEMA)
+                if await conn.fetchval(_POSTGRES_JOURNALS_KEY_SQL) != ["user_id", "id"]:
+                    # up to v4 id alone was the key; ids are only unique per user
+                    await conn.execute(
+                        "ALTER TABLE journals DROP CONSTRAINT IF EXISTS journals_pkey, "
+                        "ALTER COLUMN user_id SET NOT NULL, ADD PRIMARY KEY (user_id, id)"
+                    )
+                await conn.execute(_CREATED_AT_BACKFILL_SQL)
+                await conn.execute("DELETE FROM journal_days")
+                await conn.execute(_DAYS_BACKFILL_SQL)
+                await conn.execute("INSERT INTO lifecho_schema (version) VALUES ($1)", SCHEMA_VERSION)
+                logger.info("journal schema migrated: v%d -> v%d (postgres)", version, SCHEMA_VERSION)
+
+    async def migrate(self):
+        await self._get_pool()
+
+    async def session_counts(self, user_id, date=None):
+        pool = await self._get_pool()
+        sql = "SELECT date, entries FROM journal_days WHERE user_id = $1"
+        args = [user_id]
+        if date is not None:
+            sql += " AND date = $2"
+            args.append(date)
+        rows = await pool.fetch(sql, *args)
+        return {r["date"]: r["entries"] for r in rows}
+
+    async def insert_many(self, batches):
+        import asyncpg
+        pool = await self._get_pool()
+        sql = _insert_sql(lambda i: f"${i}")
+        day_sql = _day_upsert_sql(lambda i: f"${i}")
+        it = iter(batches)
+        total = 0
+        async with pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    while True:
+                        batch = await asyncio.to_thread(next, it, _SENTINEL)
+                        if batch is _SENTINEL:
+                            break
+                        await conn.executemany(sql, [tuple(r.get(c) for c in JOURNAL_COLUMNS) for r in batch])
+                        await conn.executemany(day_sql, [_day_params(r) for r in batch])
+                        total += len(batch)
+            except asyncpg.UniqueViolationError as e:
+                raise JournalConflictError(str(e)) from e
+        return total
+
+    async def list_month(self, user_id, year, month):
+        pool = await self._get_pool()
+        rows = await pool.fetch(
+            f"SELECT {', '.join(JOURNAL_LIST_COLUMNS)} FROM journals "
+            "WHERE date LIKE $1 AND user_id = $2 ORDER BY date, session_num",
+            _month_prefix(year, month), user_id,
+        )
+        return [dict(r) for r in rows]
+
+    async def timeline(self, user_id, limit, before=None):
+        pool = await self._get_pool()
+        sql = f"SELECT {', '.join(JOURNAL_TIMELINE_COLUMNS)} FROM journals WHERE user_id = $1"
+        args = [user_id]
+        if before is not None:
+            sql += " AND (created_at, id) < ($2, $3)"
+            args.extend(before)
+        rows = await pool.fetch(f"{sql} {_TIMELINE_ORDER} ${len(args) + 1}", *args, limit)
+        return [dict(r) for r in rows]
+
+    async def calendar(self, user_id, year):
+        pool = await self._get_pool()
+        rows = await pool.fetch(
+            f"SELECT {', '.join(JOURNAL_DAY_COLUMNS)} FROM journal_days "
+            "WHERE user_id = $1 AND date >= $2 AND date < $3 ORDER BY date",
+            user_id, *_year_range(year),
+        )
+        return [dict(r) for r in rows]
+
+    async def get(self, user_id, journal_id):
+        pool = await self._get_pool()
+        row = await pool.fetchrow(
+            "SELECT * FROM journals WHERE id = $1 AND user_id = $2", journal_id, user_id
+        )
+        return dict(row) if row else None
+
+    async def iter_user(self, user_id, batch_size):
+        pool = await self._get_pool()
+        # Keyset pages, each on a pool slot only for its own query: a slow export
+        # download must not pin a connection or hold a transaction open (vacuum).
+        rows = await pool.fetch(
+            "SELECT * FROM journals WHERE user_id = $1 ORDER BY date, session_num LIMIT $2",
+            user_id, batch_size,
+        )
+        while rows:
+            yield [dict(r) for r in rows]
+            if len(rows) < batch_size:
+                break
+            last = rows[-1]
+            rows = await pool.fetch(
+                "SELECT * FROM journals WHERE user_id = $1 AND (date, session_num) > ($2, $3) "
+                "ORDER BY date, session_num LIMIT $4",
+                user_id, last["date"], last["session_num"], batch_size,
+            )
+
+    async def load_chat_session(self, user_id):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                row = await conn.fetchrow(
+                    "SELECT version, snapshot_version, snapshot, updated_at FROM chat_session_snapshots "
+                    "WHERE user_id = $1", user_id,
+                )
+                if row is None:
+                    return None
+                ops = await conn.fetch(
+                    "SELECT version, ops FROM chat_session_ops WHERE user_id = $1 AND version > $2 ORDER BY version",
+                    user_id, row["snapshot_version"],
+                )
+        return _chat_session(row, ops)
+
+    async def append_chat_session_ops(self, user_id, base_version, ops, updated_at):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if base_version == 0:
+                    status = await conn.execute(
+                        "INSERT INTO chat_session_snapshots (user_id, version, snapshot_version, snapshot, updated_at) "
+                        "VALUES ($1, 1, 0, 'null', $2) ON CONFLICT (user_id) DO NOTHING",
+                        user_id, updated_at,
+                    )
+                else:
+                    status = await conn.execute(
+                        "UPDATE chat_session_snapshots SET version = version + 1, updated_at = $1 "
+                        "WHERE user_id = $2 AND version = $3",
+                        updated_at, user_id, base_version,
+                    )
+                if not status.endswith(" 1"):
+                    return False
+                await conn.execute(
+                    "INSERT INTO chat_session_ops (user_id, version, ops) VALUES ($1, $2, $3)",
+                    user_id, base_version + 1, ops,
+                )
+        return True
+
+    async def replace_chat_session(self, user_id, snapshot, updated_at):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                version = await conn.fetchval(
+                    "INSERT INTO chat_session_snapshots (user_id, version, snapshot_version, snapshot, updated_at) "
+                    "VALUES ($1, 1, 1, $2, $3) ON CONFLICT (user_id) DO UPDATE SET "
+                    "version = chat_session_snapshots.version + 1, "
+                    "snapshot_version = chat_session_snapshots.version + 1, "
+                    "snapshot = EXCLUDED.snapshot, updated_at = EXCLUDED.updated_at "
+                    "RETURNING version",
+                    user_id, snapshot, updated_at,
+                )
+                await conn.execute(
+                    "DELETE FROM chat_session_ops WHERE user_id = $1 AND version <= $2", user_id, version
+                )
+        return version
+
+    async def compact_chat_session(self, user_id, version, snapshot):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.execute(
+                    "UPDATE chat_session_snapshots SET snapshot = $1, snapshot_version = $2 "
+                    "WHERE user_id = $3 AND snapshot_version < $2 AND version >= $2",
+                    snapshot, version, user_id,
+                )
+                if status.endswith(" 1"):
+                    await conn.execute(
+                        "DELETE FROM chat_session_ops WHERE user_id = $1 AND version <= $2", user_id, version
+                    )
+
+    async def delete_chat_session(self, user_id):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM chat_session_snapshots WHERE user_id = $1", user_id)
+                await conn.execute("DELETE FROM chat_session_ops WHERE user_id = $1", user_id)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+def create_journal_repository(
+    database_url: Optional[str], sqlite_path: Path, pool_size: int = 4
+) -> JournalRepository:
+    if database_url and database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresJournalRepository(database_url, max_size=pool_size)
+    return SqliteJournalRepository(sqlite_path, pool_size=pool_size)
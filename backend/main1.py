@@ -1,74 +1,137 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import json
 import base64
-import sqlite3
+import hashlib
+import asyncio
+import shutil
+import tempfile
+import zipfile
+import logging
 import httpx
-import google.generativeai as genai # google官方的sdk
 import jwt
 from jwt.exceptions import InvalidTokenError
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import Literal, Optional
 from dotenv import load_dotenv
-from google.cloud import texttospeech
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import date as calendar_date, datetime
 from pathlib import Path
 from io import BytesIO
+from journal_store import (
+    JOURNAL_COLUMNS,
+    JournalConflictError,
+    JournalRepository,
+    create_journal_repository,
+)
+from startup import LazyModule, LazyResource
+from app_logging import RequestContextMiddleware, configure_logging, redact
+from http_encoding import CompressionMiddleware, FastJSONResponse, dumps
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from metrics import FALLBACKS, REGISTRY, ROLE_DETECTIONS, STAGE_SECONDS, MetricsMiddleware, timed
+from providers import (
+    GeminiImageProvider,
+    GeminiTextProvider,
+    GoogleSpeechProvider,
+    ImageGenerationError,
+    Providers,
+    SpeechUnavailableError,
+    fake_providers,
+)
+from resilience import SingleFlight, with_resilience
+from ratelimit import (
+    FairScheduler,
+    LocalBucketStore,
+    QueueTimeout,
+    RateLimiter,
+    RedisBucketStore,
+    SqliteBucketStore,
+    parse_costs,
+)
+from model_cache import ModelOutputCache
+from audio_preprocess import AudioPreprocessor, find_ffmpeg
+from image_optimize import ImageOptimizer
+from audio_ingest import AudioIngestor
+from speech_pipeline import ReplyExtractor, SpeechPipeline, split_sentences
+from speech_service import SpeechCache, SpeechService
+from shared_state import create_shared_store
+from speculative import Speculator, conversation_key
+from history_compaction import HistoryCompactor
+from journal_index import JournalIndex, journal_text
+from session_sync import PatchError, SessionConflict, SessionSync, sniff_mime
+from podcast_audio import PodcastAssembler
+from role_detector import detector as role_detector
 
 # 加载环境变量
 load_dotenv()
-app = FastAPI()
+configure_logging()
+logger = logging.getLogger("lifecho.api")
+
+
+# --- 启动 / 预热 ---
+# import 本身不做任何重活：SDK、TTS 客户端、数据库迁移都在 lifespan 里后台预热，
+# 冷启动时端口立刻可用，/readyz 在预热完成前返回 503。
+_warmup_state: dict = {"state": "pending", "seconds": None, "error": None}
+
 
-# --- Uploads directory & SQLite setup ---
+async def _warm_up():
+    _warmup_state["state"] = "running"
+    t0 = time.perf_counter()
+    try:
+        await journal_repo.migrate()
+        if not FAKE_PROVIDERS:
+            await asyncio.to_thread(genai.load)
+            await asyncio.to_thread(texttospeech.load)
+            await tts_client.aget_or_none()
+        _warmup_state["state"] = "done"
+    except Exception as e:
+        _warmup_state["state"] = "failed"
+        _warmup_state["error"] = f"{type(e).__name__}: {e}"
+        logger.error("预热失败: %s", _warmup_state["error"])
+    _warmup_state["seconds"] = round(time.perf_counter() - t0, 3)
+    if tts_client.error:
+        logger.error("Google TTS 客户端初始化失败: %s", tts_client.error)
+    logger.info("预热完成: %s", _warmup_state)
+    # 固定文案的语音提前合成进缓存（不影响 /readyz）
+    await speech_service.prewarm(SPEECH_PREWARM)
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    warmup_task = asyncio.create_task(_warm_up())
+    yield
+    warmup_task.cancel()
+    await journal_repo.close()
+    model_cache.close()
+    audio_ingestor.close()
+    await podcast_assembler.close()
+    speculator.close()
+    history_compactor.close()
+    shared_state.close()
+
+
+# dict 返回值统一用 orjson 序列化（未安装时退回标准库）
+app = FastAPI(lifespan=_lifespan, default_response_class=FastJSONResponse)
+
+# --- Uploads directory & journal storage ---
 UPLOADS_DIR = Path(__file__).parent / "uploads"
 UPLOADS_DIR.mkdir(exist_ok=True)
 
-DB_PATH = Path(__file__).parent / "journals.db"
-
-def get_db():
-    conn = sqlite3.connect(str(DB_PATH))
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db()
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS journals (
-            id TEXT PRIMARY KEY,
-            date TEXT NOT NULL,
-            session_num INTEGER NOT NULL,
-            title TEXT,
-            diary_ja TEXT,
-            diary_zh TEXT,
-            podcast_script TEXT,
-            podcast_audio_path TEXT,
-            scene_1_path TEXT,
-            scene_2_path TEXT,
-            thumbnail_path TEXT,
-            entry_text TEXT,
-            role TEXT,
-            tone TEXT,
-            rounds INTEGER DEFAULT 0,
-            created_at TEXT,
-            chat_turns TEXT
-        )
-    """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_journals_date ON journals(date)")
-    try:
-        conn.execute("ALTER TABLE journals ADD COLUMN chat_turns TEXT")
-    except Exception:
-        pass
-    try:
-        conn.execute("ALTER TABLE journals ADD COLUMN user_id TEXT")
-    except Exception:
-        pass
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_journals_user ON journals(user_id)")
-    conn.commit()
-    conn.close()
+DB_PATH = Path(os.getenv("JOURNAL_SQLITE_PATH", str(Path(__file__).parent / "journals.db")))
 
-init_db()
+# JOURNAL_DATABASE_URL=postgres://... shares journals across replicas; default is the local SQLite file
+journal_repo: JournalRepository = create_journal_repository(
+    os.getenv("JOURNAL_DATABASE_URL"),
+    DB_PATH,
+    pool_size=int(os.getenv("JOURNAL_DB_POOL_SIZE", "4")),
+)
 
 app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 
@@ -77,6 +140,36 @@ app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 async def root():
     return {"status": "ok", "message": "LifeEcho Backend is running"}
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving. Never touches upstreams."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: warm-up finished and every required dependency initialized."""
+    components = {
+        "journal_db": {"state": "ready" if journal_repo.schema_ready else "cold", "required": True},
+        "gemini_sdk": {**genai.status(), "required": not FAKE_PROVIDERS},
+        "tts_sdk": {**texttospeech.status(), "required": False},
+        "google_tts": tts_client.status(),
+    }
+    ready = _warmup_state["state"] == "done" and all(
+        c["state"] == "ready" for c in components.values() if c["required"]
+    )
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "warmup": _warmup_state,
+        "import_seconds": IMPORT_SECONDS,
+        "components": components,
+    }
+    return FastJSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of request, stage, retry and fallback metrics."""
+    return PlainTextResponse(REGISTRY.expose(), media_type=METRICS_CONTENT_TYPE)
+
 # 跨域配置：允许前端 3000 端口访问
 app.add_middleware(
     CORSMiddleware,
@@ -87,47 +180,96 @@ app.add_middleware(
     ],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "Retry-After", "X-Cache"],
 )
+# 只压缩完整的文本/JSON 响应；音频、图片、流式响应和以 base64 媒体为主的 JSON 原样返回
+if os.getenv("COMPRESSION_ENABLED", "1") == "1":
+    app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_BYTES", "1024")))
+app.add_middleware(RequestContextMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 # --- 核心配置区 (请在 .env 文件中填写) ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL_ID = os.getenv("GEMINI_MODEL_ID", "gemini-flash-latest")  # 默认使用 gemini-flash-latest
-genai.configure(api_key=GEMINI_API_KEY)
+# google官方的sdk；首次访问 genai.xxx 时才 import 并 configure
+genai = LazyModule("google.generativeai", on_load=lambda m: m.configure(api_key=GEMINI_API_KEY))
 
 # --- Supabase JWT（日记 API 鉴权）---
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("NEXT_PUBLIC_SUPABASE_URL", "")
 
-_jwks_cache: dict = {}
+# --- 多 worker 共享状态（JWKS、头像、限流桶）---
+# gunicorn 多 worker（WEB_CONCURRENCY>1）时模块全局变量各进程一份；需要共享的小状态放这里：
+# SHARED_STATE_URL=redis://... 跨机器共享，否则是同机所有 worker 共用的 SQLite 文件
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "")
+SHARED_STATE_PATH = Path(os.getenv("SHARED_STATE_PATH", str(Path(__file__).parent / "shared_state.db")))
+shared_state = create_shared_store(SHARED_STATE_URL, SHARED_STATE_PATH)
+
+# JWKS：进程内副本短期有效，共享存储里的一份按 JWKS_CACHE_SECONDS 过期（密钥轮换后会重新拉取）
+JWKS_CACHE_SECONDS = float(os.getenv("JWKS_CACHE_SECONDS", "3600"))
+_JWKS_LOCAL_SECONDS = 60.0
+_JWKS_MIN_REFRESH_SECONDS = 30.0  # 未知 kid 触发的强制刷新最多这么频繁
+_jwks_cache: dict = {"jwks": {}, "expires_at": 0.0, "fetched_at": 0.0}
+
+def _fetch_jwks(refresh: bool = False) -> dict:
+    """Fetch and cache JWKS from Supabase for ES256 token verification (process copy -> shared store -> HTTP).
 
-def _fetch_jwks() -> dict:
-    """Fetch and cache JWKS from Supabase for ES256 token verification."""
-    if _jwks_cache.get("keys"):
-        return _jwks_cache
+    Blocking (shared store + HTTP): call it through _jwks(), never on the event loop.
+    """
+    now = time.time()
+    if not refresh:
+        if _jwks_cache["jwks"].get("keys") and _jwks_cache["expires_at"] > now:
+            return _jwks_cache["jwks"]
+        shared = shared_state.get("jwks")
+        if shared:
+            _jwks_cache.update(jwks=json.loads(shared), expires_at=now + _JWKS_LOCAL_SECONDS)
+            return _jwks_cache["jwks"]
+    elif now - _jwks_cache["fetched_at"] < _JWKS_MIN_REFRESH_SECONDS:
+        return _jwks_cache["jwks"]
     try:
         import httpx
         anon_key = os.getenv("SUPABASE_ANON_KEY") or os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY", "")
         url = f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json"
         headers = {"apikey": anon_key} if anon_key else {}
+        _jwks_cache["fetched_at"] = now
         resp = httpx.get(url, headers=headers, timeout=10)
         if resp.status_code == 200:
             data = resp.json()
-            _jwks_cache.update(data)
+            shared_state.set("jwks", json.dumps(data).encode("utf-8"), ttl=JWKS_CACHE_SECONDS)
+            _jwks_cache.update(jwks=data, expires_at=now + _JWKS_LOCAL_SECONDS)
             return data
     except Exception as e:
-        print(f"⚠️ Failed to fetch JWKS: {e}")
-    return {}
+        logger.warning("Failed to fetch JWKS: %s", e)
+    return _jwks_cache["jwks"]  # 刷新失败时继续用旧的密钥
+
+
+_jwks_lock = asyncio.Lock()
 
 
-def _decode_supabase_jwt(token: str) -> dict:
+async def _jwks(refresh: bool = False) -> dict:
+    """进程内副本有效时直接返回；否则在线程里拉取，同一时刻只有一个请求去拉。"""
+    if not refresh and _jwks_cache["jwks"].get("keys") and _jwks_cache["expires_at"] > time.time():
+        return _jwks_cache["jwks"]
+    async with _jwks_lock:
+        if not refresh and _jwks_cache["jwks"].get("keys") and _jwks_cache["expires_at"] > time.time():
+            return _jwks_cache["jwks"]  # 等锁期间别的请求已经拉好了
+        return await asyncio.to_thread(_fetch_jwks, refresh)
+
+
+async def _decode_supabase_jwt(token: str) -> dict:
     header = jwt.get_unverified_header(token)
     alg = header.get("alg", "HS256")
 
     try:
         if alg == "ES256":
-            jwks = _fetch_jwks()
+            jwks = await _jwks()
             kid = header.get("kid")
             key_data = next((k for k in jwks.get("keys", []) if k.get("kid") == kid), None)
+            if not key_data:
+                # 可能是刚轮换的新密钥
+                jwks = await _jwks(refresh=True)
+                key_data = next((k for k in jwks.get("keys", []) if k.get("kid") == kid), None)
             if not key_data:
                 raise HTTPException(status_code=401, detail="No matching JWKS key found")
             from jwt.algorithms import ECAlgorithm
@@ -145,17 +287,145 @@ async def get_current_user_id(
     authorization: Optional[str] = Header(None),
 ) -> str:
     if not authorization or not authorization.startswith("Bearer "):
-        print(f"⚠️ JWT auth failed: header={'(missing)' if not authorization else authorization[:30]}...")
+        logger.warning("JWT auth failed: Authorization header %s", "missing" if not authorization else "malformed")
         raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
     token = authorization[7:].strip()
-    print(f"🔑 JWT token received, length={len(token)}, first30={token[:30]}...")
-    payload = _decode_supabase_jwt(token)
+    logger.debug("JWT token received, length=%d", len(token))
+    payload = await _decode_supabase_jwt(token)
     sub = payload.get("sub")
     if not sub:
         raise HTTPException(status_code=401, detail="Token missing sub")
     return str(sub)
 
 
+# --- 限流 / 公平排队（模型类接口）---
+# 按用户（有合法 JWT 时）或 IP 计桶。前面有 N 层反向代理时设 TRUSTED_PROXY_COUNT=N（TRUST_PROXY_HEADERS=1 即 N=1）：
+# 每层代理把它看到的对端地址追加到 X-Forwarded-For 末尾，所以取从右数第 N 个；更靠左的是客户端自己填的，不可信
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT") or (1 if os.getenv("TRUST_PROXY_HEADERS", "") == "1" else 0))
+
+
+async def _rate_limit_identity(request: Request) -> str:
+    """限流 / 预计算归属用的调用方 key；每个请求只解一次 JWT，结果放在 request.state 上复用。"""
+    identity = getattr(request.state, "rate_limit_identity", None)
+    if identity is None:
+        identity = await _resolve_identity(request)
+        request.state.rate_limit_identity = identity
+    return identity
+
+
+async def _resolve_identity(request: Request) -> str:
+    authorization = request.headers.get("authorization", "")
+    if authorization.startswith("Bearer "):
+        try:
+            sub = (await _decode_supabase_jwt(authorization[7:].strip())).get("sub")
+            if sub:
+                return f"user:{sub}"
+        except Exception:
+            pass  # 无效 token 按匿名 IP 计
+    if TRUSTED_PROXY_COUNT:
+        hops = [h.strip() for h in ",".join(request.headers.getlist("x-forwarded-for")).split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_COUNT:
+            return "ip:" + hops[-TRUSTED_PROXY_COUNT]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+# 单进程用内存桶；多 worker 时桶放在共享的 SQLite 文件里（否则每个 worker 各算一份，限额变成 N 倍）
+_rate_limit_redis = os.getenv("RATE_LIMIT_REDIS_URL") or (SHARED_STATE_URL if SHARED_STATE_URL.startswith("redis") else "")
+if _rate_limit_redis:
+    _rate_limit_store = RedisBucketStore(_rate_limit_redis)
+elif WEB_CONCURRENCY > 1:
+    _rate_limit_store = SqliteBucketStore(SHARED_STATE_PATH)
+else:
+    _rate_limit_store = LocalBucketStore()
+rate_limiter = RateLimiter(
+    _rate_limit_identity,
+    store=_rate_limit_store,
+    costs=parse_costs(os.getenv("RATE_LIMIT_COSTS", "")),
+    capacity=float(os.getenv("RATE_LIMIT_CAPACITY", "60")),
+    refill_per_second=float(os.getenv("RATE_LIMIT_REFILL_PER_SEC", "1")),
+    # UPSTREAM_CONCURRENCY 是整台机器的上限，平分给各个 worker
+    scheduler=FairScheduler(
+        max(1, int(os.getenv("UPSTREAM_CONCURRENCY", "16")) // WEB_CONCURRENCY),
+        max_wait=float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30")),
+    ),
+    enabled=os.getenv("RATE_LIMIT_ENABLED", "1") == "1",
+)
+
+
+# --- 模型输出缓存（detect_roles / transcribe / summarize / refine_summary）---
+# 修改对应路由的 prompt 模板时，请同时递增这里的版本号
+MODEL_CACHE_VERSIONS = {"detect_roles": "1", "transcribe": "2", "summarize": "1", "refine_summary": "1",
+                        "history_summary": "1"}
+model_cache = ModelOutputCache(
+    Path(os.getenv("MODEL_CACHE_PATH", str(Path(__file__).parent / "model_cache.db"))),
+    max_bytes=int(float(os.getenv("MODEL_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    ttl_seconds=float(os.getenv("MODEL_CACHE_TTL_HOURS", "168")) * 3600,
+    enabled=os.getenv("MODEL_CACHE_ENABLED", "1") == "1",
+)
+
+# --- 长对话历史压缩：最近 HISTORY_KEEP_TURNS 轮原样保留，更早的折叠进滚动摘要（按会话缓存） ---
+#     各接口的历史 token 预算，HISTORY_BUDGET_CHAT=... 等环境变量覆盖；预算内的历史原样发送
+HISTORY_BUDGETS = {
+    route: int(os.getenv(f"HISTORY_BUDGET_{route.upper()}", str(default)))
+    for route, default in {"chat": 1200, "summarize": 4000, "refine_summary": 4000,
+                           "scene_prompts": 3000, "podcast_script": 6000}.items()
+}
+HISTORY_SUMMARY_CHARS = int(os.getenv("HISTORY_SUMMARY_CHARS", "400"))
+
+
+async def _fold_history(previous: Optional[str], messages: list[tuple[str, str]]) -> str:
+    """把较早的对话（连同上一次的摘要）压缩成一段摘要，给 history_compactor 用"""
+    system_prompt = f"""
+    你负责压缩一段日语学习对话的早期部分，供后续对话和日记生成参考。
+    要求：
+    1. 保留具体的事实：人物、事件、时间、地点、物品、情绪。
+    2. 保留用户用过或学到的日语表达（原文照抄）。
+    3. 不评价、不续写，{HISTORY_SUMMARY_CHARS}字以内，只输出摘要正文。
+    """
+    text = "\n".join(f"{role}: {content}" for role, content in messages)
+    user_prompt = f"[已有摘要]:\n{previous}\n\n[新增对话]:\n{text}" if previous else f"[对话]:\n{text}"
+    with timed("history.summarize"):
+        summary, _ = await model_cache.cached(
+            "history_summary", MODEL_CACHE_VERSIONS["history_summary"], GEMINI_MODEL_ID,
+            [system_prompt, user_prompt],
+            lambda: providers.text.generate([user_prompt], system_instruction=system_prompt),
+        )
+    return summary.strip()
+
+
+history_compactor = HistoryCompactor(
+    _fold_history,
+    keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "4")),
+    fold_turns=int(os.getenv("HISTORY_FOLD_TURNS", "4")),
+    enabled=os.getenv("HISTORY_COMPACTION", "1") == "1",
+)
+
+
+async def _history_lines(history: list, route: str, session: str = "", line=None) -> list[str]:
+    """预算内的历史文本行（默认 "role: content"）；超出预算时第一行是更早对话的摘要"""
+    compacted = await history_compactor.compact([(m.role, m.content) for m in history], HISTORY_BUDGETS[route],
+                                                session)
+    return compacted.lines(line or (lambda role, content: f"{role}: {content}"))
+
+# --- 对话结束（FINISHED）时在后台提前生成总结和场景提示词 ---
+# SPECULATIVE_FINALIZE 列出要提前做的工作（summarize / scene_prompts），留空则关闭
+speculator = Speculator(
+    ttl=float(os.getenv("SPECULATIVE_TTL_SECONDS", "600")),
+    kinds=[k.strip() for k in os.getenv("SPECULATIVE_FINALIZE", "summarize,scene_prompts").split(",") if k.strip()],
+)
+
+
+# --- 人物识别：本地词典优先，低置信度时再调用 Gemini ---
+# local_first（默认）| local（从不调用模型）| model（总是调用模型）
+ROLE_DETECT_MODE = os.getenv("ROLE_DETECT_MODE", "local_first")
+
+
+def cache_bypass(cache_control: Optional[str] = Header(None)) -> bool:
+    """`Cache-Control: no-cache` (or no-store) forces a fresh model call."""
+    value = (cache_control or "").lower()
+    return "no-cache" in value or "no-store" in value
+
+
 # --- 数据模型 ---
 class Message(BaseModel):
     role: str
@@ -170,6 +440,7 @@ class ChatRequest(BaseModel):
     previous_communication_raw: list[dict] = []  # 之前的完整 communication_raw（可选），用于保留所有字段
     audio_base64: str = ""  # 用户语音输入（base64编码，可选）
     audio_mime_type: str = "audio/webm"  # 音频MIME类型
+    audio_id: str = ""  # /api/transcribe 返回的录音 id（可选），有效时无需再传 audio_base64
 
 class RefineRequest(ChatRequest):
     correction_summary: str  # 用户输入的修正内容
@@ -216,30 +487,141 @@ def clean_json_content(content: str):
 
 # --- TTS 客户端初始化, 文字转语音 ---
 # 确保 Google Cloud 凭证路径正确设置
+texttospeech = LazyModule("google.cloud.texttospeech")
 google_creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
-tts_client = None
 
-try:
+
+def _build_tts_client():
+    """凭证解析 + gRPC channel 建立较慢，由预热任务或首次合成时调用"""
     if google_creds_json:
         from google.oauth2 import service_account
         creds_dict = json.loads(google_creds_json)
         credentials = service_account.Credentials.from_service_account_info(creds_dict)
-        tts_client = texttospeech.TextToSpeechClient(credentials=credentials)
-        print("✅ Google TTS 客户端初始化成功 (从环境变量)")
-    else:
-        tts_credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-        if tts_credentials_path and not os.path.isabs(tts_credentials_path):
-            backend_dir = os.path.dirname(os.path.abspath(__file__))
-            tts_credentials_path = os.path.join(backend_dir, tts_credentials_path)
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = tts_credentials_path
-
-        tts_client = texttospeech.TextToSpeechClient()
-        print("✅ Google TTS 客户端初始化成功 (从文件)")
-except Exception as e:
-    print(f"❌ Google TTS 客户端初始化失败: {e}")
-    tts_client = None
-
-# --- TTS 辅助函数：语音合成 ---
+        client = texttospeech.TextToSpeechClient(credentials=credentials)
+        logger.info("Google TTS 客户端初始化成功 (从环境变量)")
+        return client
+
+    tts_credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    if tts_credentials_path and not os.path.isabs(tts_credentials_path):
+        backend_dir = os.path.dirname(os.path.abspath(__file__))
+        tts_credentials_path = os.path.join(backend_dir, tts_credentials_path)
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = tts_credentials_path
+
+    client = texttospeech.TextToSpeechClient()
+    logger.info("Google TTS 客户端初始化成功 (从文件)")
+    return client
+
+
+# 失败状态会记录下来并在 /readyz 中展示，60 秒内不重复尝试
+tts_client = LazyResource("google_tts", _build_tts_client, required=False)
+
+
+# --- 上游模型 provider ---
+# LIFECHO_PROVIDERS=fake 换成本地确定性假实现（压测 / 离线开发用），延迟和失败率可配：
+#   FAKE_TEXT_LATENCY_MS / FAKE_IMAGE_LATENCY_MS / FAKE_TTS_LATENCY_MS / FAKE_FAILURE_RATE / FAKE_SLOW_RATE / FAKE_SEED
+# 所有 provider 外面套一层重试 + 熔断（resilience.py）；chat 轮次在超过近期 p95 时发对冲请求（CHAT_HEDGE=0 关闭）
+FAKE_PROVIDERS = os.getenv("LIFECHO_PROVIDERS", "google") == "fake"
+
+
+CHAT_HEDGE = os.getenv("CHAT_HEDGE", "1") == "1"
+# chat 轮次流式读取 Gemini 输出，reply 每凑满一句（。！？）就开始合成语音（CHAT_STREAM_TTS=0 退回整段合成）
+CHAT_STREAM_TTS = os.getenv("CHAT_STREAM_TTS", "1") == "1"
+
+
+def _build_base_providers() -> Providers:
+    if FAKE_PROVIDERS:
+        logger.warning("使用本地假 provider（LIFECHO_PROVIDERS=fake），不会调用 Gemini / Google TTS")
+        return fake_providers(
+            text_latency=float(os.getenv("FAKE_TEXT_LATENCY_MS", "800")) / 1000,
+            image_latency=float(os.getenv("FAKE_IMAGE_LATENCY_MS", "4000")) / 1000,
+            tts_latency=float(os.getenv("FAKE_TTS_LATENCY_MS", "300")) / 1000,
+            failure_rate=float(os.getenv("FAKE_FAILURE_RATE", "0")),
+            slow_rate=float(os.getenv("FAKE_SLOW_RATE", "0")),
+            seed=int(os.getenv("FAKE_SEED", "0")),
+        )
+    return Providers(
+        text=GeminiTextProvider(genai, GEMINI_MODEL_ID),
+        image=GeminiImageProvider(genai, "nano-banana-pro-preview"),
+        speech=GoogleSpeechProvider(tts_client, texttospeech),
+    )
+
+
+# 测试 / 压测可以直接替换 main1.providers
+providers: Providers = with_resilience(
+    _build_base_providers(),
+    attempts=int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3")),
+    failure_threshold=int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5")),
+    reset_timeout=float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", "30")),
+    # 流式回复里两段之间最多等这么久，卡住就按上游失败处理（0 关闭）
+    stream_idle_timeout=float(os.getenv("UPSTREAM_STREAM_IDLE_SECONDS", "20")) or None,
+)
+
+# --- 录音预处理：去首尾静音 + 单声道 16kHz Opus，再交给 Gemini（需要 ffmpeg，AUDIO_PREPROCESS=0 关闭）---
+audio_preprocessor = AudioPreprocessor(
+    find_ffmpeg(),
+    max_workers=int(os.getenv("AUDIO_PREPROCESS_WORKERS", "0")) or None,
+    enabled=os.getenv("AUDIO_PREPROCESS", "1") == "1",
+)
+
+# --- 生成图片压缩：缩到显示尺寸、转 WebP（IMAGE_FORMAT=avif 可选）、去掉元数据；IMAGE_OPTIMIZE=0 关闭 ---
+image_optimizer = ImageOptimizer(
+    output_format=os.getenv("IMAGE_FORMAT", "webp"),
+    webp_quality=int(os.getenv("IMAGE_WEBP_QUALITY", "80")),
+    avif_quality=int(os.getenv("IMAGE_AVIF_QUALITY", "60")),
+    max_workers=int(os.getenv("IMAGE_OPTIMIZE_WORKERS", "0")) or None,
+    enabled=os.getenv("IMAGE_OPTIMIZE", "1") == "1",
+)
+SCENE_IMAGE_MAX_PX = int(os.getenv("SCENE_IMAGE_MAX_PX", "1024"))    # 场景图最长边
+AVATAR_IMAGE_MAX_PX = int(os.getenv("AVATAR_IMAGE_MAX_PX", "256"))   # 头像最长边
+
+# --- 录音接入：小录音内联，大录音落临时文件后走 Gemini 文件 API；按内容哈希缓存，
+#     /api/transcribe 返回 audio_id，确认后 /api/chat 直接复用，不再重复上传 ---
+audio_ingestor = AudioIngestor(
+    audio_preprocessor,
+    lambda: providers.text,
+    inline_max_bytes=int(float(os.getenv("AUDIO_INLINE_MAX_MB", "4")) * 1024 * 1024),
+    ttl_seconds=float(os.getenv("AUDIO_HANDLE_TTL_MINUTES", "60")) * 60,
+)
+
+# --- TTS：/api/tts、chat 回复、播客都经过 speech_service，同样的 (音色, 文本) 只合成一次 ---
+#     内存 LRU + 磁盘内容寻址缓存（SPEECH_CACHE_DIR，多个 worker 可共用），SPEECH_CACHE_ENABLED=0 关闭
+VOICE_NAMES = {"model": "ja-JP-Neural2-B", "user": "ja-JP-Neural2-C"}
+# 最后一轮强制使用的结束语
+ENDING_MESSAGE_JA = "ありがとうございます。今日は私と話してくれて、一緒に今日の日記を書きましょう。"
+ENDING_MESSAGE_ZH = "谢谢你和我说这些，让我们来一起写作今天的日记吧。"
+
+speech_service = SpeechService(lambda: providers.speech, SpeechCache(
+    Path(os.getenv("SPEECH_CACHE_DIR", str(Path(__file__).parent / "tts_cache"))),
+    max_bytes=int(float(os.getenv("SPEECH_CACHE_MAX_MB", "256")) * 1024 * 1024),
+    memory_max_bytes=int(float(os.getenv("SPEECH_CACHE_MEMORY_MB", "16")) * 1024 * 1024),
+    enabled=os.getenv("SPEECH_CACHE_ENABLED", "1") == "1",
+))
+# 整句（非流式路径）和逐句（流式路径）两种切法都预热
+SPEECH_PREWARM = [
+    (text, VOICE_NAMES["model"])
+    for text in [ENDING_MESSAGE_JA, *split_sentences(ENDING_MESSAGE_JA, final=True)[0]]
+]
+
+
+async def _synthesize_sentence(text: str) -> bytes:
+    with timed("tts.synthesize"):
+        return await speech_service.synthesize(text, VOICE_NAMES["model"])
+
+
+async def _synthesize_podcast_line(text: str, voice_name: str) -> bytes:
+    with timed("podcast.tts_line"):
+        return await speech_service.synthesize(text, voice_name)
+
+
+# --- 播客音频：按 MP3 帧拼接，说话人之间插入静音帧；边合成边写盘，/api/podcast_audio/<id>.mp3 边写边播 ---
+podcast_assembler = PodcastAssembler(
+    Path(os.getenv("PODCAST_AUDIO_DIR", str(Path(__file__).parent / "podcasts"))),
+    _synthesize_podcast_line,
+    speaker_gap=float(os.getenv("PODCAST_SPEAKER_GAP_MS", "450")) / 1000,
+    line_gap=float(os.getenv("PODCAST_LINE_GAP_MS", "150")) / 1000,
+)
+
+
 async def synthesize_speech(text: str, speaker: str = "model"):
     """
     语音合成辅助函数
@@ -247,52 +629,93 @@ async def synthesize_speech(text: str, speaker: str = "model"):
     :param speaker: 说话人类型，"model" 为导师，"user" 为用户
     :return: 包含 audio_base64 的字典，失败时返回包含 error 的字典
     """
-    if tts_client is None:
-        error_msg = "TTS 客户端未初始化，请检查 Google Cloud 凭证配置"
-        print(f"❌ {error_msg}")
-        return {"error": error_msg}
-    
     try:
         # 1. 根据 speaker 参数选择音色
         # 如果是 model (导师)，用音色 B；如果是 user (用户)，用音色 C
-        voice_name = "ja-JP-Neural2-B" if speaker == "model" else "ja-JP-Neural2-C"
-        print(f"🔊 开始合成语音: 文本长度={len(text)}, 音色={voice_name}")
-        
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="ja-JP",
-            name=voice_name
-        )
+        voice_name = VOICE_NAMES["model"] if speaker == "model" else VOICE_NAMES["user"]
+        logger.debug("开始合成语音: 文本长度=%d, 音色=%s", len(text), voice_name)
 
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            pitch=0.0,       # 音高调整，0.0 为正常
-            speaking_rate=1.0 # 语速调整
-        )
-
-        response = tts_client.synthesize_speech(
-            input=synthesis_input, 
-            voice=voice, 
-            audio_config=audio_config
-        )
+        with timed("tts.synthesize"):
+            audio_content = await speech_service.synthesize(text, voice_name)
 
-        audio_base64 = base64.b64encode(response.audio_content).decode("utf-8")
-        print(f"✅ TTS 合成成功: 音频大小={len(audio_base64)} 字符")
+        audio_base64 = base64.b64encode(audio_content).decode("utf-8")
+        logger.debug("TTS 合成成功: 音频大小=%d 字符", len(audio_base64))
         return {"audio_base64": audio_base64, "speaker": speaker}
 
+    except SpeechUnavailableError as e:
+        logger.error("%s", e)
+        return {"error": str(e)}
     except Exception as e:
         error_msg = f"TTS 合成失败: {str(e)}"
-        print(f"❌ {error_msg}")
-        import traceback
-        traceback.print_exc()  # 打印完整错误堆栈
+        logger.exception(error_msg)  # 记录完整错误堆栈
         return {"error": error_msg}
 
 # ===========================
 # 1. 实时对话接口 (含 5W1R 引导)
 # ===========================
-@app.post("/api/chat")
-async def chat(request: ChatRequest):
+@app.post("/api/chat", dependencies=[Depends(rate_limiter.limit("chat"))])
+async def chat(request: ChatRequest, http_request: Request):
+    """
+    普通请求返回一个 JSON。
+    Accept: application/x-ndjson 时改为逐行推送：回复语音按句合成好一段推一段
+    {"type": "audio", "index", "text", "audio_base64"}，最后一行是完整结果 {"type": "result", ...}，
+    前端可以在 Gemini 还没写完时就开始播放第一句。
+    """
+    owner = await _rate_limit_identity(http_request)
+    if "application/x-ndjson" not in http_request.headers.get("accept", ""):
+        return await _chat_turn(request, owner=owner)
+
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def on_audio(index: int, text: str, audio: bytes):
+        events.put_nowait({"type": "audio", "index": index, "text": text,
+                           "audio_base64": base64.b64encode(audio).decode("utf-8")})
+
+    async def run_turn():
+        try:
+            result = await _chat_turn(request, on_audio=on_audio, owner=owner)
+            if isinstance(result, Response):
+                result = json.loads(result.body)
+            events.put_nowait({"type": "result", **result})
+        finally:
+            events.put_nowait(None)
+
+    turn = asyncio.ensure_future(run_turn())
+
+    async def lines():
+        try:
+            while (event := await events.get()) is not None:
+                yield dumps(event) + b"\n"
+        finally:
+            turn.cancel()  # client went away
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _conversation_key(request: ChatRequest) -> str:
+    return conversation_key(request.tone, request.mentorRole, history=[(m.role, m.content) for m in request.history])
+
+
+def _speculate_finalization(owner: str, request: ChatRequest, reply: str):
+    """前端收到 FINISHED 后会用「本轮 history + 这条结束语」请求总结和配图，这里提前开始算"""
+    final = request.model_copy(update={
+        "history": [*request.history, Message(role="model", content=reply)],
+        "audio_base64": "",
+        "previous_communication_raw": [],
+    })
+    key = _conversation_key(final)
+
+    async def summary():
+        return (await _summarize(final))[0]
+
+    async def scene_prompts():
+        return await _image_scene_prompts(final.history, final.context) or None
+
+    speculator.start(owner, "summarize", key, summary)
+    speculator.start(owner, "scene_prompts", key, scene_prompts)
+
+
+async def _chat_turn(request: ChatRequest, on_audio=None, owner: Optional[str] = None):
     # 根据 tone 值设置语气描述
     tone_descriptions = {
         "Gentle": "温柔、友善、鼓励性的语气，使用温和的日语表达（タメ口 OK），多用「〜だね」「〜よ」「〜でしょ」等亲密的结尾，像好朋友一样随意自然",
@@ -305,6 +728,8 @@ async def chat(request: ChatRequest):
     current_round = len([m for m in request.history if m.role == "user"])
     is_last_round = current_round >= request.turn
     is_first_round = len(request.history) == 0  # 第一轮：history为空，基于context生成AI提问
+    if is_first_round and owner:
+        speculator.discard(owner)  # 新的对话开始，上一次提前算的结果作废
     
     # 动态构建系统指令
     if is_first_round:
@@ -432,11 +857,6 @@ async def chat(request: ChatRequest):
     """
     
     try:
-        model = genai.GenerativeModel(
-            model_name=GEMINI_MODEL_ID,  # 使用环境变量配置的模型ID
-            system_instruction=system_instruction
-        )
-
         # --- 2. 处理历史记录 (只取文本), 相当于加记忆,过去背景；处理格式，转成 role, content---
         gemini_history = []
         
@@ -445,34 +865,44 @@ async def chat(request: ChatRequest):
             # 构建一个提示，让AI基于context生成第一个问题
             prompt_for_first_round = f"用户分享了以下话题：{request.context if request.context else '（用户未提供初始话题）'}。请基于这个话题，用日语主动提出第一个问题，帮助用户深入探索这个话题。"
             content_to_send = [prompt_for_first_round]
-            use_generate_content = True  # 第一轮用 generate_content 避免 send_message 内部 IndexError
+            chat_history = None  # 第一轮用 generate_content 避免 send_message 内部 IndexError
         else:
-            # 非第一轮：正常处理历史记录
-            for m in request.history[:-1]:  # 不包含最新一条
-                role = "user" if m.role == "user" else "model"
-                gemini_history.append({"role": role, "parts": [m.content]})
+            # 非第一轮：正常处理历史记录（不包含最新一条）；超出 token 预算时较早的轮次折叠成摘要
+            compacted = await history_compactor.compact(
+                [(m.role, m.content) for m in request.history[:-1]], HISTORY_BUDGETS["chat"], request.context)
+            if compacted.summary:
+                gemini_history.append({"role": "user", "parts": [f"[之前对话的摘要] {compacted.summary}"]})
+            for role, content in compacted.recent:
+                role = "user" if role == "user" else "model"
+                gemini_history.append({"role": role, "parts": [content]})
 
             # --- 3. 处理当前最新的输入（文本或浏览器录音）---
             if len(request.history) == 0:
                 raise ValueError("history为空，无法处理用户输入")
             last_msg = request.history[-1].content
             
-            # ★ 优先使用前端传来的 audio_base64（浏览器录音）
-            if request.audio_base64:
-                print(f"🎤 [/api/chat] 检测到浏览器录音，音频base64长度={len(request.audio_base64)}, mime={request.audio_mime_type}")
-                audio_bytes = base64.b64decode(request.audio_base64)
-                print(f"🎤 音频解码后字节数={len(audio_bytes)}")
-                audio_part = genai.protos.Part(
-                    inline_data=genai.protos.Blob(
-                        mime_type=request.audio_mime_type,
-                        data=audio_bytes
-                    )
-                )
+            # ★ 优先使用浏览器录音：audio_id（转写时已接入的录音）或 audio_base64
+            if request.audio_id or request.audio_base64:
+                recording = audio_ingestor.get(request.audio_id) if request.audio_id else None
+                if recording is None:
+                    if not request.audio_base64:
+                        # 录音已过期或落在别的实例上：让前端带着 audio_base64 重发
+                        return {
+                            "reply": "",
+                            "translation": "",
+                            "status": "ERROR",
+                            "suggestion": None,
+                            "communication_raw": [],
+                            "error": "audio_expired",
+                        }
+                    recording = await audio_ingestor.add(request.audio_base64, request.audio_mime_type)
+                logger.debug("检测到浏览器录音: id=%s, 字节数=%d, mime=%s",
+                             recording.audio_id, recording.size, recording.mime_type)
+                with timed("chat.audio_ingest"):
+                    audio_part = await audio_ingestor.part(recording)
                 # 构建历史上下文
-                history_context = "\n".join([
-                    f"{'用户' if m.role == 'user' else request.mentorRole}: {m.content}" 
-                    for m in request.history[:-1]
-                ])
+                history_context = "\n".join(compacted.lines(
+                    lambda role, content: f"{'用户' if role == 'user' else request.mentorRole}: {content}"))
                 context_text = f"""## 之前的对话历史：
 {history_context}
 
@@ -483,57 +913,47 @@ async def chat(request: ChatRequest):
 ⚠️ 保留所有口癖、停顿词（えっと、あの、那个、嗯、就是）。
 然后根据系统指令的 Output Format 生成完整的 JSON 回复。"""
                 content_to_send = [audio_part, context_text]
-                use_generate_content = True  # 多模态必须用 generate_content
-            elif last_msg.endswith(('.m4a', '.mp3', '.wav')):
-                audio_file = genai.upload_file(path=last_msg)
-                content_to_send = [audio_file]
-                chat_session = model.start_chat(history=gemini_history)
-                use_generate_content = False
+                chat_history = None  # 多模态必须用 generate_content
             else:      
                 content_to_send = [last_msg]
-                chat_session = model.start_chat(history=gemini_history)
-                use_generate_content = False
+                chat_history = gemini_history
         
         # --- 4. 开启对话并发送 ---
-        # ⚠️ 关键修复：第一轮使用 model.generate_content() 而非 chat_session.send_message()
-        # 原因：send_message() 内部会执行 response.candidates[0].content 来更新历史，
-        #        当 Gemini 返回空 candidates 时抛出 "list index out of range"，
-        #        而且这个 IndexError 发生在 SDK 内部，难以在外层可靠捕获。
+        # ⚠️ 第一轮和音频输入不带 history（provider 走 generate_content 而非 ChatSession），
+        #    空 candidates / 被屏蔽时 provider 抛出 EmptyResponseError（ValueError）
+        # 流式模式下 reply 每写完一句就开始合成语音；最后一轮的 reply 会被改写，不提前推送给客户端
+        speech = None
+        if CHAT_STREAM_TTS:
+            speech = SpeechPipeline(_synthesize_sentence, on_segment=None if is_last_round else on_audio)
         try:
-            print(f"🔍 [第一轮={is_first_round}, 有音频={bool(request.audio_base64)}, use_generate={use_generate_content}] 调用 Gemini API...")
-            if use_generate_content:
-                # 第一轮：直接调用 generate_content，不经过 ChatSession
-                response = model.generate_content(
-                    content_to_send,
-                    generation_config={"response_mime_type": "application/json"}
-                )
-            else:
-                # 非第一轮：使用 ChatSession 保持对话上下文
-                response = chat_session.send_message(
-                    content_to_send,
-                    generation_config={"response_mime_type": "application/json"}
-                )
-            
-            # 安全获取响应文本 —— 用独立的 try/except 包裹
-            response_text = None
-            try:
-                response_text = response.text
-                print(f"✅ 通过 response.text 获取到文本，长度={len(response_text)}")
-            except (IndexError, ValueError, AttributeError) as text_err:
-                print(f"⚠️ response.text 获取失败({type(text_err).__name__}: {text_err})，尝试备选方式...")
-                try:
-                    if response.candidates and len(response.candidates) > 0:
-                        c = response.candidates[0]
-                        if c.content and c.content.parts and len(c.content.parts) > 0:
-                            response_text = c.content.parts[0].text
-                            print(f"✅ 通过 candidates 获取到文本，长度={len(response_text)}")
-                except (IndexError, ValueError, AttributeError) as fallback_err:
-                    print(f"⚠️ 备选方式也失败: {fallback_err}")
-            
-            if not response_text:
-                raise ValueError("模型未返回有效文本（candidates 为空或被屏蔽）")
+            logger.debug("调用 Gemini API: 第一轮=%s, 有音频=%s, 带历史=%s",
+                         is_first_round, bool(request.audio_id or request.audio_base64), chat_history is not None)
+            with timed("chat.gemini"):
+                if speech is None:
+                    response_text = await providers.text.generate(
+                        content_to_send,
+                        system_instruction=system_instruction,
+                        history=chat_history,
+                        json_mode=True,
+                        hedge=CHAT_HEDGE,
+                    )
+                else:
+                    reply_stream = ReplyExtractor("reply")
+                    chunks = []
+                    async for chunk in providers.text.stream(
+                        content_to_send,
+                        system_instruction=system_instruction,
+                        history=chat_history,
+                        json_mode=True,
+                        hedge=CHAT_HEDGE,
+                    ):
+                        chunks.append(chunk)
+                        speech.feed(reply_stream.feed(chunk))
+                    response_text = "".join(chunks)
+            logger.debug("Gemini 返回文本，长度=%d", len(response_text))
             
             # ★ JSON 修复：Gemini 有时返回格式不完美的 JSON
+            parse_started = time.perf_counter()
             import re
             cleaned = response_text.strip()
             # 去掉 markdown 代码块包裹
@@ -544,8 +964,7 @@ async def chat(request: ChatRequest):
             try:
                 res_json = json.loads(cleaned)
             except json.JSONDecodeError as je:
-                print(f"⚠️ JSON 直接解析失败: {je}")
-                print(f"⚠️ 原始文本前200字符: {cleaned[:200]}")
+                logger.warning("JSON 直接解析失败: %s, 原始文本 %s", je, redact(cleaned))
                 # 尝试提取第一个完整的 JSON 对象 { ... }
                 brace_count = 0
                 start_idx = cleaned.find('{')
@@ -564,7 +983,8 @@ async def chat(request: ChatRequest):
                     json_str = cleaned[start_idx:end_idx + 1]
                     try:
                         res_json = json.loads(json_str)
-                        print(f"✅ JSON 修复成功（提取大括号内容）")
+                        FALLBACKS.inc(kind="chat.json_brace_extract")
+                        logger.info("JSON 修复成功（提取大括号内容）")
                     except json.JSONDecodeError:
                         # 最后尝试：修复常见问题（字符串内未转义的换行/引号）
                         # 尝试用正则提取关键字段
@@ -584,11 +1004,13 @@ async def chat(request: ChatRequest):
                                 "status": status_match.group(1) if status_match else "CONTINUE",
                                 "suggestion": suggestion_match.group(1) if suggestion_match else None,
                             }
-                            print(f"✅ JSON 修复成功（正则提取关键字段）")
+                            FALLBACKS.inc(kind="chat.json_regex_extract")
+                            logger.info("JSON 修复成功（正则提取关键字段）")
                         else:
                             raise ValueError(f"无法从模型返回文本中提取JSON: {cleaned[:200]}")
                 else:
                     raise ValueError(f"JSON 大括号不匹配: {cleaned[:200]}")
+            STAGE_SECONDS.observe(time.perf_counter() - parse_started, stage="chat.parse")
             if not isinstance(res_json, dict):
                 raise ValueError("模型返回格式不是有效的JSON对象")
             # 若模型直接返回 Error，视为失败，不继续后续流程
@@ -603,11 +1025,12 @@ async def chat(request: ChatRequest):
             if res_json.get("suggestion") is None:
                 res_json["suggestion"] = None
             
-            print(f"✅ [第一轮={is_first_round}] 解析成功: reply长度={len(res_json.get('reply',''))}, user_ja={res_json.get('user_ja','')[:30]}")
+            logger.debug("解析成功: 第一轮=%s, reply长度=%d", is_first_round, len(res_json.get("reply", "")))
         except Exception as e:
-            print(f"❌ Gemini API调用失败: {type(e).__name__}: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Gemini API调用失败: %s: %s", type(e).__name__, e)
+            FALLBACKS.inc(kind="chat.error_payload")
+            if speech is not None:
+                speech.cancel()
             # 返回友好的错误信息，不将异常详情暴露给用户
             return {
                 "reply": f"抱歉，作为{request.mentorRole}，我现在无法回复。请稍后再试。（{type(e).__name__}）",
@@ -621,35 +1044,33 @@ async def chat(request: ChatRequest):
         
         # 4.5. 强制检查轮次，如果达到最后一轮，强制设置FINISHED状态并添加结束语
         # 使用之前计算的current_round（包括当前这一条用户消息）
-        print(f"🔍 调试信息：当前轮次={current_round}, 目标轮次={request.turn}, 是否最后一轮={is_last_round}")
-        print(f"🔍 调试信息：history长度={len(request.history)}, 用户消息数={len([m for m in request.history if m.role == 'user'])}")
+        logger.debug("当前轮次=%d, 目标轮次=%d, 是否最后一轮=%s, history长度=%d",
+                     current_round, request.turn, is_last_round, len(request.history))
         
         # 强制检查：如果达到或超过目标轮次，必须设置FINISHED并强制替换为结束语
         if current_round >= request.turn:
-            print(f"🎯 检测到最后一轮（第 {current_round} 轮 >= {request.turn} 轮），强制设置FINISHED状态")
+            logger.debug("检测到最后一轮（第 %d 轮 >= %d 轮），强制设置FINISHED状态", current_round, request.turn)
             res_json["status"] = "FINISHED"
             
             # 第6轮：强制替换reply为结束语，不包含问题
             original_reply = res_json.get("reply", "")
-            ending_message_ja = "ありがとうございます。今日は私と話してくれて、一緒に今日の日記を書きましょう。"
-            ending_message_zh = "谢谢你和我说这些，让我们来一起写作今天的日记吧。"
+            ending_message_ja = ENDING_MESSAGE_JA
+            ending_message_zh = ENDING_MESSAGE_ZH
             
             # 检查是否已包含结束语的关键词
             has_ending = "ありがとう" in original_reply and ("日記" in original_reply or "一緒" in original_reply)
             
-            print(f"🔍 调试信息：原始reply长度={len(original_reply)}, 是否包含结束语={has_ending}")
-            print(f"🔍 调试信息：原始reply内容={original_reply[:150]}...")
             
             # 检查reply中是否包含问题（问号、疑问词等）
             has_question = "？" in original_reply or "?" in original_reply or "ですか" in original_reply or "どう" in original_reply or "何" in original_reply or "いつ" in original_reply or "どこ" in original_reply or "誰" in original_reply or "なぜ" in original_reply or "どのように" in original_reply
             
-            print(f"🔍 调试信息：reply是否包含问题={has_question}")
+            logger.debug("原始reply长度=%d, 是否包含结束语=%s, 是否包含问题=%s", len(original_reply), has_ending, has_question)
             
             # 如果AI已经包含了结束语且没有提问，保留AI的回复
             if has_ending and not has_question:
                 # AI已经包含结束语且没有提问，保留AI的回复
                 res_json["reply"] = original_reply
-                print(f"✅ AI已包含结束语且无提问（第 {current_round} 轮），保留AI回复")
+                logger.debug("AI已包含结束语且无提问（第 %d 轮），保留AI回复", current_round)
             elif has_question:
                 # 如果包含问题，移除问题部分，保留回应部分，然后添加结束语
                 # 尝试提取问题之前的内容作为回应
@@ -671,8 +1092,7 @@ async def chat(request: ChatRequest):
                 res_json["reply"] = final_reply
                 res_json["translation"] = "太好了。" + " " + ending_message_zh
                 
-                print(f"⚠️ AI回复中包含问题，已移除问题并添加结束语（第 {current_round} 轮）")
-                print(f"✅ 最终reply: {res_json.get('reply', '')}")
+                logger.info("AI回复中包含问题，已移除问题并添加结束语（第 %d 轮）", current_round)
             else:
                 # 如果没有结束语但没有问题，添加结束语
                 if original_reply:
@@ -683,42 +1103,55 @@ async def chat(request: ChatRequest):
                     res_json["reply"] = ending_message_ja
                     res_json["translation"] = ending_message_zh
                 
-                print(f"✅ 已添加结束语（第 {current_round} 轮）")
-                print(f"✅ 最终reply: {res_json.get('reply', '')}")
+                logger.debug("已添加结束语（第 %d 轮）", current_round)
             
             # 确保status是FINISHED
             res_json["status"] = "FINISHED"
-        else:
-            print(f"📝 当前是第 {current_round} 轮，未达到最后一轮（需要 {request.turn} 轮），继续对话")
 
         # 5. 动态集成 TTS ---
         ai_reply_text = res_json.get("reply", "")
+        if res_json.get("status") == "FINISHED" and owner:
+            # 结束语已经确定：合成语音的同时就开始算总结和场景提示词
+            _speculate_finalization(owner, request, ai_reply_text)
+        elif res_json.get("status") == "CONTINUE" and ai_reply_text:
+            # 下一轮的历史 = 本轮 history + 这条回复：用户还在看回复时先把要折叠的摘要算好
+            history_compactor.prefetch([*((m.role, m.content) for m in request.history), ("model", ai_reply_text)],
+                                       HISTORY_BUDGETS["chat"], request.context)
         
         if ai_reply_text:
             try:
-                tts_result = await synthesize_speech(text=ai_reply_text, speaker="model")
+                with timed("chat.tts"):
+                    if speech is not None:
+                        # 大部分句子在 Gemini 写完之前就已合成好，这里只补上剩下的并按顺序拼接
+                        try:
+                            audio_content = await speech.finish(ai_reply_text)
+                            tts_result = {"audio_base64": base64.b64encode(audio_content).decode("utf-8")}
+                        except SpeechUnavailableError as e:
+                            logger.error("%s", e)
+                            tts_result = {"error": str(e)}
+                    else:
+                        tts_result = await synthesize_speech(text=ai_reply_text, speaker="model")
                 if "error" in tts_result:
                     error_msg = tts_result.get("error")
-                    print(f"⚠️ TTS 合成失败: {error_msg}")
+                    logger.warning("TTS 合成失败: %s", error_msg)
                     res_json["reply_audio"] = None
                     res_json["tts_error"] = error_msg
                 else:
                     audio_base64 = tts_result.get("audio_base64")
                     if audio_base64:
                         res_json["reply_audio"] = audio_base64
-                        print(f"✅ 成功生成回复音频，已添加到响应中")
                     else:
-                        print(f"⚠️ TTS 返回结果中没有 audio_base64 字段")
+                        logger.warning("TTS 返回结果中没有 audio_base64 字段")
                         res_json["reply_audio"] = None
             except Exception as tts_err:
                 error_msg = f"TTS 调用异常: {str(tts_err)}"
-                print(f"⚠️ {error_msg}")
-                import traceback
-                traceback.print_exc()
+                logger.exception(error_msg)
                 res_json["reply_audio"] = None
                 res_json["tts_error"] = error_msg
         else:
-            print("⚠️ AI 回复文本为空，跳过 TTS 合成")
+            logger.warning("AI 回复文本为空，跳过 TTS 合成")
+            if speech is not None:
+                speech.cancel()
 
         # 6. 整合完整历史（每轮都生成，包含详细信息）---
         # 构建完整的 communication_raw，包含每轮的详细信息
@@ -760,11 +1193,9 @@ async def chat(request: ChatRequest):
             # 如果有之前的完整 communication_raw，使用它来保留所有字段
             if request.previous_communication_raw and len(request.previous_communication_raw) > 0:
                 # 使用之前的完整 communication_raw，保留所有字段
-                print(f"🔍 使用之前的 communication_raw，包含 {len(request.previous_communication_raw)} 条记录")
                 full_communication = request.previous_communication_raw.copy()
             else:
                 # 如果没有之前的 communication_raw，从 history 构建（只包含 role 和 content）
-                print(f"🔍 从 history 构建 communication_raw，包含 {len(request.history)} 条记录")
                 for m in request.history[:-1]:  # 不包含最新一条（当前用户输入）
                     msg_dict = {
                         "role": m.role,
@@ -784,7 +1215,7 @@ async def chat(request: ChatRequest):
                 }
                 full_communication.append(current_user_round)
             else:
-                print("⚠️ 警告：history为空，跳过用户输入记录")
+                logger.warning("history为空，跳过用户输入记录")
             
             # 加入 AI 刚刚生成的回复（模型输出）
             # 安全处理suggestion字段，防止list index out of range错误
@@ -810,16 +1241,14 @@ async def chat(request: ChatRequest):
         res_json["communication_raw"] = full_communication
         
         if res_json.get("status") == "FINISHED":
-            print(f"🎊 对话结束！已打包 {len(full_communication)} 条完整对话记录")
-        else:
-            print(f"📝 当前对话轮次：{len([m for m in full_communication if m['role'] == 'user'])}/{request.turn}")
+            logger.info("对话结束，已打包 %d 条完整对话记录", len(full_communication))
 
-        return res_json
+        with timed("chat.serialize"):
+            return FastJSONResponse(res_json)
 
     except Exception as e:
-        print(f"❌ [外层异常] {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[外层异常] %s: %s", type(e).__name__, e)
+        FALLBACKS.inc(kind="chat.error_payload")
         return {
             "reply": f"抱歉，回复生成时出了点问题，请稍后再试。（{type(e).__name__}）",
             "translation": "抱歉，回复生成时出了点问题，请稍后再试。",
@@ -833,15 +1262,8 @@ async def chat(request: ChatRequest):
 # ===========================
 # 2.1 日记自动总结接口（initial summary）
 # ===========================
-@app.post("/api/summarize")
-async def summarize(request: ChatRequest):
-    
-    """
-    输入：前端传回的完整对话历史 (communication_raw)
-    输出：对话summary，{{"title": "...", "diary_ja": "...", "diary_zh": "..."}}
-    """
-
-
+async def _summarize(request: ChatRequest, bypass_cache: bool = False) -> tuple[dict, bool]:
+    """返回 (summary, 是否命中模型缓存)；/api/summarize 和对话结束时的提前计算共用"""
     system_prompt = f"""
     你是一位精通日语手帐写作的导师。
     任务： 基于对话事实,将用户与「{request.mentorRole}」（语气：{request.tone}）的对话总结成一篇第一人称（私）的治愈系日语摘要。。
@@ -850,39 +1272,61 @@ async def summarize(request: ChatRequest):
     2. 情感真挚，150字左右。
     ## 格式：必须返回 JSON {{"title": "...", "diary_ja": "...", "diary_zh": "..."}}
     """
+
+    # 1. 提供“食材”,简化历史记录，只保留文本语义
+    history_summary = "".join(line + "\n" for line in await _history_lines(
+        request.history, "summarize", request.context,
+        lambda role, content: f"{'user' if role == 'user' else 'model'}: {content}"))
+
+    # 2. 下达“开工”指令,生成内容;规定“包装格式”（system_prompt 设定“大脑”的工作模式）
+    user_prompt = f"以下是对话历史：\n{history_summary}"
+    with timed("summarize.gemini"):
+        response_text, hit = await model_cache.cached(
+            "summarize", MODEL_CACHE_VERSIONS["summarize"], GEMINI_MODEL_ID, [system_prompt, user_prompt],
+            lambda: providers.text.generate(
+                [user_prompt],
+                system_instruction=system_prompt,
+                json_mode=True,  # 强制返回json的意思
+            ),
+            validate=json.loads,
+            bypass=bypass_cache,
+        )
+
+    # 3. 最后“拆箱”取货。AI 返回的是一串死板的“字符串”，这行代码把它变成了 Python 能操作的“字典”。
+    return json.loads(response_text), hit
+
+
+@app.post("/api/summarize", dependencies=[Depends(rate_limiter.limit("generate"))])
+async def summarize(request: ChatRequest, http_request: Request, response: Response,
+                    bypass_cache: bool = Depends(cache_bypass)):
     
+    """
+    输入：前端传回的完整对话历史 (communication_raw)
+    输出：对话summary，{{"title": "...", "diary_ja": "...", "diary_zh": "..."}}
+    对话结束时已提前开始计算：history 一致就直接取（还没算完就等它），不一致则重新生成
+    """
     try:
-        # 1. 设定“大脑”的工作模式。
-        model = genai.GenerativeModel(
-            model_name=GEMINI_MODEL_ID,
-            system_instruction=system_prompt
-        )
-        
-        # 2. 提供“食材”,简化历史记录，只保留文本语义
-        history_summary = ""
-        for m in request.history:
-            role_name = "user" if m.role == "user" else "model"
-            history_summary += f"{role_name}: {m.content}\n"
-
-        # 3. 下达“开工”指令,生成内容;规定“包装格式”
-        response = model.generate_content(
-            f"以下是对话历史：\n{history_summary}",
-            generation_config={"response_mime_type": "application/json"} # 强制返回json的意思
-        )
-        
-        # 4. 最后“拆箱”取货。AI 返回的是一串死板的“字符串”，这行代码把它变成了 Python 能操作的“字典”。
-        return json.loads(response.text)
+        summary = None
+        if not bypass_cache:
+            summary = await speculator.take(await _rate_limit_identity(http_request), "summarize",
+                                            _conversation_key(request))
+        hit = summary is not None
+        if summary is None:
+            summary, hit = await _summarize(request, bypass_cache)
+        response.headers["X-Cache"] = "HIT" if hit else "MISS"
+        return summary
     
     except Exception as e:
-        print(f"❌ 总结失败: {e}")
+        logger.exception("总结失败: %s", e)
+        FALLBACKS.inc(kind="summarize.fail")
         return {"title": "今日、回響", "diary_ja": "fail", "diary_zh": 'fail'}
 
 # ===========================
 # 2.2 日记修改接口（refined summary）
 # ===========================
 
-@app.post("/api/refine_summary")
-async def refine_summary(request: RefineRequest):
+@app.post("/api/refine_summary", dependencies=[Depends(rate_limiter.limit("generate"))])
+async def refine_summary(request: RefineRequest, response: Response, bypass_cache: bool = Depends(cache_bypass)):
     """
     接收用户修正意见，生成最终的 refined_summary
     """
@@ -896,8 +1340,7 @@ async def refine_summary(request: RefineRequest):
     格式：JSON {{"refined_summary_ja": "...", "refined_summary_zh": "..."}}
     """
     try:
-        model = genai.GenerativeModel(model_name=GEMINI_MODEL_ID, system_instruction=system_prompt)
-        history_text = "\n".join([f"{m.role}: {m.content}" for m in request.history])
+        history_text = "\n".join(await _history_lines(request.history, "refine_summary", request.context))
         
         input_content = f"""
         [原始对话历史]:
@@ -907,20 +1350,26 @@ async def refine_summary(request: RefineRequest):
         {request.correction_summary}
         """
         
-        response = model.generate_content(
-            input_content,
-            generation_config={"response_mime_type": "application/json"}
-        )
-        return json.loads(response.text)
+        with timed("refine_summary.gemini"):
+            response_text, hit = await model_cache.cached(
+                "refine_summary", MODEL_CACHE_VERSIONS["refine_summary"], GEMINI_MODEL_ID,
+                [system_prompt, input_content],
+                lambda: providers.text.generate([input_content], system_instruction=system_prompt, json_mode=True),
+                validate=json.loads,
+                bypass=bypass_cache,
+            )
+        response.headers["X-Cache"] = "HIT" if hit else "MISS"
+        return json.loads(response_text)
     except Exception as e:
-        print(f"❌ 修正总结失败: {e}")
+        logger.exception("修正总结失败: %s", e)
+        FALLBACKS.inc(kind="refine_summary.fail")
         return {"refined_summary_ja": "Error", "refined_summary_zh": "Error"}
 
 # ===========================
 # 3.  播客脚本接口 + 日记
 # ===========================
 
-@app.post("/api/generate_podcast_and_diary")
+@app.post("/api/generate_podcast_and_diary", dependencies=[Depends(rate_limiter.limit("generate"))])
 async def generate_podcast_and_diary(request: FinalGenerationRequest):
     """
     输入：communication_raw + refined_summary_ja
@@ -961,15 +1410,12 @@ async def generate_podcast_and_diary(request: FinalGenerationRequest):
         if not history:
             raise ValueError("缺少对话素材 (History is empty)")
         
-        print(f"🔍 调试信息：组合后的 history 长度: {len(history)}")
-        print(f"   包含 communication_raw: {len(request.communication_raw)} 条")
-        print(f"   refined_summary_ja: {request.refined_summary_ja[:50] if request.refined_summary_ja else 'N/A'}...")
+        logger.debug("组合后的 history 长度=%d, communication_raw=%d 条, refined_summary_ja=%s",
+                     len(history), len(request.communication_raw), redact(request.refined_summary_ja))
         
         # 2. 调用 Gemini 生成内容
-        model = genai.GenerativeModel(model_name=GEMINI_MODEL_ID, system_instruction=system_prompt)
-        
         # 构建输入文本：包含对话历史和用户总结的摘要
-        history_text = "\n".join([f"{m.role}: {m.content}" for m in history])
+        history_text = "\n".join(await _history_lines(history, "podcast_script", request.context))
         
         # 添加 refined_summary 作为额外的上下文
         input_text = f"""以下是完整的对话素材：
@@ -978,13 +1424,13 @@ async def generate_podcast_and_diary(request: FinalGenerationRequest):
 [用户总结的日记摘要]：
 {request.refined_summary_ja}
 """
-        response = model.generate_content(
-            input_text,
-            generation_config={"response_mime_type": "application/json"}
-        )
+        with timed("podcast_script.gemini"):
+            response_text = await providers.text.generate(
+                [input_text], system_instruction=system_prompt, json_mode=True
+            )
         
         # 2. 解析 JSON 结果
-        res_data = json.loads(response.text)
+        res_data = json.loads(response_text)
         
         # 3. 返回脚本和日记（不包含音频）
         result = {
@@ -993,15 +1439,13 @@ async def generate_podcast_and_diary(request: FinalGenerationRequest):
             "status": "SUCCESS"
         }
         
-        print(f"✅ 播客脚本和日记生成成功")
-        print(f"   日记标题: {result['diary'].get('title', 'N/A')}")
+        logger.info("播客脚本和日记生成成功: %d 行脚本", len(result["script"]))
         
         return result
 
     except Exception as e:
-        print(f"❌ fail: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("播客脚本和日记生成失败: %s", e)
+        FALLBACKS.inc(kind="podcast_script.fail")
         return {
             "script": [],
             "diary": {"title": "fail", "content_ja": "fail"},
@@ -1034,90 +1478,116 @@ class ImageGenerationRequest(BaseModel):
     history: list[Message]
     scene_prompts: list[str] = None  # 可选的场景提示词，如果提供则跳过提取步骤
 
-@app.post("/api/generate_podcast_audio")
+def _podcast_lines(script: list) -> list[tuple[str, str, str]]:
+    """脚本 -> [(speaker, voice_name, content)]，空行去掉"""
+    lines = []
+    for i, line in enumerate(script, 1):
+        speaker = line.get("speaker", "")
+        content = line.get("content", "")
+        if not content.strip():
+            continue
+
+        # --- 核心：音色分配逻辑 ---
+        # 主持人（导师）：使用男声 ja-JP-Neural2-B (男声)
+        # 用户（嘉宾）：使用女声 ja-JP-Neural2-C (女声)
+        # 检查说话人是否为用户/嘉宾（支持中文和日文）
+        if ("用户" in speaker or "ユーザー" in speaker or "嘉宾" in speaker or "私" in speaker or
+            speaker.lower() == "user" or "guest" in speaker.lower()):
+            # 用户/嘉宾使用女声
+            voice_name = VOICE_NAMES["user"]  # 女声
+            speaker_gender = "女声"
+        else:
+            # 主持人/导师使用男声
+            voice_name = VOICE_NAMES["model"]  # 男声
+            speaker_gender = "男声"
+
+        logger.debug("[%d/%d] %s: %s (%s: %s)", i, len(script), speaker, redact(content), speaker_gender, voice_name)
+        lines.append((speaker, voice_name, content))
+    return lines
+
+
+def _start_podcast(script: list):
+    lines = _podcast_lines(script)
+    if not lines:
+        return None
+    logger.info("开始生成多角色播客音频，总轮次: %d", len(lines))
+    return podcast_assembler.start(providers.speech.profile, lines)
+
+
+@app.post("/api/generate_podcast_audio", dependencies=[Depends(rate_limiter.limit("podcast_audio"))])
 async def generate_podcast_audio(request: PodcastScriptRequest):
     """
     输入：播客脚本数组 [{'speaker': '...', 'content': '...'}]
-    输出：拼接后的完整 MP3 Base64
+    输出：拼接后的完整 MP3 Base64（想边合成边播放用 /api/podcast_audio）
     """
     try:
         script = request.script
-        
+
         if not script or not isinstance(script, list):
             return {"error": "脚本内容为空或格式错误", "audio_base64": None, "status": "ERROR"}
 
-        if tts_client is None:
-            return {"error": "TTS 客户端未初始化", "audio_base64": None, "status": "ERROR"}
-
-        combined_audio_content = b"" # 用于存储拼接的二进制音频数据
-
-        print(f"🔊 开始生成多角色播客音频，总轮次: {len(script)}")
-
-        for i, line in enumerate(script, 1):
-            speaker = line.get("speaker", "")
-            content = line.get("content", "")
-            
-            # --- 核心：音色分配逻辑 ---
-            # 如果说话人是用户（含有“用户”或“嘉宾”字样），用音色 C
-            # 如果说话人是导师角色，用音色 B
-            if "用户" in speaker or "嘉宾" in speaker or "私" in speaker:
-                current_speaker_type = "user" # ja-JP-Neural2-C
-            else:
-                current_speaker_type = "model" # ja-JP-Neural2-B
-            
-            # 调用已有的合成函数（注意：需要确保 synthesize_speech 返回的是原始二进制数据或在之后解码）
-            # 为了方便拼接二进制数据，我们稍微调整逻辑获取 response.audio_content
-            
-            # --- 模拟合成过程 ---
-            # 这里调用 Google TTS API 并获取 audio_content
-            # 注意：合成后将二进制内容追加到 combined_audio_content
-            # 主持人（导师）：使用男声 ja-JP-Neural2-B (男声)
-            # 用户（嘉宾）：使用女声 ja-JP-Neural2-C (女声)
-            # 检查说话人是否为用户/嘉宾（支持中文和日文）
-            if ("用户" in speaker or "ユーザー" in speaker or "嘉宾" in speaker or "私" in speaker or 
-                speaker.lower() == "user" or "guest" in speaker.lower()):
-                # 用户/嘉宾使用女声
-                voice_name = "ja-JP-Neural2-C"  # 女声
-                speaker_gender = "女声"
-            else:
-                # 主持人/导师使用男声
-                voice_name = "ja-JP-Neural2-B"  # 男声
-                speaker_gender = "男声"
-            
-            print(f"  [{i}/{len(script)}] {speaker}: {content[:50]}... ({speaker_gender}: {voice_name})")
-            
-            synthesis_input = texttospeech.SynthesisInput(text=content)
-            voice = texttospeech.VoiceSelectionParams(language_code="ja-JP", name=voice_name)
-            audio_config = texttospeech.AudioConfig(
-                audio_encoding=texttospeech.AudioEncoding.MP3,
-                pitch=0.0,
-                speaking_rate=1.0
-            )
-            
-            response = tts_client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config)
-            combined_audio_content += response.audio_content
+        job = _start_podcast(script)
+        if job is None:
+            return {"error": "脚本内容为空或格式错误", "audio_base64": None, "status": "ERROR"}
+        await job.wait()
+        if job.error:
+            return {"error": job.error, "audio_base64": None, "status": "ERROR"}
 
         # 将最终拼接好的二进制数据转为 Base64
-        final_base64 = base64.b64encode(combined_audio_content).decode("utf-8")
-        print(f"✅ 多角色播客合成成功，最终大小: {len(final_base64)} 字符")
-        
+        audio_content = await asyncio.to_thread(job.path.read_bytes)
+        final_base64 = base64.b64encode(audio_content).decode("utf-8")
+        logger.info("多角色播客合成成功，最终大小: %d 字符", len(final_base64))
+
         return {
             "status": "SUCCESS",
             "audio_base64": final_base64,
-            "total_lines": len(script)
+            "total_lines": len(script),
+            "podcast_id": job.podcast_id,
         }
 
     except Exception as e:
-        print(f"❌ 播客合成异常: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("播客合成异常: %s", e)
         return {"error": str(e), "audio_base64": None, "status": "ERROR"}
 
+
+@app.post("/api/podcast_audio", dependencies=[Depends(rate_limiter.limit("podcast_audio"))])
+async def start_podcast_audio(request: PodcastScriptRequest):
+    """
+    开始合成播客音频，立即返回播放地址；GET 这个地址会边合成边推送 audio/mpeg，
+    前端 <audio src> 在第一句合成好之后就能开始播放。
+    """
+    script = request.script
+    if not script or not isinstance(script, list):
+        return {"error": "脚本内容为空或格式错误", "url": None, "status": "ERROR"}
+    job = _start_podcast(script)
+    if job is None:
+        return {"error": "脚本内容为空或格式错误", "url": None, "status": "ERROR"}
+    return {
+        "status": "SUCCESS",
+        "podcast_id": job.podcast_id,
+        "url": f"/api/podcast_audio/{job.podcast_id}.mp3",
+        "total_lines": len(script),
+    }
+
+
+@app.get("/api/podcast_audio/{podcast_id}.mp3")
+async def podcast_audio(podcast_id: str):
+    job = podcast_assembler.get(podcast_id)
+    if job is None:
+        return FastJSONResponse({"error": "podcast_not_found", "status": "ERROR"}, status_code=404)
+    if job.error:
+        return FastJSONResponse({"error": job.error, "status": "ERROR"}, status_code=502)
+    if job.done:
+        return FileResponse(job.path, media_type="audio/mpeg")
+    # 还在合成：分块推送已经写好的部分，直到最后一句写完
+    return StreamingResponse(podcast_assembler.stream(job), media_type="audio/mpeg",
+                             headers={"Cache-Control": "no-store"})
+
 # ===========================
 # 5.  语音合成接口 
 # ===========================
 # FastAPI 路由：对外提供 TTS 接口
-@app.post("/api/tts")
+@app.post("/api/tts", dependencies=[Depends(rate_limiter.limit("tts"))])
 async def text_to_speech(text: str, speaker: str = "model"):
     """
     TTS 路由接口，接收 HTTP 请求并调用 synthesize_speech
@@ -1127,19 +1597,15 @@ async def text_to_speech(text: str, speaker: str = "model"):
 # ===========================
 # 6. 漫画生成接口 
 # ===========================
-@app.post("/api/extract_scene_prompts")
+@app.post("/api/extract_scene_prompts", dependencies=[Depends(rate_limiter.limit("generate"))])
 async def extract_scene_prompts(request: ChatRequest):
     """
     只提取场景提示词，不生成图片
     """
     try:
-        print(f"📝 收到场景提示词提取请求")
         
-        # 1. 初始化文本模型，用于从对话历史中提取"视觉瞬间"
-        text_model = genai.GenerativeModel(GEMINI_MODEL_ID)
-        
-        # 将历史记录转化为文本素材
-        history_text = "\n".join([f"{m.role}: {m.content}" for m in request.history])
+        # 1. 从对话历史中提取"视觉瞬间"，先将历史记录转化为文本素材
+        history_text = "\n".join(await _history_lines(request.history, "scene_prompts", request.context))
         
         # 提示词工程：基于脚本内容提取两个不同的视觉瞬间
         extraction_prompt = f"""
@@ -1184,15 +1650,11 @@ async def extract_scene_prompts(request: ChatRequest):
         """
         
         # 获取场景描述
-        print(f"📝 正在提取场景提示词...")
-        extract_res = text_model.generate_content(
-            extraction_prompt, 
-            generation_config={"response_mime_type": "application/json"}
-        )
-        print(f"✅ 场景提示词提取成功")
+        with timed("scene_prompts.gemini"):
+            extract_text = await providers.text.generate([extraction_prompt], json_mode=True)
         
         try:
-            prompts_raw = json.loads(extract_res.text).get("scene_prompts", [])
+            prompts_raw = json.loads(extract_text).get("scene_prompts", [])
             # 清理提示词：移除 "第一个场景：" 和 "第二个场景：" 等前缀
             prompts = []
             for prompt in prompts_raw:
@@ -1204,18 +1666,16 @@ async def extract_scene_prompts(request: ChatRequest):
                     cleaned = prompt.split(":", 1)[1].strip()
                 prompts.append(cleaned)
             
-            print(f"   提取到 {len(prompts)} 个场景提示词")
-            print(f"\n📝 场景提示词详情:")
+            logger.info("提取到 %d 个场景提示词", len(prompts))
             for i, prompt in enumerate(prompts, 1):
-                print(f"   场景 {i}: {prompt}")
+                logger.debug("场景 %d: %s", i, redact(prompt))
             
             return {
                 "status": "SUCCESS",
                 "scene_prompts": prompts
             }
         except json.JSONDecodeError as json_err:
-            print(f"❌ JSON 解析失败: {json_err}")
-            print(f"   响应文本: {extract_res.text[:500]}")
+            logger.error("场景提示词 JSON 解析失败: %s, 响应文本 %s", json_err, redact(extract_text))
             return {
                 "status": "ERROR",
                 "scene_prompts": [],
@@ -1223,26 +1683,59 @@ async def extract_scene_prompts(request: ChatRequest):
             }
             
     except Exception as e:
-        print(f"❌ 场景提示词提取失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("场景提示词提取失败: %s", e)
         return {
             "status": "ERROR",
             "scene_prompts": [],
             "error": str(e)
         }
 
-@app.post("/api/generate_image_from_prompts")
-async def generate_image_from_prompts(request: ImageFromPromptsRequest):
+PLACEHOLDER_IMAGE_URL = "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b"
+
+
+async def _generate_scene_images(prompts: list[str], keep_original: bool = False) -> list[dict]:
+    """用 nano-banana-pro-preview 依次生成前两个场景并压缩；单张失败时用占位图"""
+    generated_scenes = []
+    for i, p in enumerate(prompts[:2]):  # 确保只取前两个
+        logger.debug("正在生成场景 %d/2, 提示词 %s", i + 1, redact(p))
+        try:
+            # 调用 Nano Banana 的图像生成接口
+            with timed("image.generate"):
+                img_data_bytes = await providers.image.generate_image(p)
+            image = await image_optimizer.optimize(img_data_bytes, SCENE_IMAGE_MAX_PX, keep_original, kind="scene")
+            # 将字节数据转换为 base64 字符串
+            generated_scenes.append({
+                "scene_id": i + 1,
+                "image_base64": base64.b64encode(image.data).decode("utf-8"),
+                "description": p,
+                **image.report(),
+            })
+            logger.info("场景 %d 生成成功", i + 1)
+        except Exception as img_err:
+            if isinstance(img_err, ImageGenerationError):
+                logger.warning("场景 %d %s，使用占位图", i + 1, img_err)
+            else:
+                logger.exception("场景 %d 生成失败: %s", i + 1, img_err)
+            FALLBACKS.inc(kind="image.placeholder")
+            # 单张生成失败的备选逻辑
+            generated_scenes.append({
+                "scene_id": i + 1,
+                "image_url": PLACEHOLDER_IMAGE_URL,
+                "description": p,
+                "error": str(img_err)
+            })
+    return generated_scenes
+
+
+@app.post("/api/generate_image_from_prompts", dependencies=[Depends(rate_limiter.limit("image"))])
+async def generate_image_from_prompts(request: ImageFromPromptsRequest, keep_original: bool = False):
     """
     使用已提取的场景提示词生成图片
+    返回压缩后的图片（mime_type 标明格式）；?keep_original=1 时附带模型原图 original_base64
     """
     try:
         prompts = request.scene_prompts
-        print(f"🎨 收到图片生成请求（使用提供的提示词）")
-        print(f"   提示词数量: {len(prompts)}")
-        for i, prompt in enumerate(prompts, 1):
-            print(f"   场景 {i}: {prompt}")
+        logger.info("收到图片生成请求，提示词数量: %d", len(prompts))
         
         if not prompts:
             return {
@@ -1251,73 +1744,7 @@ async def generate_image_from_prompts(request: ImageFromPromptsRequest):
                 "error": "提示词列表为空"
             }
 
-        # 调用 nano-banana-pro-preview 生成图片
-        image_gen_model = genai.GenerativeModel("nano-banana-pro-preview")
-        
-        generated_scenes = []
-        
-        for i, p in enumerate(prompts[:2]):  # 确保只取前两个
-            print(f"\n🎨 正在生成场景 {i+1}/2")
-            print(f"   完整提示词: {p}")
-            
-            try:
-                # 调用 Nano Banana 的图像生成接口
-                response = image_gen_model.generate_content(p)
-                
-                # 提取图片数据
-                if response.candidates and len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    if candidate.content and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'inline_data') and part.inline_data:
-                                img_data_bytes = part.inline_data.data
-                                # 将字节数据转换为 base64 字符串
-                                img_data_base64 = base64.b64encode(img_data_bytes).decode("utf-8")
-                                
-                                generated_scenes.append({
-                                    "scene_id": i + 1,
-                                    "image_base64": img_data_base64,
-                                    "description": p
-                                })
-                                print(f"✅ 场景 {i+1} 生成成功")
-                                break
-                        else:
-                            # 如果没有找到 inline_data，尝试其他方式
-                            print(f"⚠️ 场景 {i+1} 未找到图片数据，尝试备用方案")
-                            generated_scenes.append({
-                                "scene_id": i + 1,
-                                "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                                "description": p,
-                                "error": "未找到图片数据"
-                            })
-                    else:
-                        print(f"⚠️ 场景 {i+1} 响应格式异常")
-                        generated_scenes.append({
-                            "scene_id": i + 1,
-                            "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                            "description": p,
-                            "error": "响应格式异常"
-                        })
-                else:
-                    print(f"⚠️ 场景 {i+1} 无候选结果")
-                    generated_scenes.append({
-                        "scene_id": i + 1,
-                        "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                        "description": p,
-                        "error": "无候选结果"
-                    })
-                    
-            except Exception as img_err:
-                print(f"❌ 场景 {i+1} 生成失败: {img_err}")
-                import traceback
-                traceback.print_exc()
-                # 单张生成失败的备选逻辑
-                generated_scenes.append({
-                    "scene_id": i + 1,
-                    "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                    "description": p,
-                    "error": str(img_err)
-                })
+        generated_scenes = await _generate_scene_images(prompts, keep_original)
 
         return {
             "status": "SUCCESS",
@@ -1325,32 +1752,21 @@ async def generate_image_from_prompts(request: ImageFromPromptsRequest):
         }
 
     except Exception as e:
-        print(f"❌ 图片生成失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("图片生成失败: %s", e)
         return {
             "status": "ERROR",
             "scenes": [],
             "error": str(e)
         }
 
-@app.post("/api/generate_image")
-async def generate_image(request: ChatRequest):
-    """
-    基于播客脚本内容，利用 Nano Banana 生成两幅吉卜力风格的场景漫画
-    先提取提示词，再生成图片（完整流程）
-    """
-    try:
-        print(f"🎨 收到图片生成请求（完整流程）")
-        
-        # 先提取提示词
-        text_model = genai.GenerativeModel(GEMINI_MODEL_ID)
-        
-        # 将历史记录转化为文本素材
-        history_text = "\n".join([f"{m.role}: {m.content}" for m in request.history])
-        
-        # 提示词工程：基于脚本内容提取两个不同的视觉瞬间
-        extraction_prompt = f"""
+
+async def _image_scene_prompts(history: list[Message], session: str = "") -> list[str]:
+    """/api/generate_image 用的场景提示词（吉卜力风格）；JSON 解析失败时抛出 JSONDecodeError"""
+    # 先提取提示词，将历史记录转化为文本素材
+    history_text = "\n".join(await _history_lines(history, "scene_prompts", session))
+    
+    # 提示词工程：基于脚本内容提取两个不同的视觉瞬间
+    extraction_prompt = f"""
         你是一位视觉场景设计师。基于以下播客脚本对话内容，提取两个完全不同、有强烈对比的视觉瞬间。
         
         ## 核心要求：
@@ -1391,116 +1807,63 @@ async def generate_image(request: ChatRequest):
         4. 如果对话中提到"割り切る"、"備え"等概念，可以通过相关的物品或动作来体现。
         5. 确保两个场景有明显的区别，不要使用相似的物品、动作或构图
         """
-        
-        # 获取场景描述
-        print(f"📝 正在提取场景提示词...")
-        extract_res = text_model.generate_content(
-            extraction_prompt, 
-            generation_config={"response_mime_type": "application/json"}
-        )
-        print(f"✅ 场景提示词提取成功")
-        
-        try:
-            prompts_raw = json.loads(extract_res.text).get("scene_prompts", [])
-            # 清理提示词：移除 "第一个场景：" 和 "第二个场景：" 等前缀
-            prompts = []
-            for prompt in prompts_raw:
-                # 移除中文前缀（如 "第一个场景："、"第二个场景："、"场景1："等）
-                cleaned = prompt
-                if "：" in prompt:
-                    cleaned = prompt.split("：", 1)[1].strip()
-                elif ":" in prompt:
-                    cleaned = prompt.split(":", 1)[1].strip()
-                prompts.append(cleaned)
-            
-            print(f"   提取到 {len(prompts)} 个场景提示词")
-            print(f"\n📝 场景提示词详情:")
-            for i, prompt in enumerate(prompts, 1):
-                print(f"   场景 {i}: {prompt}")
-        except json.JSONDecodeError as json_err:
-            print(f"❌ JSON 解析失败: {json_err}")
-            print(f"   响应文本: {extract_res.text[:500]}")
-            return {
-                "status": "ERROR",
-                "scenes": [],
-                "error": f"场景提示词解析失败: {str(json_err)}"
-            }
+    
+    # 获取场景描述
+    with timed("scene_prompts.gemini"):
+        extract_text = await providers.text.generate([extraction_prompt], json_mode=True)
+    
+    try:
+        prompts_raw = json.loads(extract_text).get("scene_prompts", [])
+        # 清理提示词：移除 "第一个场景：" 和 "第二个场景：" 等前缀
+        prompts = []
+        for prompt in prompts_raw:
+            # 移除中文前缀（如 "第一个场景："、"第二个场景："、"场景1："等）
+            cleaned = prompt
+            if "：" in prompt:
+                cleaned = prompt.split("：", 1)[1].strip()
+            elif ":" in prompt:
+                cleaned = prompt.split(":", 1)[1].strip()
+            prompts.append(cleaned)
+        
+        logger.info("提取到 %d 个场景提示词", len(prompts))
+        for i, prompt in enumerate(prompts, 1):
+            logger.debug("场景 %d: %s", i, redact(prompt))
+    except json.JSONDecodeError as json_err:
+        logger.error("场景提示词 JSON 解析失败: %s, 响应文本 %s", json_err, redact(extract_text))
+        raise
+    return prompts
+
+
+@app.post("/api/generate_image", dependencies=[Depends(rate_limiter.limit("image"))])
+async def generate_image(request: ChatRequest, http_request: Request, keep_original: bool = False):
+    """
+    基于播客脚本内容，利用 Nano Banana 生成两幅吉卜力风格的场景漫画
+    先提取提示词，再生成图片（完整流程）
+    对话结束时已提前提取提示词：history 一致就直接用
+    ?keep_original=1 时附带模型原图
+    """
+    try:
+        prompts = await speculator.take(await _rate_limit_identity(http_request), "scene_prompts",
+                                        _conversation_key(request))
+        if prompts is None:
+            try:
+                prompts = await _image_scene_prompts(request.history, request.context)
+            except json.JSONDecodeError as json_err:
+                return {
+                    "status": "ERROR",
+                    "scenes": [],
+                    "error": f"场景提示词解析失败: {str(json_err)}"
+                }
         
         if not prompts:
-            print("⚠️ 警告：未获取到场景提示词")
+            logger.warning("未获取到场景提示词")
             return {
                 "status": "ERROR",
                 "scenes": [],
                 "error": "未获取到场景提示词"
             }
         
-        # 调用生成图片的逻辑（复用上面的代码）
-        image_gen_model = genai.GenerativeModel("nano-banana-pro-preview")
-        
-        generated_scenes = []
-        
-        for i, p in enumerate(prompts[:2]):  # 确保只取前两个
-            print(f"\n🎨 正在生成场景 {i+1}/2")
-            print(f"   完整提示词: {p}")
-            
-            try:
-                # 调用 Nano Banana 的图像生成接口
-                response = image_gen_model.generate_content(p)
-                
-                # 提取图片数据
-                if response.candidates and len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    if candidate.content and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'inline_data') and part.inline_data:
-                                img_data_bytes = part.inline_data.data
-                                # 将字节数据转换为 base64 字符串
-                                img_data_base64 = base64.b64encode(img_data_bytes).decode("utf-8")
-                                
-                                generated_scenes.append({
-                                    "scene_id": i + 1,
-                                    "image_base64": img_data_base64,
-                                    "description": p
-                                })
-                                print(f"✅ 场景 {i+1} 生成成功")
-                                break
-                        else:
-                            # 如果没有找到 inline_data，尝试其他方式
-                            print(f"⚠️ 场景 {i+1} 未找到图片数据，尝试备用方案")
-                            generated_scenes.append({
-                                "scene_id": i + 1,
-                                "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                                "description": p,
-                                "error": "未找到图片数据"
-                            })
-                    else:
-                        print(f"⚠️ 场景 {i+1} 响应格式异常")
-                        generated_scenes.append({
-                            "scene_id": i + 1,
-                            "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                            "description": p,
-                            "error": "响应格式异常"
-                        })
-                else:
-                    print(f"⚠️ 场景 {i+1} 无候选结果")
-                    generated_scenes.append({
-                        "scene_id": i + 1,
-                        "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                        "description": p,
-                        "error": "无候选结果"
-                    })
-                    
-            except Exception as img_err:
-                print(f"❌ 场景 {i+1} 生成失败: {img_err}")
-                import traceback
-                traceback.print_exc()
-                # 单张生成失败的备选逻辑
-                generated_scenes.append({
-                    "scene_id": i + 1,
-                    "image_url": "https://images.unsplash.com/photo-1464822759023-fed622ff2c3b",
-                    "description": p,
-                    "error": str(img_err)
-                })
+        generated_scenes = await _generate_scene_images(prompts, keep_original)
 
         return {
             "status": "SUCCESS",
@@ -1508,9 +1871,7 @@ async def generate_image(request: ChatRequest):
         }
 
     except Exception as e:
-        print(f"❌ 图片生成失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("图片生成失败: %s", e)
         return {
             "status": "ERROR",
             "scenes": [],
@@ -1526,25 +1887,34 @@ class AvatarRequest(BaseModel):
 class DetectRolesRequest(BaseModel):
     text: str  # 用户输入的文本
 
-@app.post("/api/detect_roles")
-async def detect_roles(request: DetectRolesRequest):
+@app.post("/api/detect_roles", dependencies=[Depends(rate_limiter.limit("detect_roles"))])
+async def detect_roles(request: DetectRolesRequest, response: Response, bypass_cache: bool = Depends(cache_bypass)):
     """
     从用户输入的文本中识别人物角色
     使用 Gemini 模型分析文本，提取提到的人物
     """
     try:
         text = request.text
-        print(f"🔍 收到人物识别请求")
         
         if not text or text.strip() == '':
             return {
                 "status": "SUCCESS",
                 "roles": []
             }
-        
+
+        if ROLE_DETECT_MODE != "model":
+            with timed("detect_roles.local"):
+                detection = role_detector.detect(text)
+            if detection.confident or ROLE_DETECT_MODE == "local":
+                ROLE_DETECTIONS.inc(source="local")
+                response.headers["X-Cache"] = "LOCAL"
+                return {
+                    "status": "SUCCESS",
+                    "roles": detection.roles
+                }
+            logger.info("本地人物识别置信度低（%s），改用 Gemini", detection.reason)
+
         # 使用 Gemini 模型识别人物
-        text_model = genai.GenerativeModel(GEMINI_MODEL_ID)
-        
         prompt = f"""请从以下文本中识别出所有提到的人物角色。只返回人物名称，不要返回用户本人。
 
 要求：
@@ -1559,17 +1929,24 @@ async def detect_roles(request: DetectRolesRequest):
 
 请直接返回JSON数组，不要包含其他说明文字。"""
         
-        response = text_model.generate_content(prompt)
+        with timed("detect_roles.gemini"):
+            response_text, hit = await model_cache.cached(
+                "detect_roles", MODEL_CACHE_VERSIONS["detect_roles"], GEMINI_MODEL_ID, [prompt],
+                lambda: providers.text.generate([prompt]),
+                bypass=bypass_cache,
+            )
+        response.headers["X-Cache"] = "HIT" if hit else "MISS"
+        ROLE_DETECTIONS.inc(source="model")
         
         # 解析响应
-        response_text = response.text.strip()
+        response_text = response_text.strip()
         # 尝试提取JSON数组
         import re
         json_match = re.search(r'\[.*?\]', response_text, re.DOTALL)
         if json_match:
             import json
             roles = json.loads(json_match.group())
-            print(f"✅ 识别到 {len(roles)} 个人物: {roles}")
+            logger.info("识别到 %d 个人物", len(roles))
             return {
                 "status": "SUCCESS",
                 "roles": roles if isinstance(roles, list) else []
@@ -1578,39 +1955,31 @@ async def detect_roles(request: DetectRolesRequest):
             # 如果没有找到JSON，尝试按行分割
             lines = [line.strip() for line in response_text.split('\n') if line.strip()]
             roles = [line for line in lines if not line.startswith('#') and not line.startswith('//')]
-            print(f"✅ 识别到 {len(roles)} 个人物: {roles}")
+            logger.info("识别到 %d 个人物", len(roles))
             return {
                 "status": "SUCCESS",
                 "roles": roles[:10]  # 最多返回10个
             }
         
     except Exception as e:
-        print(f"❌ 人物识别异常: {str(e)}")
+        logger.exception("人物识别异常: %s", e)
         return {
             "status": "ERROR",
             "roles": [],
             "error": str(e)
         }
 
-@app.post("/api/generate_avatar")
-async def generate_avatar(request: AvatarRequest):
-    """
-    根据角色名称生成AI头像
-    使用 nano-banana-pro-preview 生成角色头像
-    """
-    try:
-        role_name = request.role
-        print(f"🎨 收到头像生成请求: {role_name}")
-        
-        if not role_name or role_name.strip() == '':
-            return {
-                "status": "ERROR",
-                "error": "角色名称不能为空"
-            }
-        
-        # 构建头像生成提示词 - 根据角色名生成差异化的头像
-        # 通过角色名推断外观特征，确保不同角色有不同外观
-        prompt = f"""Generate a unique anime-style avatar portrait. The character is named "{role_name}" (a Japanese person).
+# 同一个角色名（同一段提示词）的头像在所有 worker 之间共享，AVATAR_CACHE_DAYS 后过期
+AVATAR_CACHE_SECONDS = float(os.getenv("AVATAR_CACHE_DAYS", "30")) * 86400
+AVATAR_BATCH_MAX = int(os.getenv("AVATAR_BATCH_MAX", "10"))  # detect_roles 最多返回 10 个角色
+AVATAR_BATCH_CONCURRENCY = int(os.getenv("AVATAR_BATCH_CONCURRENCY", "3"))
+_avatar_inflight = SingleFlight()
+
+
+def _avatar_prompt(role_name: str) -> str:
+    # 构建头像生成提示词 - 根据角色名生成差异化的头像
+    # 通过角色名推断外观特征，确保不同角色有不同外观
+    return f"""Generate a unique anime-style avatar portrait. The character is named "{role_name}" (a Japanese person).
         
         IMPORTANT: The character's appearance must be UNIQUE and reflect their name/personality:
         - If the name suggests a senior/older person (先輩, 先生, 部長): mature face, professional look
@@ -1628,69 +1997,170 @@ async def generate_avatar(request: AvatarRequest):
         - Simple solid color background (NOT white - use a soft pastel color)
         - 512x512 pixels, high quality
         - The character should look like a real person you'd meet in Japan"""
+
+
+def _avatar_cache_key(role_name: str) -> str:
+    return "avatar:v1:" + hashlib.sha256(_avatar_prompt(role_name).encode("utf-8")).hexdigest()[:32]
+
+
+async def _generate_avatar_image(role_name: str) -> bytes:
+    """调用 nano-banana-pro-preview 生成头像并写入共享缓存；同一角色的并发请求共用一次生成"""
+    cache_key = _avatar_cache_key(role_name)
+
+    async def generate() -> bytes:
+        # 在共享任务里跑：发起的请求断开了，其他等待者照样拿到结果，头像也照样进缓存
+        logger.debug("正在生成头像: %s", redact(role_name))
+        with timed("avatar.generate"):
+            img_data_bytes = await providers.image.generate_image(_avatar_prompt(role_name))
+        await shared_state.aset(cache_key, img_data_bytes, ttl=AVATAR_CACHE_SECONDS)
+        return img_data_bytes
+
+    return await _avatar_inflight.do(cache_key, generate)
+
+
+@app.post("/api/generate_avatar", dependencies=[Depends(rate_limiter.limit("avatar"))])
+async def generate_avatar(request: AvatarRequest, response: Response, bypass_cache: bool = Depends(cache_bypass),
+                          keep_original: bool = False):
+    """
+    根据角色名称生成AI头像
+    使用 nano-banana-pro-preview 生成角色头像
+    Cache-Control: no-cache 时重新生成
+    缓存里是模型原图，返回前缩到 AVATAR_IMAGE_MAX_PX 并压缩；?keep_original=1 时附带原图
+    """
+    try:
+        role_name = request.role
         
-        # 调用 nano-banana-pro-preview 生成头像
-        image_gen_model = genai.GenerativeModel("nano-banana-pro-preview")
-        
-        print(f"🎨 正在生成头像: {role_name}")
-        response = image_gen_model.generate_content(prompt)
-        
-        # 提取图片数据
-        if response.candidates and len(response.candidates) > 0:
-            candidate = response.candidates[0]
-            if candidate.content and candidate.content.parts:
-                for part in candidate.content.parts:
-                    if hasattr(part, 'inline_data') and part.inline_data:
-                        img_data_bytes = part.inline_data.data
-                        # 将字节数据转换为 base64 字符串
-                        img_data_base64 = base64.b64encode(img_data_bytes).decode("utf-8")
-                        
-                        print(f"✅ 头像生成成功: {role_name}")
-                        return {
-                            "status": "SUCCESS",
-                            "image_base64": img_data_base64,
-                            "role": role_name
-                        }
+        if not role_name or role_name.strip() == '':
+            return {
+                "status": "ERROR",
+                "error": "角色名称不能为空"
+            }
         
-        # 如果没有找到图片数据，返回错误
-        print(f"⚠️ 头像生成失败: 未找到图片数据")
+        img_data_bytes = None if bypass_cache else await shared_state.aget(_avatar_cache_key(role_name))
+        response.headers["X-Cache"] = "HIT" if img_data_bytes else "MISS"
+        if img_data_bytes is None:
+            try:
+                img_data_bytes = await _generate_avatar_image(role_name)
+            except ImageGenerationError as img_err:
+                # 如果没有找到图片数据，返回错误
+                logger.warning("头像生成失败: %s", img_err)
+                return {
+                    "status": "ERROR",
+                    "error": "未能生成头像图片"
+                }
+
+        image = await image_optimizer.optimize(img_data_bytes, AVATAR_IMAGE_MAX_PX, keep_original, kind="avatar")
+        # 将字节数据转换为 base64 字符串
+        img_data_base64 = base64.b64encode(image.data).decode("utf-8")
+        logger.info("头像生成成功")
         return {
-            "status": "ERROR",
-            "error": "未能生成头像图片"
+            "status": "SUCCESS",
+            "image_base64": img_data_base64,
+            "role": role_name,
+            **image.report(),
         }
         
     except Exception as e:
-        print(f"❌ 头像生成异常: {str(e)}")
+        logger.exception("头像生成异常: %s", e)
         return {
             "status": "ERROR",
             "error": str(e)
         }
 
+
+class AvatarBatchRequest(BaseModel):
+    roles: list[str]  # detect_roles 返回的角色列表
+
+
+@app.post("/api/generate_avatars")
+async def generate_avatars(request: AvatarBatchRequest, http_request: Request,
+                           bypass_cache: bool = Depends(cache_bypass), keep_original: bool = False):
+    """
+    一次请求生成多个角色的头像（detect_roles 之后调用），逐行推送 NDJSON：
+    已缓存的角色立即返回，其余最多 AVATAR_BATCH_CONCURRENCY 个并发生成，谁先好谁先推
+    {"type": "avatar", "role", "status", "image_base64" + "mime_type" / "saved_bytes" | "error", "cached"}，
+    最后一行 {"type": "done", "roles", "cached", "generated", "failed"}。
+    限流按需要生成的角色数计费，每次生成各占一个上游名额。
+    """
+    roles = list(dict.fromkeys(r.strip() for r in request.roles if r and r.strip()))[:AVATAR_BATCH_MAX]
+    if bypass_cache:
+        cached = [None] * len(roles)
+    else:
+        cached = await asyncio.gather(*(shared_state.aget(_avatar_cache_key(r)) for r in roles))
+    hits = {role: img for role, img in zip(roles, cached) if img is not None}
+    misses = [role for role in roles if role not in hits]
+    caller = await rate_limiter.spend(http_request, "avatar", units=len(misses))
+
+    async def avatar_event(role: str, img_data_bytes: bytes, was_cached: bool) -> dict:
+        image = await image_optimizer.optimize(img_data_bytes, AVATAR_IMAGE_MAX_PX, keep_original, kind="avatar")
+        return {"type": "avatar", "role": role, "status": "SUCCESS", "cached": was_cached,
+                "image_base64": base64.b64encode(image.data).decode("utf-8"), **image.report()}
+
+    events: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(AVATAR_BATCH_CONCURRENCY)
+
+    async def generate(role: str):
+        event = {"type": "avatar", "role": role, "status": "ERROR", "error": "cancelled"}
+        try:
+            async with semaphore:
+                try:
+                    async with rate_limiter.slot(caller, "avatar"):
+                        img_data_bytes = await _generate_avatar_image(role)
+                    event = await avatar_event(role, img_data_bytes, False)
+                except ImageGenerationError as e:
+                    logger.warning("头像生成失败: %s", e)
+                    event = {"type": "avatar", "role": role, "status": "ERROR", "error": "未能生成头像图片"}
+                except QueueTimeout:
+                    event = {"type": "avatar", "role": role, "status": "ERROR", "error": "server_busy"}
+                except Exception as e:
+                    logger.exception("头像生成异常: %s", e)
+                    event = {"type": "avatar", "role": role, "status": "ERROR", "error": str(e)}
+        finally:
+            events.put_nowait(event)  # 每个角色都要报一次，否则 lines() 会一直等在 events.get()
+
+    tasks = [asyncio.ensure_future(generate(role)) for role in misses]
+
+    async def lines():
+        failed = 0
+        try:
+            for role, img_data_bytes in hits.items():
+                yield dumps(await avatar_event(role, img_data_bytes, True)) + b"\n"
+            for _ in tasks:
+                event = await events.get()
+                failed += event["status"] != "SUCCESS"
+                yield dumps(event) + b"\n"
+            logger.info("批量头像: %d 个角色, 缓存 %d, 生成 %d, 失败 %d",
+                        len(roles), len(hits), len(misses) - failed, failed)
+            yield dumps({"type": "done", "roles": len(roles), "cached": len(hits),
+                         "generated": len(misses) - failed, "failed": failed}) + b"\n"
+        finally:
+            for task in tasks:
+                task.cancel()  # 客户端断开时不再排队；已开始的生成在共享任务里跑完并写入缓存
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 class TranscribeRequest(BaseModel):
     audio_base64: str
     audio_mime_type: str = "audio/webm"
 
-@app.post("/api/transcribe")
-async def transcribe_audio(request: TranscribeRequest):
+@app.post("/api/transcribe", dependencies=[Depends(rate_limiter.limit("transcribe"))])
+async def transcribe_audio(request: TranscribeRequest, response: Response, bypass_cache: bool = Depends(cache_bypass)):
     """
     语音转写端点：将用户录制的音频转写为文字
     支持中文、日语、英语及多语言混合
     """
     try:
-        print(f"🎤 收到语音转写请求，音频大小={len(request.audio_base64)} 字符, mime={request.audio_mime_type}")
+        logger.debug("收到语音转写请求，音频大小=%d 字符, mime=%s", len(request.audio_base64), request.audio_mime_type)
         if not request.audio_base64:
             return {"status": "ERROR", "error": "未提供音频数据", "text": ""}
         
-        text_model = genai.GenerativeModel(GEMINI_MODEL_ID)
-        
-        # 将 base64 解码为 bytes，使用 Gemini SDK 的 Part 格式
-        audio_bytes = base64.b64decode(request.audio_base64)
-        audio_part = genai.protos.Part(
-            inline_data=genai.protos.Blob(
-                mime_type=request.audio_mime_type,
-                data=audio_bytes
-            )
-        )
+        # 接入录音（解码 + 内容哈希）；缓存键用原始录音的哈希，命中时连预处理 / 上传都省掉
+        recording = await audio_ingestor.add(request.audio_base64, request.audio_mime_type)
+
+        async def transcribe():
+            with timed("transcribe.audio_ingest"):
+                audio_part = await audio_ingestor.part(recording)
+            return await providers.text.generate([audio_part, prompt])
         
         prompt = """请仔细听这段语音，并将其转写为文字。
 要求：
@@ -1700,20 +2170,34 @@ async def transcribe_audio(request: TranscribeRequest):
 4. 只返回转写后的纯文字，不要添加任何说明或标点符号解释
 5. 如果完全听不到声音或无法识别，返回空字符串"""
         
-        response = text_model.generate_content([audio_part, prompt])
-        transcribed_text = response.text.strip()
-        print(f"✅ 语音转写成功: {transcribed_text[:100]}...")
-        return {"status": "SUCCESS", "text": transcribed_text}
+        with timed("transcribe.gemini"):
+            response_text, hit = await model_cache.cached(
+                "transcribe", MODEL_CACHE_VERSIONS["transcribe"], GEMINI_MODEL_ID,
+                [recording.mime_type, recording.audio_id, prompt],
+                transcribe,
+                bypass=bypass_cache,
+            )
+        response.headers["X-Cache"] = "HIT" if hit else "MISS"
+        transcribed_text = response_text.strip()
+        logger.info("语音转写成功: %s", redact(transcribed_text))
+        return {"status": "SUCCESS", "text": transcribed_text, "audio_id": recording.audio_id}
     except Exception as e:
-        print(f"❌ 语音转写失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("语音转写失败: %s", e)
         return {"status": "ERROR", "error": str(e), "text": ""}
 
 # ============================================================
 # Journal persistence endpoints
 # ============================================================
 
+# 相关日记检索：保存时本地算一次向量，按用户存成 float16 矩阵（内存映射），查询不调用 Gemini；
+# JOURNAL_INDEX=0 关闭
+journal_index = JournalIndex(
+    Path(os.getenv("JOURNAL_INDEX_DIR", str(Path(__file__).parent / "journal_vectors"))),
+    enabled=os.getenv("JOURNAL_INDEX", "1") == "1",
+)
+JOURNAL_RELATED_K = int(os.getenv("JOURNAL_RELATED_K", "5"))
+JOURNAL_RELATED_MAX_K = 50
+
 class JournalSaveRequest(BaseModel):
     date: str                             # "2026-03-21"
     title: str = ""
@@ -1737,9 +2221,23 @@ def _save_base64_file(b64: str, dest: Path, is_audio: bool = False):
         dest.write_bytes(data)
         return True
     except Exception as e:
-        print(f"Failed to save file {dest}: {e}")
+        logger.error("Failed to save file %s: %s", dest, e)
         return False
 
+async def _save_scene_image(b64: Optional[str], entry_dir: Path, rel: str, name: str) -> Optional[str]:
+    """Decode, optimize and write a scene image named after its real format; returns the uploads-relative path."""
+    if not b64:
+        return None
+    try:
+        data = base64.b64decode(b64)
+    except Exception as e:
+        logger.error("Failed to decode %s: %s", name, e)
+        return None
+    image = await image_optimizer.optimize(data, SCENE_IMAGE_MAX_PX, kind="scene")
+    filename = f"{name}.{image.extension if image.extension != 'bin' else 'png'}"
+    (entry_dir / filename).write_bytes(image.data)
+    return f"{rel}/{filename}"
+
 def _make_thumbnail(src_path: Path, thumb_path: Path, width: int = 240):
     """Create a resized thumbnail. Falls back to copying the original."""
     try:
@@ -1753,7 +2251,7 @@ def _make_thumbnail(src_path: Path, thumb_path: Path, width: int = 240):
         import shutil
         shutil.copy2(str(src_path), str(thumb_path))
     except Exception as e:
-        print(f"Thumbnail generation failed: {e}")
+        logger.warning("Thumbnail generation failed: %s", e)
         import shutil
         shutil.copy2(str(src_path), str(thumb_path))
 
@@ -1764,14 +2262,9 @@ async def save_journal(
     user_id: str = Depends(get_current_user_id),
 ):
     try:
-        conn = get_db()
-
         # Determine session_num for this date (per user)
-        row = conn.execute(
-            "SELECT COUNT(*) as cnt FROM journals WHERE date = ? AND user_id = ?",
-            (req.date, user_id),
-        ).fetchone()
-        session_num = (row["cnt"] if row else 0) + 1
+        counts = await journal_repo.session_counts(user_id, req.date)
+        session_num = counts.get(req.date, 0) + 1
         journal_id = f"{req.date}-{session_num}"
 
         entry_dir = UPLOADS_DIR / user_id / req.date / journal_id
@@ -1785,24 +2278,15 @@ async def save_journal(
             if _save_base64_file(req.podcast_audio_base64, audio_file, is_audio=True):
                 audio_path = f"{rel}/podcast.mp3"
 
-        scene_1_path = None
-        if req.scene_1_base64:
-            s1_file = entry_dir / "scene_1.png"
-            if _save_base64_file(req.scene_1_base64, s1_file):
-                scene_1_path = f"{rel}/scene_1.png"
-
-        scene_2_path = None
-        if req.scene_2_base64:
-            s2_file = entry_dir / "scene_2.png"
-            if _save_base64_file(req.scene_2_base64, s2_file):
-                scene_2_path = f"{rel}/scene_2.png"
+        # Scene images: already optimized by the image routes; older clients may still send PNG
+        scene_1_path = await _save_scene_image(req.scene_1_base64, entry_dir, rel, "scene_1")
+        scene_2_path = await _save_scene_image(req.scene_2_base64, entry_dir, rel, "scene_2")
 
         # Generate thumbnail from scene_1
         thumbnail_path = None
-        scene_1_file = entry_dir / "scene_1.png"
-        if scene_1_file.exists():
+        if scene_1_path:
             thumb_file = entry_dir / "thumbnail.png"
-            _make_thumbnail(scene_1_file, thumb_file)
+            _make_thumbnail(UPLOADS_DIR / scene_1_path, thumb_file)
             thumbnail_path = f"{rel}/thumbnail.png"
 
         # Process chat_turns: save reply audio files, strip base64 from stored JSON
@@ -1824,42 +2308,40 @@ async def save_journal(
                     turn_data["reply_audio_path"] = f"{rel}/reply_audio_{i}.mp3"
             chat_turns_for_db.append(turn_data)
 
-        conn.execute(
-            """INSERT INTO journals
-               (id, date, session_num, user_id, title, diary_ja, diary_zh, podcast_script,
-                podcast_audio_path, scene_1_path, scene_2_path, thumbnail_path,
-                entry_text, role, tone, rounds, created_at, chat_turns)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                journal_id,
-                req.date,
-                session_num,
-                user_id,
-                req.title,
-                req.diary_ja,
-                req.diary_zh,
-                json.dumps(req.podcast_script, ensure_ascii=False),
-                audio_path,
-                scene_1_path,
-                scene_2_path,
-                thumbnail_path,
-                req.entry_text,
-                req.role,
-                req.tone,
-                req.rounds,
-                datetime.now().isoformat(),
-                json.dumps(chat_turns_for_db, ensure_ascii=False),
-            ),
-        )
-        conn.commit()
-        conn.close()
+        await journal_repo.insert({
+            "id": journal_id,
+            "date": req.date,
+            "session_num": session_num,
+            "user_id": user_id,
+            "title": req.title,
+            "diary_ja": req.diary_ja,
+            "diary_zh": req.diary_zh,
+            "podcast_script": json.dumps(req.podcast_script, ensure_ascii=False),
+            "podcast_audio_path": audio_path,
+            "scene_1_path": scene_1_path,
+            "scene_2_path": scene_2_path,
+            "thumbnail_path": thumbnail_path,
+            "entry_text": req.entry_text,
+            "role": req.role,
+            "tone": req.tone,
+            "rounds": req.rounds,
+            "created_at": datetime.now().isoformat(),
+            "chat_turns": json.dumps(chat_turns_for_db, ensure_ascii=False),
+        })
+
+        # 向量只在保存时算一次；失败不影响保存，下次查询相关日记时会重建
+        if journal_index.enabled:
+            try:
+                with timed("journal_index.add"):
+                    await journal_index.add(user_id, journal_id, journal_text({"diary_ja": req.diary_ja, "entry_text": req.entry_text}))
+            except Exception as e:
+                FALLBACKS.inc(kind="journal_index.error")
+                logger.warning("日记向量写入失败: %s: %s", type(e).__name__, e)
 
-        print(f"✅ Journal saved: {journal_id}")
+        logger.info("Journal saved: %s", journal_id)
         return {"status": "SUCCESS", "id": journal_id}
     except Exception as e:
-        print(f"❌ Journal save failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Journal save failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -1870,13 +2352,7 @@ async def list_journals(
     user_id: str = Depends(get_current_user_id),
 ):
     try:
-        conn = get_db()
-        month_prefix = f"{year}-{str(month).zfill(2)}"
-        rows = conn.execute(
-            "SELECT id, date, session_num, rounds, thumbnail_path, title FROM journals WHERE date LIKE ? AND user_id = ? ORDER BY date, session_num",
-            (f"{month_prefix}%", user_id),
-        ).fetchall()
-        conn.close()
+        rows = await journal_repo.list_month(user_id, year, month)
 
         entries: dict[str, list] = {}
         for r in rows:
@@ -1892,8 +2368,298 @@ async def list_journals(
 
         return {"status": "SUCCESS", "entries": entries}
     except Exception as e:
-        print(f"❌ Journal list failed: {e}")
+        logger.exception("Journal list failed: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+JOURNAL_TIMELINE_PAGE = int(os.getenv("JOURNAL_TIMELINE_PAGE", "20"))
+JOURNAL_TIMELINE_MAX_PAGE = 100
+
+
+def _encode_cursor(row: dict) -> str:
+    raw = json.dumps([row["created_at"], row["id"]], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        created_at, journal_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(created_at, str) or not isinstance(journal_id, str):
+            raise ValueError
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return created_at, journal_id
+
+
+@app.get("/api/journal/timeline")
+async def journal_timeline(
+    cursor: Optional[str] = None,
+    limit: int = JOURNAL_TIMELINE_PAGE,
+    user_id: str = Depends(get_current_user_id),
+):
+    """
+    按创建时间倒序的无限滚动列表。next_cursor 原样传回取下一页，为 null 表示到底；
+    游标定位 (created_at, id)，第 N 页和第 1 页一样只走一次索引查找。
+    """
+    limit = max(1, min(limit, JOURNAL_TIMELINE_MAX_PAGE))
+    before = _decode_cursor(cursor) if cursor else None
+    try:
+        rows = await journal_repo.timeline(user_id, limit + 1, before)
+    except Exception as e:
+        logger.exception("Journal timeline failed: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    page = rows[:limit]
+    entries = [{
+        "id": r["id"],
+        "date": r["date"],
+        "session_num": r["session_num"],
+        "rounds": r["rounds"],
+        "title": r["title"],
+        "created_at": r["created_at"],
+        "thumbnail_url": f"/uploads/{r['thumbnail_path']}" if r["thumbnail_path"] else None,
+    } for r in page]
+    next_cursor = _encode_cursor(page[-1]) if len(rows) > limit else None
+    return {"status": "SUCCESS", "entries": entries, "next_cursor": next_cursor}
+
+
+@app.get("/api/journal/calendar")
+async def journal_calendar(
+    year: int,
+    user_id: str = Depends(get_current_user_id),
+):
+    """整年的日历概览（每天的篇数、总轮数、最新缩略图），一次索引查询，不用按月请求 list。"""
+    try:
+        rows = await journal_repo.calendar(user_id, year)
+        days = {
+            r["date"]: {
+                "entries": r["entries"],
+                "rounds": r["rounds"],
+                "thumbnail_url": f"/uploads/{r['thumbnail_path']}" if r["thumbnail_path"] else None,
+            }
+            for r in rows
+        }
+        return {"status": "SUCCESS", "year": year, "days": days}
+    except Exception as e:
+        logger.exception("Journal calendar failed: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ============================================================
+# Journal export / import (streaming zip archive)
+# ============================================================
+#
+# Archive layout:
+#   manifest.json                      {"version", "exported_at", "count"}
+#   journals/<id>.json                 one journals row (chat_turns / podcast_script as stored)
+#   uploads/<user>/<date>/<id>/<file>  media referenced by the row
+#
+# Export never holds more than one media file in memory; import spools the
+# upload to disk and hands journal_repo a lazy batch generator that it
+# consumes inside a single transaction.
+
+JOURNAL_ARCHIVE_VERSION = 1
+JOURNAL_ARCHIVE_BATCH = 200                       # rows per fetch / executemany
+JOURNAL_IMPORT_SPOOL_BYTES = 8 * 1024 * 1024      # spill uploaded archive to disk above this
+JOURNAL_IMPORT_MAX_BYTES = int(float(os.getenv("JOURNAL_IMPORT_MAX_MB", "512")) * 1024 * 1024)
+
+JOURNAL_MEDIA_COLUMNS = ("podcast_audio_path", "scene_1_path", "scene_2_path", "thumbnail_path")
+
+
+class _ZipChunkSink:
+    """Write-only, non-seekable file object; zipfile falls back to data descriptors."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._pos = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _journal_media_paths(record: dict) -> list[str]:
+    """All upload-relative media paths referenced by a journals row."""
+    paths = [record[c] for c in JOURNAL_MEDIA_COLUMNS if record.get(c)]
+    try:
+        turns = json.loads(record.get("chat_turns") or "[]")
+    except (TypeError, ValueError):
+        turns = []
+    for turn in turns:
+        if isinstance(turn, dict) and turn.get("reply_audio_path"):
+            paths.append(turn["reply_audio_path"])
+    return paths
+
+
+def _write_archive_record(zf: zipfile.ZipFile, record: dict):
+    zf.writestr(f"journals/{record['id']}.json", json.dumps(record, ensure_ascii=False))
+
+
+async def _iter_journal_archive(user_id: str):
+    """Yield a zip of every journal (plus media) for user_id, chunk by chunk."""
+    sink = _ZipChunkSink()
+    count = 0
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        async for rows in journal_repo.iter_user(user_id, JOURNAL_ARCHIVE_BATCH):
+            for record in rows:
+                _write_archive_record(zf, record)
+                for rel_path in _journal_media_paths(record):
+                    src = UPLOADS_DIR / rel_path
+                    if src.is_file():
+                        # mp3/png are already compressed; deflating them only burns CPU
+                        await run_in_threadpool(zf.write, src, f"uploads/{rel_path}", zipfile.ZIP_STORED)
+                        yield sink.drain()
+                count += 1
+            yield sink.drain()
+        zf.writestr("manifest.json", json.dumps({
+            "version": JOURNAL_ARCHIVE_VERSION,
+            "exported_at": datetime.now().isoformat(),
+            "count": count,
+        }))
+    yield sink.drain()
+    logger.info("Journal export finished: %d entries", count)
+
+
+@app.get("/api/journal/export")
+async def export_journals(user_id: str = Depends(get_current_user_id)):
+    filename = f"lifecho-journals-{datetime.now().strftime('%Y%m%d')}.zip"
+    return StreamingResponse(
+        _iter_journal_archive(user_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _archive_date(value) -> str:
+    """The record's date if it is a real YYYY-MM-DD day; it becomes a path component, so nothing else passes."""
+    try:
+        if isinstance(value, str) and calendar_date.fromisoformat(value).isoformat() == value:
+            return value
+    except ValueError:
+        pass
+    raise ValueError(f"invalid date {value!r}")
+
+
+def _upload_path(root: Path, rel: str) -> Path:
+    """UPLOADS_DIR / rel, resolved; raises ValueError if it would land outside root."""
+    path = (UPLOADS_DIR / rel).resolve()
+    if not path.is_relative_to(root):
+        raise ValueError(f"path outside uploads: {rel!r}")
+    return path
+
+
+def _iter_import_batches(zf: zipfile.ZipFile, user_id: str, session_counts: dict, created_dirs: list):
+    """Yield journals rows from the archive, renumbered for user_id, with media extracted.
+
+    Runs inside the repository's insert transaction (off the event loop).
+    """
+    names = set(zf.namelist())
+    journal_names = sorted(n for n in names if n.startswith("journals/") and n.endswith(".json"))
+    user_root = _upload_path(UPLOADS_DIR.resolve(), user_id)
+
+    def relocate(old_rel: str, new_rel: str) -> Optional[str]:
+        name = Path(old_rel).name
+        member = f"uploads/{old_rel}"
+        if name in ("", ".", "..") or member not in names:
+            return None
+        dest = _upload_path(user_root, f"{new_rel}/{name}")
+        with zf.open(member) as src, open(dest, "wb") as out:
+            shutil.copyfileobj(src, out)
+        return f"{new_rel}/{name}"
+
+    for start in range(0, len(journal_names), JOURNAL_ARCHIVE_BATCH):
+        batch = []
+        for name in journal_names[start:start + JOURNAL_ARCHIVE_BATCH]:
+            record = json.loads(zf.read(name))
+            try:
+                date = _archive_date(record.get("date"))
+            except ValueError as e:
+                raise ValueError(f"{name}: {e}")
+
+            # session_num continues after whatever the user already has on each date
+            session_num = session_counts.get(date, 0) + 1
+            session_counts[date] = session_num
+            journal_id = f"{date}-{session_num}"
+            new_rel = f"{user_id}/{date}/{journal_id}"
+            entry_dir = _upload_path(user_root, new_rel)
+            entry_dir.mkdir(parents=True, exist_ok=True)
+            created_dirs.append(entry_dir)
+
+            for col in JOURNAL_MEDIA_COLUMNS:
+                record[col] = relocate(record[col], new_rel) if record.get(col) else None
+
+            turns = json.loads(record.get("chat_turns") or "[]")
+            for turn in turns:
+                if isinstance(turn, dict) and turn.get("reply_audio_path"):
+                    turn["reply_audio_path"] = relocate(turn["reply_audio_path"], new_rel)
+            record["chat_turns"] = json.dumps(turns, ensure_ascii=False)
+
+            record.update(id=journal_id, session_num=session_num, user_id=user_id, date=date)
+            record["created_at"] = record.get("created_at") or datetime.now().isoformat()  # timeline key
+            batch.append(record)
+        yield batch
+
+
+def _remove_dirs(dirs: list[Path]):
+    root = UPLOADS_DIR.resolve()
+    for d in dirs:
+        if d.resolve().is_relative_to(root):
+            shutil.rmtree(d, ignore_errors=True)
+
+
+@app.post("/api/journal/import")
+async def import_journals(
+    request: Request,
+    user_id: str = Depends(get_current_user_id),
+):
+    """Body: a zip produced by /api/journal/export (sent as application/zip), at most JOURNAL_IMPORT_MAX_MB."""
+    too_large = HTTPException(status_code=413, detail="Journal archive too large")
+    if int(request.headers.get("content-length") or 0) > JOURNAL_IMPORT_MAX_BYTES:
+        raise too_large
+    spool = tempfile.SpooledTemporaryFile(max_size=JOURNAL_IMPORT_SPOOL_BYTES)
+    created_dirs: list[Path] = []
+    try:
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > JOURNAL_IMPORT_MAX_BYTES:  # chunked uploads carry no content-length
+                raise too_large
+            spool.write(chunk)
+        spool.seek(0)
+        with await run_in_threadpool(zipfile.ZipFile, spool) as zf:
+            session_counts = await journal_repo.session_counts(user_id)
+            imported = await journal_repo.insert_many(
+                _iter_import_batches(zf, user_id, session_counts, created_dirs)
+            )
+        logger.info("Journal import finished: %d entries", imported)
+        return {"status": "SUCCESS", "imported": imported}
+    except HTTPException:
+        raise
+    except (zipfile.BadZipFile, ValueError, KeyError) as e:
+        logger.warning("Journal import rejected: %s", e)
+        _remove_dirs(created_dirs)
+        raise HTTPException(status_code=400, detail=f"Invalid journal archive: {e!s}")
+    except JournalConflictError as e:
+        logger.warning("Journal import conflict: %s", e)
+        _remove_dirs(created_dirs)
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.exception("Journal import failed: %s", e)
+        _remove_dirs(created_dirs)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        spool.close()
 
 
 @app.get("/api/journal/{journal_id}")
@@ -1902,12 +2668,7 @@ async def get_journal(
     user_id: str = Depends(get_current_user_id),
 ):
     try:
-        conn = get_db()
-        row = conn.execute(
-            "SELECT * FROM journals WHERE id = ? AND user_id = ?",
-            (journal_id, user_id),
-        ).fetchone()
-        conn.close()
+        row = await journal_repo.get(user_id, journal_id)
 
         if not row:
             raise HTTPException(status_code=404, detail="Journal not found")
@@ -1946,10 +2707,114 @@ async def get_journal(
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Journal get failed: {e}")
+        logger.exception("Journal get failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/journal/{journal_id}/related")
+async def related_journals(
+    journal_id: str,
+    k: int = JOURNAL_RELATED_K,
+    user_id: str = Depends(get_current_user_id),
+):
+    """
+    和这篇日记最相似的 k 篇过去的日记（diary_ja + entry_text 的向量余弦相似度，从高到低）。
+    索引缺失、换了 embedder、或者没有这篇（保存前的旧日记、导入）时先从数据库重建一次。
+    """
+    if not journal_index.enabled:
+        raise HTTPException(status_code=503, detail="Related journals unavailable")
+    k = max(1, min(k, JOURNAL_RELATED_MAX_K))
+    try:
+        with timed("journal_index.search"):
+            matches = await journal_index.related(user_id, journal_id, k)
+        if matches is None:
+            if not await journal_repo.get(user_id, journal_id):
+                raise HTTPException(status_code=404, detail="Journal not found")
+            with timed("journal_index.rebuild"):
+                await journal_index.rebuild(user_id, journal_repo.iter_user(user_id, JOURNAL_ARCHIVE_BATCH))
+            matches = await journal_index.related(user_id, journal_id, k) or []
+        rows = await asyncio.gather(*(journal_repo.get(user_id, related_id) for related_id, _ in matches))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Journal related failed: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    entries = [{
+        "id": r["id"],
+        "date": r["date"],
+        "title": r["title"],
+        "score": round(score, 4),
+        "thumbnail_url": f"/uploads/{r['thumbnail_path']}" if r["thumbnail_path"] else None,
+    } for (_, score), r in zip(matches, rows) if r]
+    return {"status": "SUCCESS", "id": journal_id, "entries": entries}
+
+
+# ============================================================
+# Chat session sync (snapshot + JSON Patch deltas, see session_sync.py)
+# ============================================================
+
+# 大段 base64（回复音频、场景图）移出文档单独落盘，同步只写增量
+session_sync = SessionSync(
+    lambda: journal_repo,
+    Path(os.getenv("SESSION_MEDIA_DIR", str(Path(__file__).parent / "session_media"))),
+    compact_every=int(os.getenv("SESSION_COMPACT_EVERY", "32")),
+    compact_bytes=int(os.getenv("SESSION_COMPACT_BYTES", str(256 * 1024))),
+)
+
+
+class SessionReplaceRequest(BaseModel):
+    snapshot: dict
+
+
+class SessionPatchRequest(BaseModel):
+    base_version: int
+    ops: list[dict]  # RFC 6902: {"op": "add" | "remove" | "replace" | "move" | "copy" | "test", "path", ...}
+
+
+@app.get("/api/session")
+async def get_session(inline_media: bool = False, user_id: str = Depends(get_current_user_id)):
+    """当前会话快照；version 为 0 表示还没有。inline_media=1 时把 $media 句柄还原成 base64。"""
+    return {"status": "SUCCESS", **await session_sync.get(user_id, inline_media)}
+
+
+@app.put("/api/session")
+async def replace_session(req: SessionReplaceRequest, user_id: str = Depends(get_current_user_id)):
+    """整体覆盖（首次同步，或 409 之后重新对齐）。"""
+    version = await session_sync.put(user_id, req.snapshot)
+    return {"status": "SUCCESS", "version": version}
+
+
+@app.patch("/api/session")
+async def patch_session(req: SessionPatchRequest, user_id: str = Depends(get_current_user_id)):
+    """在 base_version 上应用增量；版本已前进时返回 409 和当前版本，客户端 GET 后重做或直接 PUT。"""
+    try:
+        version = await session_sync.patch(user_id, req.base_version, req.ops)
+    except SessionConflict as e:
+        raise HTTPException(status_code=409, detail={"error": "version_conflict", "version": e.version})
+    except PatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"status": "SUCCESS", "version": version}
+
+
+@app.delete("/api/session")
+async def delete_session(user_id: str = Depends(get_current_user_id)):
+    await session_sync.delete(user_id)
+    return {"status": "SUCCESS"}
+
+
+@app.get("/api/session/media/{media_id}")
+async def get_session_media(media_id: str, user_id: str = Depends(get_current_user_id)):
+    """快照里 {"$media": id} 句柄对应的原始字节（内容寻址，可长期缓存）。"""
+    path = session_sync.media_path(user_id, media_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    with open(path, "rb") as f:
+        mime = sniff_mime(f.read(12))
+    return FileResponse(path, media_type=mime, headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+
+IMPORT_SECONDS = round(time.perf_counter() - _IMPORT_STARTED, 3)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
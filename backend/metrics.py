@@ -0,0 +1,274 @@
+"""
+In-process metrics with Prometheus text exposition.
+
+    with timed("chat.gemini"):
+        response = model.generate_content(...)
+    FALLBACKS.inc(kind="chat.json_regex_extract")
+
+timed() records into lifecho_stage_seconds{stage=...} and counts exceptions
+in lifecho_stage_errors_total. With OTEL_ENABLED=1 it also opens an
+OpenTelemetry span (a no-op unless an SDK/exporter is configured).
+MetricsMiddleware records lifecho_http_request_seconds per route template.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self) -> list[str]:
+        lines = self.header()
+        for key, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{_label_str(self.label_names, key)} {value:g}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [bucket counts..., +Inf count, sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: list(v) for k, v in self._series.items()}
+
+    def expose(self) -> list[str]:
+        lines = self.header()
+        for key, series in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_label_str(self.label_names, key, le)} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_str(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.label_names, key)} {series[-1]:g}")
+            lines.append(f"{self.name}_count{_label_str(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "lifecho_http_request_seconds", "HTTP request latency by route template", ("method", "route", "status"))
+STAGE_SECONDS = REGISTRY.histogram(
+    "lifecho_stage_seconds", "Latency of pipeline stages and upstream calls", ("stage",))
+STAGE_ERRORS = REGISTRY.counter(
+    "lifecho_stage_errors_total", "Exceptions raised inside a timed stage", ("stage", "error"))
+RETRIES = REGISTRY.counter(
+    "lifecho_retries_total", "Retried upstream calls", ("operation",))
+HEDGES = REGISTRY.counter(
+    "lifecho_hedged_requests_total", "Hedged second requests that completed first (won) or lost", ("operation", "outcome"))
+CIRCUIT_STATE = REGISTRY.gauge(
+    "lifecho_circuit_state", "Upstream circuit breaker state (0 closed, 1 half-open, 2 open)", ("circuit",))
+CIRCUIT_REJECTIONS = REGISTRY.counter(
+    "lifecho_circuit_rejections_total", "Calls rejected while a circuit was open", ("circuit",))
+RATE_LIMITED = REGISTRY.counter(
+    "lifecho_rate_limited_total", "Requests rejected by admission control (429 bucket / 503 queue timeout)",
+    ("route", "reason"))
+MODEL_CACHE_REQUESTS = REGISTRY.counter(
+    "lifecho_model_cache_requests_total", "Model output cache lookups (hit / miss / bypass)", ("route", "result"))
+MODEL_CACHE_BYTES = REGISTRY.gauge(
+    "lifecho_model_cache_bytes", "Bytes stored in the model output cache")
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "lifecho_admission_queue_depth", "Requests waiting in the fair queue for an upstream slot")
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "lifecho_admission_wait_seconds", "Time spent waiting in the fair queue")
+AUDIO_PREPROCESS_BYTES = REGISTRY.counter(
+    "lifecho_audio_preprocess_bytes_total", "Recording bytes before (in) / after (out) preprocessing", ("stage",))
+AUDIO_INGEST = REGISTRY.counter(
+    "lifecho_audio_ingest_total", "Recordings turned into model input (inline / upload / reused)", ("mode",))
+ROLE_DETECTIONS = REGISTRY.counter(
+    "lifecho_role_detections_total", "detect_roles answers by source (local / model)", ("source",))
+TTS_CACHE_REQUESTS = REGISTRY.counter(
+    "lifecho_tts_cache_requests_total", "Speech synthesis lookups (memory / disk / shared / miss)", ("result",))
+TTS_CACHE_HIT_RATIO = REGISTRY.gauge(
+    "lifecho_tts_cache_hit_ratio", "Share of speech synthesis requests answered without calling TTS")
+TTS_CACHE_SAVED_BYTES = REGISTRY.counter(
+    "lifecho_tts_cache_saved_bytes_total", "MP3 bytes served from the speech cache instead of synthesized")
+TTS_CACHE_BYTES = REGISTRY.gauge(
+    "lifecho_tts_cache_bytes", "Bytes held by the speech cache", ("tier",))
+RESPONSE_BYTES = REGISTRY.counter(
+    "lifecho_response_bytes_total", "Response body bytes before / after compression", ("encoding", "stage"))
+RESPONSE_COMPRESSION = REGISTRY.counter(
+    "lifecho_response_compression_total", "Compression decisions (gzip / br / skipped reason)", ("result",))
+HISTORY_COMPACTION = REGISTRY.counter(
+    "lifecho_history_compaction_total", "Rolling history summaries (full / incremental / reused)", ("result",))
+IMAGE_OPTIMIZE_BYTES = REGISTRY.counter(
+    "lifecho_image_optimize_bytes_total", "Generated image bytes before (in) / after (out) optimization",
+    ("kind", "stage"))
+SPECULATIVE = REGISTRY.counter(
+    "lifecho_speculative_total",
+    "Speculative finalization work (started / hit / joined / discarded / failed)", ("kind", "result"))
+FALLBACKS = REGISTRY.counter(
+    "lifecho_fallbacks_total", "Degraded-path results (JSON repair, placeholder images, error payloads)", ("kind",))
+
+_tracer = None
+if os.getenv("OTEL_ENABLED") == "1":
+    try:
+        from opentelemetry import trace
+        _tracer = trace.get_tracer("lifecho")
+    except ImportError:
+        _tracer = None
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block into lifecho_stage_seconds{stage}; exceptions are counted and re-raised."""
+    span_cm = _tracer.start_as_current_span(stage) if _tracer is not None else None
+    if span_cm is not None:
+        span_cm.__enter__()
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        STAGE_ERRORS.inc(stage=stage, error=type(e).__name__)
+        if span_cm is not None:
+            span_cm.__exit__(type(e), e, e.__traceback__)
+            span_cm = None
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        if span_cm is not None:
+            span_cm.__exit__(None, None, None)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency under the matched route template (not the raw path)."""
+
+    def __init__(self, app, exclude: tuple = ("/metrics",)):
+        self.app = app
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.exclude:
+            return await self.app(scope, receive, send)
+
+        status = {"code": 500}
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=scope.get("method", ""),
+                route=getattr(route, "path", None) or "unmatched",
+                status=str(status["code"]),
+            )
+
+
+def stage_summary(stage_prefix: Optional[str] = None) -> dict:
+    """{stage: {"count", "mean_ms"}} — handy for benchmarks and debugging."""
+    out = {}
+    for key, series in STAGE_SECONDS.snapshot().items():
+        stage = key[0]
+        if stage_prefix and not stage.startswith(stage_prefix):
+            continue
+        count = sum(series[:-1])
+        out[stage] = {"count": count, "mean_ms": round(series[-1] / count * 1000, 3) if count else 0.0}
+    return out
@@ -0,0 +1,172 @@
+"""
+Persistent cache for deterministic model outputs.
+
+detect_roles, transcribe, summarize and refine_summary are pure functions of
+their prompt: the same seed text / audio bytes / history gives an equivalent
+answer, and users bouncing between pages replay them. Entries are keyed by
+
+    sha256(route, template version, model id, rendered prompt parts)
+
+so any change to the prompt wording or the request content is a miss by
+construction; bump the route's version to drop old entries explicitly.
+
+Storage is a small SQLite file (MODEL_CACHE_PATH) with a TTL and a
+size-bounded LRU (accessed_at). Only outputs that pass the caller's
+validator are stored, so fallback / error payloads are never cached.
+Clients force regeneration with `Cache-Control: no-cache`.
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from metrics import MODEL_CACHE_BYTES, MODEL_CACHE_REQUESTS
+
+logger = logging.getLogger("lifecho.model_cache")
+
+
+def cache_key(route: str, version: str, model_id: str, parts: list) -> str:
+    h = hashlib.sha256()
+    for item in (route, version, model_id, *parts):
+        data = item if isinstance(item, bytes) else str(item).encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))  # length-prefixed: ("ab", "c") != ("a", "bc")
+        h.update(data)
+    return h.hexdigest()
+
+
+class ModelOutputCache:
+    def __init__(self, path: Path, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 7 * 86400,
+                 enabled: bool = True):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._total = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS model_cache (
+                    key TEXT PRIMARY KEY,
+                    route TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_model_cache_lru ON model_cache(accessed_at)")
+            conn.commit()
+            self._total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM model_cache").fetchone()[0]
+            MODEL_CACHE_BYTES.set(self._total)
+            self._conn = conn
+        return self._conn
+
+    # --- sync implementations, always called via asyncio.to_thread ---
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            conn = self._db()
+            row = conn.execute("SELECT value, size, created_at FROM model_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, size, created_at = row
+            if now - created_at > self.ttl:
+                conn.execute("DELETE FROM model_cache WHERE key = ?", (key,))
+                self._total -= size
+            else:
+                conn.execute("UPDATE model_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            MODEL_CACHE_BYTES.set(self._total)
+            return value if now - created_at <= self.ttl else None
+
+    def _put(self, key: str, route: str, value: str):
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes // 10:
+            return  # one entry may not take over the cache
+        with self._lock:
+            conn = self._db()
+            old = conn.execute("SELECT size FROM model_cache WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO model_cache (key, route, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, route, value, size, now, now),
+            )
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict(conn, now)
+            conn.commit()
+            MODEL_CACHE_BYTES.set(self._total)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Drop expired rows, then least recently used ones down to 90% of max_bytes."""
+        conn.execute("DELETE FROM model_cache WHERE created_at < ?", (now - self.ttl,))
+        self._total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM model_cache").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        if self._total <= target:
+            return
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM model_cache ORDER BY accessed_at").fetchall():
+            if self._total <= target:
+                break
+            conn.execute("DELETE FROM model_cache WHERE key = ?", (key,))
+            self._total -= size
+            evicted += 1
+        logger.info("model cache evicted %d entries, %d bytes left", evicted, self._total)
+
+    # --- async API ---
+
+    async def cached(
+        self,
+        route: str,
+        version: str,
+        model_id: str,
+        parts: list,
+        compute: Callable[[], Awaitable[str]],
+        validate: Optional[Callable[[str], Any]] = None,
+        bypass: bool = False,
+    ) -> tuple[str, bool]:
+        """Return (text, hit). compute() runs on a miss; its result is stored if validate() doesn't raise."""
+        if not self.enabled:
+            return await compute(), False
+        key = cache_key(route, version, model_id, parts)
+        if bypass:
+            MODEL_CACHE_REQUESTS.inc(route=route, result="bypass")
+        else:
+            try:
+                value = await asyncio.to_thread(self._get, key)
+            except sqlite3.Error as e:
+                logger.warning("model cache read failed: %s", e)
+                value = None
+            if value is not None:
+                MODEL_CACHE_REQUESTS.inc(route=route, result="hit")
+                return value, True
+            MODEL_CACHE_REQUESTS.inc(route=route, result="miss")
+
+        value = await compute()
+        try:
+            if validate is not None:
+                validate(value)
+        except Exception:
+            return value, False  # let the route's own error handling see it; never cache it
+        try:
+            await asyncio.to_thread(self._put, key, route, value)
+        except sqlite3.Error as e:
+            logger.warning("model cache write failed: %s", e)
+        return value, False
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
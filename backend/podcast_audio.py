@@ -0,0 +1,342 @@
+"""
+Podcast audio assembly: TTS clips joined at MP3 frame boundaries, written to
+disk as they come in, served while still being written.
+
+Concatenating the raw TTS responses left every clip's ID3 / Xing header in the
+middle of the stream (players report the first clip's duration, some glitch
+at the seams) and put the next speaker right on top of the last syllable.
+Here each clip is reduced to its audio frames, speakers are separated by
+silent frames in the clip's own format, and the result is appended to
+
+    PODCAST_AUDIO_DIR/<podcast_id>.mp3.part  ->  <podcast_id>.mp3 when complete
+
+Lines are synthesized up to max_parallel ahead and written strictly in order,
+so `GET /api/podcast_audio/<id>.mp3` can start streaming audio/mpeg after the
+first line while the rest is still being synthesized. The id is a hash of
+the script, voices and gaps, so the same podcast is only ever assembled once.
+With several workers sharing the directory, the worker that creates the
+.part file (O_EXCL) assembles it; the others follow the file on disk.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+from metrics import FALLBACKS
+
+logger = logging.getLogger("lifecho.podcast")
+
+# Layer III bitrates (kbps) by bitrate index, and sample rates by version
+_BITRATES = {
+    "1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    "2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {"1": [44100, 48000, 32000], "2": [22050, 24000, 16000], "2.5": [11025, 12000, 8000]}
+_VERSIONS = {0b00: "2.5", 0b10: "2", 0b11: "1"}
+_CHUNK = 64 * 1024
+_PODCAST_ID = re.compile(r"[0-9a-f]{32}")
+_REMOTE_POLL_SECONDS = 0.2
+
+
+@dataclass(frozen=True)
+class FrameFormat:
+    version: str
+    sample_rate: int
+    bitrate: int       # kbps
+    mono: bool
+    header: bytes      # the first frame's header, reused for silence
+
+    @property
+    def samples_per_frame(self) -> int:
+        return 1152 if self.version == "1" else 576
+
+    @property
+    def frame_length(self) -> int:
+        coefficient = 144 if self.version == "1" else 72
+        return coefficient * self.bitrate * 1000 // self.sample_rate
+
+
+def _parse_header(data: bytes, i: int) -> Optional[tuple[FrameFormat, int, int]]:
+    """(format, frame length, side info offset) for a Layer III frame header at data[i], else None."""
+    if i + 4 > len(data) or data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2, b3 = data[i + 1], data[i + 2], data[i + 3]
+    version = _VERSIONS.get((b1 >> 3) & 0b11)
+    if version is None or (b1 >> 1) & 0b11 != 0b01:  # reserved version / not Layer III
+        return None
+    bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 0b11
+    if bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = _BITRATES["1" if version == "1" else "2"][bitrate_index]
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    mono = b3 >> 6 == 0b11
+    fmt = FrameFormat(version, sample_rate, bitrate, mono, bytes(data[i:i + 4]))
+    length = fmt.frame_length + ((b2 >> 1) & 1)
+    crc = 0 if b1 & 1 else 2
+    return fmt, length, 4 + crc
+
+
+def _side_info_length(fmt: FrameFormat) -> int:
+    if fmt.version == "1":
+        return 17 if fmt.mono else 32
+    return 9 if fmt.mono else 17
+
+
+def _skip_id3v2(data: bytes) -> int:
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)  # syncsafe integer
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def mp3_frames(data: bytes) -> Iterator[tuple[FrameFormat, bytes]]:
+    """Audio frames of an MP3 file: ID3 tags, Xing / Info / VBRI header frames and junk are dropped."""
+    i = _skip_id3v2(data)
+    while i < len(data):
+        parsed = _parse_header(data, i)
+        if parsed is None:
+            i = data.find(b"\xff", i + 1)
+            if i < 0:
+                return
+            continue
+        fmt, length, side_info = parsed
+        end = i + length
+        # a false sync inside junk: require the next frame (or the end of data) right after this one
+        if end > len(data) or (end < len(data) and _parse_header(data, end) is None and data[end:end + 3] != b"TAG"):
+            i = data.find(b"\xff", i + 1)
+            if i < 0:
+                return
+            continue
+        tag = i + side_info + _side_info_length(fmt)
+        if data[tag:tag + 4] not in (b"Xing", b"Info") and data[i + 36:i + 40] != b"VBRI":
+            yield fmt, bytes(data[i:end])
+        i = end
+
+
+def silence(fmt: FrameFormat, seconds: float) -> bytes:
+    """Silent frames in fmt: zeroed side info means no main data and zero gain in every granule."""
+    header = bytearray(fmt.header)
+    header[1] |= 0x01    # no CRC
+    header[2] &= ~0x02   # no padding
+    frame = bytes(header) + b"\x00" * (fmt.frame_length - 4)
+    count = round(seconds * fmt.sample_rate / fmt.samples_per_frame)
+    return frame * count
+
+
+def podcast_id(profile: str, lines: list[tuple[str, str, str]], gaps: tuple[float, float]) -> str:
+    payload = json.dumps([profile, lines, gaps], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+@dataclass
+class PodcastJob:
+    podcast_id: str
+    part_path: Path
+    path: Path
+    total_lines: int
+    written_lines: int = 0
+    skipped_lines: int = 0
+    bytes_written: int = 0
+    done: bool = False
+    error: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+    task: Optional[asyncio.Task] = None
+    remote: bool = False  # being assembled by another worker process
+    _tick: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def _notify(self):
+        tick, self._tick = self._tick, asyncio.Event()
+        tick.set()
+
+    def _refresh(self):
+        # a remote job is done once the .part is gone: renamed (finished) or removed (failed)
+        if self.remote and not self.done and not self.part_path.exists():
+            self.done = True
+            if not self.path.exists():
+                self.error = "assembly failed in another worker"
+
+    async def wait(self) -> "PodcastJob":
+        while not self.done:
+            if self.remote:
+                await asyncio.sleep(_REMOTE_POLL_SECONDS)
+                self._refresh()
+            else:
+                await self._tick.wait()
+        return self
+
+
+class PodcastAssembler:
+    def __init__(self, directory: Path, synthesize: Callable[[str, str], Awaitable[bytes]],
+                 speaker_gap: float = 0.45, line_gap: float = 0.15, max_parallel: int = 3,
+                 max_files: int = 64, stale_seconds: float = 120.0):
+        self.directory = Path(directory)
+        self.synthesize = synthesize
+        self.speaker_gap = speaker_gap
+        self.line_gap = line_gap
+        self.max_parallel = max_parallel
+        self.max_files = max_files
+        self.stale_seconds = stale_seconds  # a .part untouched this long belongs to a dead worker
+        self._jobs: dict[str, PodcastJob] = {}
+
+    def _paths(self, podcast_id: str) -> tuple[Path, Path]:
+        path = self.directory / f"{podcast_id}.mp3"
+        return path.with_name(path.name + ".part"), path
+
+    def start(self, profile: str, lines: list[tuple[str, str, str]]) -> PodcastJob:
+        """lines: (speaker, voice_name, text). Returns the running, finished or newly started job."""
+        pid = podcast_id(profile, lines, (self.speaker_gap, self.line_gap))
+        job = self._jobs.get(pid)
+        if job is not None and job.error is None:
+            return job
+        part_path, path = self._paths(pid)
+        job = PodcastJob(pid, part_path, path, total_lines=len(lines))
+        self._jobs[pid] = job
+        if path.exists():
+            job.done = True
+            job.written_lines = len(lines)
+            job.bytes_written = path.stat().st_size
+            path.touch()
+            return job
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd = self._claim(part_path)
+        if fd is None:
+            job.remote = True
+            return job
+        job.task = asyncio.ensure_future(self._assemble(job, lines, fd))
+        return job
+
+    def _claim(self, part_path: Path) -> Optional[int]:
+        """Create the .part file exclusively; None when another worker is already writing it."""
+        for _ in range(2):
+            try:
+                return os.open(part_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    if time.time() - part_path.stat().st_mtime < self.stale_seconds:
+                        return None
+                    part_path.unlink()
+                except FileNotFoundError:
+                    pass  # finished or removed meanwhile: try again
+        return None
+
+    def get(self, podcast_id: str) -> Optional[PodcastJob]:
+        if not _PODCAST_ID.fullmatch(podcast_id):
+            return None
+        job = self._jobs.get(podcast_id)
+        if job is not None:
+            return job
+        part_path, path = self._paths(podcast_id)
+        if path.exists():
+            return PodcastJob(podcast_id, part_path, path, total_lines=0, done=True,
+                              bytes_written=path.stat().st_size)
+        if part_path.exists():
+            return PodcastJob(podcast_id, part_path, path, total_lines=0, remote=True)
+        return None
+
+    async def _assemble(self, job: PodcastJob, lines: list[tuple[str, str, str]], fd: int):
+        slots = asyncio.Semaphore(self.max_parallel)
+
+        async def clip(voice_name: str, text: str) -> bytes:
+            async with slots:
+                return await self.synthesize(text, voice_name)
+
+        tasks = [asyncio.ensure_future(clip(voice, text)) for _, voice, text in lines]
+        previous_speaker, fmt = None, None
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for (speaker, _, text), task in zip(lines, tasks):
+                    try:
+                        data = await task
+                    except Exception as e:
+                        # one bad line should not cost the listener the whole podcast
+                        job.skipped_lines += 1
+                        FALLBACKS.inc(kind="podcast.line_skipped")
+                        logger.warning("播客第 %d 行合成失败，跳过: %s", job.written_lines + job.skipped_lines, e)
+                        continue
+                    frames = list(mp3_frames(data))
+                    if not frames:
+                        job.skipped_lines += 1
+                        FALLBACKS.inc(kind="podcast.line_skipped")
+                        logger.warning("播客第 %d 行不是有效的 MP3，跳过", job.written_lines + job.skipped_lines)
+                        continue
+                    chunks = []
+                    if fmt is not None:
+                        chunks.append(silence(fmt, self.speaker_gap if speaker != previous_speaker else self.line_gap))
+                    fmt = frames[0][0]
+                    chunks.extend(frame for _, frame in frames)
+                    payload = b"".join(chunks)
+                    await asyncio.to_thread(self._append, f, payload)
+                    job.bytes_written += len(payload)
+                    job.written_lines += 1
+                    previous_speaker = speaker
+                    job._notify()
+            if job.written_lines == 0:
+                raise RuntimeError("播客脚本中没有任何一行合成成功")
+            job.part_path.replace(job.path)
+            logger.info("播客音频完成: id=%s, %d 行（跳过 %d）, %d 字节, %.2fs", job.podcast_id, job.written_lines,
+                        job.skipped_lines, job.bytes_written, time.monotonic() - job.started_at)
+        except BaseException as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.part_path.unlink(missing_ok=True)
+            for task in tasks:
+                task.cancel()
+            if not isinstance(e, Exception):
+                raise
+            logger.error("播客音频合成失败: %s", job.error)
+        finally:
+            job.done = True
+            job._notify()
+            self._evict()
+
+    @staticmethod
+    def _append(f, payload: bytes):
+        f.write(payload)
+        f.flush()
+
+    async def stream(self, job: PodcastJob) -> AsyncIterator[bytes]:
+        """The podcast's bytes as they are written; ends when the job is done."""
+        path = job.path if job.done else job.part_path
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            f = open(job.path, "rb")  # finished between the check and the open
+        try:
+            while True:
+                job._refresh()
+                tick, done = job._tick, job.done  # taken before the read so no append is missed
+                chunk = await asyncio.to_thread(f.read, _CHUNK)
+                if chunk:
+                    yield chunk
+                elif done:
+                    return
+                elif job.remote:
+                    await asyncio.sleep(_REMOTE_POLL_SECONDS)
+                else:
+                    await tick.wait()
+        finally:
+            f.close()
+
+    def _evict(self):
+        files = sorted(self.directory.glob("*.mp3"), key=lambda p: p.stat().st_mtime)
+        for path in files[:max(0, len(files) - self.max_files)]:
+            job = self._jobs.pop(path.stem, None)
+            if job is not None and not job.done:
+                self._jobs[path.stem] = job
+                continue
+            path.unlink(missing_ok=True)
+        for pid in [pid for pid, job in self._jobs.items() if job.done and job.error is None and not job.path.exists()]:
+            del self._jobs[pid]
+
+    async def close(self):
+        for job in self._jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
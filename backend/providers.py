@@ -0,0 +1,490 @@
+"""
+Upstream model providers.
+
+Routes never call google.generativeai / google.cloud.texttospeech directly;
+they go through three small async interfaces so the real backends can be
+swapped for deterministic local fakes (LIFECHO_PROVIDERS=fake) in load
+tests and offline development:
+
+    text   – Gemini text / multimodal generation (JSON mode, chat history)
+    image  – Gemini image generation (nano-banana)
+    speech – Google Cloud TTS, MP3 output
+
+The SDK calls are blocking, so the real providers run them in worker threads.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Optional
+
+from metrics import FALLBACKS
+
+
+@dataclass
+class AudioPart:
+    """Inline audio input for multimodal prompts."""
+    mime_type: str
+    data: bytes
+
+
+class UpstreamError(Exception):
+    """An upstream call failed in a way that is worth retrying (timeouts, 429/5xx)."""
+    retryable = True
+
+
+class EmptyResponseError(ValueError):
+    """The model answered but returned no usable text (empty or blocked candidates)."""
+
+
+class FileUploadUnsupportedError(Exception):
+    """The text provider has no file API; callers send the bytes inline instead."""
+
+
+class ImageGenerationError(Exception):
+    """The image model returned no image; the message says why."""
+
+
+class SpeechUnavailableError(Exception):
+    """TTS is not configured (missing / invalid credentials)."""
+
+
+class TextProvider(ABC):
+    @abstractmethod
+    async def generate(
+        self,
+        contents: list,
+        *,
+        system_instruction: Optional[str] = None,
+        history: Optional[list[dict]] = None,
+        json_mode: bool = False,
+        hedge: bool = False,
+    ) -> str:
+        """Return the model's text. contents items are str or AudioPart (or an uploaded file handle).
+
+        history (gemini format: [{"role", "parts"}]) continues a chat session;
+        None means a single generate call. hedge marks a latency-critical call
+        (see resilience.py); plain providers ignore it.
+        """
+
+    async def stream(
+        self,
+        contents: list,
+        *,
+        system_instruction: Optional[str] = None,
+        history: Optional[list[dict]] = None,
+        json_mode: bool = False,
+        hedge: bool = False,
+    ) -> AsyncIterator[str]:
+        """Yield the answer in pieces as the model produces it (concatenated, they equal generate()).
+
+        Providers without streaming yield the whole answer once. hedge as for generate().
+        """
+        yield await self.generate(contents, system_instruction=system_instruction, history=history,
+                                  json_mode=json_mode, hedge=hedge)
+
+    async def upload_file(self, path: str, mime_type: Optional[str] = None) -> Any:
+        """Upload a local file through the model's file API; the handle goes into contents like an AudioPart.
+
+        Providers without a file API keep this default, and callers fall back to inline AudioParts.
+        """
+        raise FileUploadUnsupportedError(type(self).__name__)
+
+
+class ImageProvider(ABC):
+    @abstractmethod
+    async def generate_image(self, prompt: str) -> bytes:
+        """Return encoded image bytes or raise ImageGenerationError."""
+
+
+class SpeechProvider(ABC):
+    # everything besides (voice, text) that changes the audio; part of the speech cache key
+    profile: str = "default"
+
+    @abstractmethod
+    async def synthesize(self, text: str, voice_name: str) -> bytes:
+        """Return MP3 bytes for text spoken with voice_name (ja-JP)."""
+
+
+@dataclass
+class Providers:
+    text: TextProvider
+    image: ImageProvider
+    speech: SpeechProvider
+
+
+# ------------------------------------------------------------
+# Real backends
+# ------------------------------------------------------------
+
+def _response_text(response) -> str:
+    # response.text raises when candidates are empty or blocked; fall back to the first part
+    try:
+        text = response.text
+    except (IndexError, ValueError, AttributeError):
+        text = None
+        try:
+            if response.candidates:
+                c = response.candidates[0]
+                if c.content and c.content.parts:
+                    text = c.content.parts[0].text
+                    FALLBACKS.inc(kind="gemini.text_via_candidates")
+        except (IndexError, ValueError, AttributeError):
+            text = None
+    if not text:
+        raise EmptyResponseError("模型未返回有效文本（candidates 为空或被屏蔽）")
+    return text
+
+
+class GeminiTextProvider(TextProvider):
+    def __init__(self, genai, model_id: str):
+        self._genai = genai  # startup.LazyModule, configured on first use
+        self.model_id = model_id
+
+    def _to_part(self, item):
+        if isinstance(item, AudioPart):
+            return self._genai.protos.Part(
+                inline_data=self._genai.protos.Blob(mime_type=item.mime_type, data=item.data)
+            )
+        return item
+
+    def _request(self, contents, system_instruction, history, json_mode, stream=False):
+        model = self._genai.GenerativeModel(model_name=self.model_id, system_instruction=system_instruction)
+        parts = [self._to_part(c) for c in contents]
+        config = {"response_mime_type": "application/json"} if json_mode else None
+        if history is None:
+            # generate_content, not ChatSession: send_message() indexes candidates[0]
+            # internally and raises an IndexError we cannot catch on empty responses
+            return model.generate_content(parts, generation_config=config, stream=stream)
+        return model.start_chat(history=history).send_message(parts, generation_config=config, stream=stream)
+
+    def _generate(self, contents, system_instruction, history, json_mode):
+        return _response_text(self._request(contents, system_instruction, history, json_mode))
+
+    async def generate(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        return await asyncio.to_thread(self._generate, contents, system_instruction, history, json_mode)
+
+    async def stream(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        # the SDK iterator blocks between chunks: drain it in a worker thread into an asyncio queue
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def pump():
+            try:
+                for chunk in self._request(contents, system_instruction, history, json_mode, stream=True):
+                    if stop.is_set():
+                        break
+                    try:
+                        text = chunk.text
+                    except (IndexError, ValueError, AttributeError):
+                        continue  # an empty / blocked chunk; the final check below catches an empty answer
+                    if text:
+                        loop.call_soon_threadsafe(queue.put_nowait, text)
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+
+        worker = loop.run_in_executor(None, pump)
+        received = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                received = True
+                yield item
+            if not received:
+                raise EmptyResponseError("模型未返回有效文本（candidates 为空或被屏蔽）")
+        finally:
+            stop.set()
+            worker.add_done_callback(lambda f: f.exception())  # nobody awaits an abandoned stream
+
+    def _upload_file(self, path, mime_type, poll_interval=1.0, max_wait=60.0):
+        # resumable upload straight from disk; audio is usually ACTIVE at once, video / long audio may be PROCESSING
+        file = self._genai.upload_file(path=path, mime_type=mime_type)
+        waited = 0.0
+        while getattr(file.state, "name", "ACTIVE") == "PROCESSING" and waited < max_wait:
+            time.sleep(poll_interval)
+            waited += poll_interval
+            file = self._genai.get_file(file.name)
+        state = getattr(file.state, "name", "ACTIVE")
+        if state != "ACTIVE":
+            raise UpstreamError(f"上传文件未就绪: {file.name} ({state})")
+        return file
+
+    async def upload_file(self, path, mime_type=None):
+        return await asyncio.to_thread(self._upload_file, path, mime_type)
+
+
+class GeminiImageProvider(ImageProvider):
+    def __init__(self, genai, model_id: str = "nano-banana-pro-preview"):
+        self._genai = genai
+        self.model_id = model_id
+
+    def _generate_image(self, prompt):
+        response = self._genai.GenerativeModel(self.model_id).generate_content(prompt)
+        if not response.candidates:
+            raise ImageGenerationError("无候选结果")
+        candidate = response.candidates[0]
+        if not (candidate.content and candidate.content.parts):
+            raise ImageGenerationError("响应格式异常")
+        for part in candidate.content.parts:
+            if getattr(part, "inline_data", None):
+                return part.inline_data.data
+        raise ImageGenerationError("未找到图片数据")
+
+    async def generate_image(self, prompt):
+        return await asyncio.to_thread(self._generate_image, prompt)
+
+
+class GoogleSpeechProvider(SpeechProvider):
+    def __init__(self, client_resource, texttospeech, language_code: str = "ja-JP"):
+        self._client = client_resource  # startup.LazyResource
+        self._tts = texttospeech        # startup.LazyModule
+        self.language_code = language_code
+        self.profile = f"google-tts/{language_code}/mp3/rate=1.0/pitch=0.0"
+
+    def _synthesize(self, client, text, voice_name):
+        tts = self._tts
+        response = client.synthesize_speech(
+            input=tts.SynthesisInput(text=text),
+            voice=tts.VoiceSelectionParams(language_code=self.language_code, name=voice_name),
+            audio_config=tts.AudioConfig(
+                audio_encoding=tts.AudioEncoding.MP3,
+                pitch=0.0,        # 音高调整，0.0 为正常
+                speaking_rate=1.0,  # 语速调整
+            ),
+        )
+        return response.audio_content
+
+    async def synthesize(self, text, voice_name):
+        client = await self._client.aget_or_none()
+        if client is None:
+            raise SpeechUnavailableError(f"TTS 客户端未初始化，请检查 Google Cloud 凭证配置（{self._client.error}）")
+        return await asyncio.to_thread(self._synthesize, client, text, voice_name)
+
+
+# ------------------------------------------------------------
+# Deterministic fakes
+# ------------------------------------------------------------
+
+class _FakeBehaviour:
+    """Latency + failure injection, deterministic per (seed, input, attempt).
+
+    failure_rate: fast UpstreamError (a 503 comes back in ~10% of the latency)
+    empty_rate:   EmptyResponseError after the full latency
+    slow_rate:    stragglers that take slow_factor × latency (the tail hedging targets)
+    concurrency:  calls served at once (models upstream quota); extra calls queue
+
+    Attempt numbers are remembered for the max_tracked most recent inputs, so a
+    long load test does not grow without bound; reset() starts a new scenario.
+    """
+
+    def __init__(self, latency: float, jitter: float = 0.2, failure_rate: float = 0.0,
+                 empty_rate: float = 0.0, slow_rate: float = 0.0, slow_factor: float = 8.0,
+                 concurrency: Optional[int] = None, seed: int = 0, max_tracked: int = 4096):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.empty_rate = empty_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.seed = seed
+        self.concurrency = concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.calls = 0
+        self.max_tracked = max_tracked
+        self._attempts: "OrderedDict[str, int]" = OrderedDict()
+
+    def reset(self):
+        """Forget attempt numbers and the call count: replaying inputs gives the first attempt's outcome again."""
+        self._attempts.clear()
+        self.calls = 0
+
+    async def run(self, key: str, scale: float = 1.0) -> random.Random:
+        """Sleep scale × latency (with jitter / stragglers), or fail; returns the call's RNG."""
+        if self.concurrency is None:
+            return await self._run(key, scale)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            return await self._run(key, scale)
+
+    async def _run(self, key: str, scale: float = 1.0) -> random.Random:
+        digest = hashlib.sha1(key.encode("utf-8", "replace")).hexdigest()
+        attempt = self._attempts.pop(digest, 0)
+        self._attempts[digest] = attempt + 1
+        while len(self._attempts) > self.max_tracked:
+            self._attempts.popitem(last=False)
+        self.calls += 1
+        rng = random.Random(f"{self.seed}:{digest}:{attempt}")
+        delay = max(0.0, scale * self.latency * (1 + rng.uniform(-self.jitter, self.jitter)))
+        fail = rng.random()
+        if fail < self.failure_rate:
+            await asyncio.sleep(delay * 0.1)
+            raise UpstreamError("simulated upstream 503")
+        if rng.random() < self.slow_rate:
+            delay *= self.slow_factor
+        await asyncio.sleep(delay)
+        if fail < self.failure_rate + self.empty_rate:
+            raise EmptyResponseError("模型未返回有效文本（candidates 为空或被屏蔽）")
+        return rng
+
+
+@dataclass
+class FakeFile:
+    """What FakeTextProvider.upload_file hands back in place of a genai File."""
+    name: str
+    mime_type: str
+
+
+def _content_key(contents, system_instruction=None, history=None) -> str:
+    parts = [system_instruction or ""]
+    for c in contents:
+        parts.append(f"<audio {len(c.data)}>" if isinstance(c, AudioPart) else str(c))
+    parts.append(str(len(history or [])))
+    return "\n".join(parts)
+
+
+class FakeTextProvider(TextProvider):
+    """Answers each route's prompt with well-formed output of the shape that route expects."""
+
+    def __init__(self, first_chunk: float = 0.35, chunk_chars: int = 16, **behaviour):
+        self.first_chunk = first_chunk    # share of the latency before the first streamed chunk
+        self.chunk_chars = chunk_chars
+        self.behaviour = _FakeBehaviour(**behaviour)
+
+    async def generate(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        rng = await self.behaviour.run(_content_key(contents, system_instruction, history))
+        return self._answer(rng, contents, system_instruction, json_mode)
+
+    async def stream(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        rng = await self.behaviour.run(_content_key(contents, system_instruction, history), scale=self.first_chunk)
+        text = self._answer(rng, contents, system_instruction, json_mode)
+        pieces = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+        gap = self.behaviour.latency * (1 - self.first_chunk) / max(1, len(pieces) - 1)
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(gap)
+            yield piece
+
+    def _answer(self, rng, contents, system_instruction, json_mode) -> str:
+        system = system_instruction or ""
+        prompt = "\n".join(c for c in contents if isinstance(c, str))
+        n = rng.randint(1, 999)
+
+        if '"reply"' in system:
+            finished = '"status": "FINISHED"' in system
+            reply = "ありがとうございます。今日は私と話してくれて、一緒に今日の日記を書きましょう。" if finished \
+                else f"へえ、そうなんだ。店長さん、優しいね。それはいつのこと？（{n}）"
+            return json.dumps({
+                "user_raw_text": "えっと、那个店長が新しい棚を作った",
+                "user_ja": "店長が新しい棚を作りました。",
+                "reply": reply,
+                "translation": "哦，是这样啊。那是什么时候的事？",
+                "translation_en": "Oh, I see. When was that?",
+                "suggestion": "「作った」より「作ってくれた」の方が自然です。",
+                "status": "FINISHED" if finished else "CONTINUE",
+            }, ensure_ascii=False)
+        if '"diary_ja"' in system:
+            return json.dumps({"title": f"今日の回響 {n}", "diary_ja": "今日は店長と話しました。" * 8,
+                               "diary_zh": "今天和店长聊天了。" * 8}, ensure_ascii=False)
+        if "refined_summary_ja" in system:
+            return json.dumps({"refined_summary_ja": "今日は新しい棚を一緒に作りました。" * 5,
+                               "refined_summary_zh": "今天一起做了新的架子。" * 5}, ensure_ascii=False)
+        if '"script"' in system:
+            speaker = re.search(r'"speaker": "([^"]*)"', system)
+            host = speaker.group(1) if speaker else "先輩"
+            script = [{"speaker": host if i % 2 == 0 else "用户", "content": f"ええと、なるほど。{i}番目の話です。"}
+                      for i in range(6)]
+            return json.dumps({"script": script, "diary": {"title": "棚の日", "content_ja": "今日は棚を作った。" * 6}},
+                              ensure_ascii=False)
+        if "scene_prompts" in prompt:
+            return json.dumps({"scene_prompts": [
+                "第一个场景：温暖的水彩风格，店长在整理新的木质货架，阳光从窗外照进来。",
+                "第二个场景：柔和的简笔画风格，用户在傍晚的街角写日记，手边放着一杯咖啡。",
+            ]}, ensure_ascii=False)
+        if "人物角色" in prompt:
+            return json.dumps(["店長", "先輩", "老师"], ensure_ascii=False)
+        if any(isinstance(c, (AudioPart, FakeFile)) for c in contents):
+            return "えっと、今日は店長と新しい棚を作りました"
+        return "{}" if json_mode else "OK"
+
+    async def upload_file(self, path, mime_type=None):
+        await self.behaviour.run(f"upload:{path}")
+        return FakeFile(name=f"files/fake-{hashlib.sha1(str(path).encode()).hexdigest()[:12]}",
+                        mime_type=mime_type or "application/octet-stream")
+
+
+def _fake_png(seed: str, size: int = 64) -> bytes:
+    """A solid-colour RGB PNG, colour derived from the prompt."""
+    r, g, b = hashlib.md5(seed.encode("utf-8")).digest()[:3]
+    row = b"\x00" + bytes((r, g, b)) * size
+    raw = row * size
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+class FakeImageProvider(ImageProvider):
+    def __init__(self, size: int = 64, **behaviour):
+        self.size = size
+        self.behaviour = _FakeBehaviour(**behaviour)
+
+    async def generate_image(self, prompt):
+        try:
+            await self.behaviour.run(prompt)
+        except EmptyResponseError:
+            raise ImageGenerationError("无候选结果")
+        return _fake_png(prompt, self.size)
+
+
+# MPEG-1 Layer III, 64 kbps, 48 kHz, mono: 192-byte frames of 24 ms each
+_MP3_FRAME = b"\xff\xfb\x54\xc0" + b"\x00" * 188
+_MP3_FRAME_SECONDS = 1152 / 48000
+
+
+def fake_mp3(seconds: float) -> bytes:
+    """Silent but well-formed MP3 of roughly the given length."""
+    return _MP3_FRAME * max(1, int(seconds / _MP3_FRAME_SECONDS))
+
+
+class FakeSpeechProvider(SpeechProvider):
+    def __init__(self, seconds_per_char: float = 0.12, **behaviour):
+        self.seconds_per_char = seconds_per_char
+        self.behaviour = _FakeBehaviour(**behaviour)
+        self.profile = f"fake/{seconds_per_char}"
+
+    async def synthesize(self, text, voice_name):
+        try:
+            # latency is the time for a ~20 character sentence; a fixed half plus a per-character half
+            await self.behaviour.run(f"{voice_name}:{text}", scale=0.5 + len(text) / 40)
+        except EmptyResponseError:
+            raise UpstreamError("simulated empty TTS response")
+        return fake_mp3(len(text) * self.seconds_per_char)
+
+
+def fake_providers(text_latency=0.8, image_latency=4.0, tts_latency=0.3,
+                   failure_rate=0.0, empty_rate=0.0, slow_rate=0.0, concurrency=None, seed=0) -> Providers:
+    common = {"failure_rate": failure_rate, "empty_rate": empty_rate, "slow_rate": slow_rate,
+              "concurrency": concurrency, "seed": seed}
+    return Providers(
+        text=FakeTextProvider(latency=text_latency, **common),
+        image=FakeImageProvider(latency=image_latency, **common),
+        speech=FakeSpeechProvider(latency=tts_latency, **common),
+    )
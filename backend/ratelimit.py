@@ -0,0 +1,308 @@
+"""
+Admission control for the model-backed endpoints.
+
+    @app.post("/api/generate_image", dependencies=[Depends(rate_limiter.limit("image"))])
+
+- Token bucket per caller (verified Supabase user id, else client IP). Each
+  route spends its cost (image ≫ avatar > podcast audio > chat > detect_roles);
+  an empty bucket answers 429 with Retry-After.
+- When more than UPSTREAM_CONCURRENCY admitted requests are in flight, new
+  ones wait in a weighted fair queue (self-clocked fair queuing on route
+  cost), so one caller's burst of image requests cannot starve everyone
+  else's chat turns. Waiting longer than max_wait answers 503 + Retry-After.
+- Batch routes (/api/generate_avatars) call spend() with the number of
+  upstream calls they will make and take one slot() per call instead.
+- Buckets live in process memory; with several workers on one host they go
+  to a SQLite file shared by the workers, and RATE_LIMIT_REDIS_URL shares
+  them between replicas (needs the `redis` package). If the shared store is
+  unavailable we fail open.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException, Request
+
+from metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_WAIT_SECONDS, RATE_LIMITED
+
+logger = logging.getLogger("lifecho.ratelimit")
+
+DEFAULT_COSTS = {
+    "image": 20.0,          # two nano-banana generations
+    "avatar": 10.0,
+    "podcast_audio": 8.0,   # ~6-12 TTS lines
+    "generate": 2.0,        # summarize / refine / podcast script / scene prompts
+    "chat": 2.0,            # Gemini + TTS
+    "transcribe": 2.0,
+    "tts": 1.0,
+    "detect_roles": 0.5,
+}
+
+
+def parse_costs(spec: str) -> dict[str, float]:
+    costs = dict(DEFAULT_COSTS)
+    for item in spec.split(","):
+        if "=" in item:
+            name, cost = item.split("=", 1)
+            costs[name.strip()] = float(cost)
+    return costs
+
+
+class LocalBucketStore:
+    """In-process token buckets; least recently used callers are dropped past max_keys."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        """Spend cost tokens; returns 0 when admitted, else seconds until the bucket could afford it."""
+        now = time.monotonic()
+        tokens, ts = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class SqliteBucketStore:
+    """Token buckets shared by the worker processes of one host; BEGIN IMMEDIATE makes each take atomic."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._takes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL, ts REAL)")
+            self._conn = conn
+        return self._conn
+
+    def _take(self, key, cost, capacity, rate):
+        now = time.time()  # wall clock: shared between processes
+        with self._lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, ts FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                tokens, ts = row if row else (capacity, now)
+                tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+                wait = 0.0
+                if tokens >= cost:
+                    tokens -= cost
+                else:
+                    wait = (cost - tokens) / rate
+                conn.execute("INSERT OR REPLACE INTO rate_buckets (key, tokens, ts) VALUES (?, ?, ?)",
+                             (key, tokens, now))
+                self._takes += 1
+                if self._takes % 1000 == 0:
+                    # a full bucket carries no information; drop the idle ones now and then
+                    conn.execute("DELETE FROM rate_buckets WHERE ts < ?", (now - capacity / rate - 60,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    async def take(self, key, cost, capacity, rate):
+        try:
+            return await asyncio.to_thread(self._take, key, cost, capacity, rate)
+        except sqlite3.Error as e:
+            logger.warning("rate limit store unavailable, admitting request: %s", e)
+            return 0.0
+
+
+_REDIS_TAKE = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local cost, capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RedisBucketStore:
+    """Token buckets shared across replicas: one atomic Lua script per check, Redis clock."""
+
+    def __init__(self, url: str, prefix: str = "lifecho:rl:"):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._script = None
+
+    async def take(self, key, cost, capacity, rate):
+        try:
+            if self._client is None:
+                import redis.asyncio as redis
+                self._client = redis.from_url(self.url)
+                self._script = self._client.register_script(_REDIS_TAKE)
+            return float(await self._script(keys=[self.prefix + key], args=[cost, capacity, rate]))
+        except Exception as e:
+            logger.warning("rate limit store unavailable, admitting request: %s: %s", type(e).__name__, e)
+            return 0.0
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+class FairScheduler:
+    """At most max_concurrency holders; waiters are served in order of virtual finish time."""
+
+    def __init__(self, max_concurrency: int, max_wait: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self._active = 0
+        self._vtime = 0.0
+        self._finish: dict[str, float] = {}
+        self._heap: list = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, fut in self._heap if not fut.done())
+
+    async def acquire(self, key: str, cost: float, weight: float = 1.0):
+        # live waiters only exist while every slot is taken (release hands slots over directly)
+        if self._active < self.max_concurrency:
+            self._active += 1
+            return
+        start = max(self._vtime, self._finish.get(key, 0.0))
+        finish = start + cost / weight
+        self._finish[key] = finish
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish, next(self._seq), fut))
+        ADMISSION_QUEUE_DEPTH.set(self.queued)
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(fut, self.max_wait)
+        except asyncio.TimeoutError:
+            raise QueueTimeout() from None
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # granted a slot just as the client went away
+            raise
+        finally:
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - t0)
+            ADMISSION_QUEUE_DEPTH.set(self.queued)
+
+    def release(self):
+        while self._heap:
+            finish, _, fut = heapq.heappop(self._heap)
+            if fut.done():  # timed out / cancelled waiter
+                continue
+            self._vtime = finish
+            fut.set_result(None)  # the slot passes straight to the next waiter
+            break
+        else:
+            self._active -= 1
+            if len(self._finish) > 10_000:
+                self._finish = {k: v for k, v in self._finish.items() if v > self._vtime}
+
+    @asynccontextmanager
+    async def slot(self, key: str, cost: float, weight: float = 1.0):
+        await self.acquire(key, cost, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class RateLimiter:
+    def __init__(self, identify: Callable[[Request], Awaitable[str]], store=None, costs: Optional[dict] = None,
+                 capacity: float = 60.0, refill_per_second: float = 1.0,
+                 scheduler: Optional[FairScheduler] = None, enabled: bool = True):
+        self.identify = identify
+        self.store = store or LocalBucketStore()
+        self.costs = costs or dict(DEFAULT_COSTS)
+        self.capacity = capacity
+        self.rate = refill_per_second
+        self.scheduler = scheduler
+        self.enabled = enabled
+
+    async def spend(self, request: Request, route_class: str, units: float = 1.0) -> str:
+        """
+        Spend units x the route's cost from the caller's bucket (429 + Retry-After when it is empty)
+        and return the caller key. A batch never costs more than a full bucket, so it stays admissible.
+        """
+        key = await self.identify(request)
+        if not self.enabled or units <= 0:
+            return key
+        cost = min(self.costs[route_class] * units, self.capacity)
+        wait = await self.store.take(key, cost, self.capacity, self.rate)
+        if wait > 0:
+            RATE_LIMITED.inc(route=route_class, reason="bucket")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests, please slow down",
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+        return key
+
+    @asynccontextmanager
+    async def slot(self, key: str, route_class: str):
+        """Fair-queue upstream slot for one unit of work inside a request (one avatar of a batch); may raise QueueTimeout."""
+        if not self.enabled or self.scheduler is None:
+            yield
+            return
+        try:
+            await self.scheduler.acquire(key, self.costs[route_class])
+        except QueueTimeout:
+            RATE_LIMITED.inc(route=route_class, reason="queue_timeout")
+            raise
+        try:
+            yield
+        finally:
+            self.scheduler.release()
+
+    def limit(self, route_class: str):
+        """FastAPI dependency: spend the route's cost, then hold a fair-queue slot for the request."""
+        cost = self.costs[route_class]
+
+        async def dependency(request: Request):
+            if not self.enabled:
+                yield
+                return
+            key = await self.spend(request, route_class)
+            if self.scheduler is None:
+                yield
+                return
+            try:
+                await self.scheduler.acquire(key, cost)
+            except QueueTimeout:
+                RATE_LIMITED.inc(route=route_class, reason="queue_timeout")
+                raise HTTPException(status_code=503, detail="Server busy, please retry",
+                                    headers={"Retry-After": "5"})
+            try:
+                yield
+            finally:
+                self.scheduler.release()
+
+        return dependency
@@ -0,0 +1,376 @@
+"""
+Retry, hedging and circuit breaking around the upstream model providers.
+
+    providers = with_resilience(Providers(text=..., image=..., speech=...))
+
+Every call goes through ResilientCall:
+- retryable failures (UpstreamError, empty candidates, 429/5xx/timeouts from
+  the Google SDKs) are retried with full-jitter exponential backoff, bounded by
+  a retry budget so a flaky upstream cannot multiply our own traffic;
+- a per-upstream circuit breaker opens after consecutive failures and fails
+  fast (CircuitOpenError) until a half-open probe succeeds;
+- latency-critical calls (hedge=True, the chat turn) start a second request
+  when the first one is slower than the recent p95, and take whichever wins.
+
+Streams get all of this for the wait until the first chunk (a hedged stream
+keeps the faster one and closes the other); after that each chunk must come
+within stream_idle_timeout, and a stall or transport error mid-stream counts
+against the breaker but is not retried (text already reached the caller).
+
+SingleFlight lets concurrent requests for the same thing (a TTS clip, an
+avatar image, an audio upload) share one upstream call.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional, TypeVar
+
+from metrics import CIRCUIT_REJECTIONS, CIRCUIT_STATE, HEDGES, RETRIES
+from providers import (
+    EmptyResponseError,
+    ImageGenerationError,
+    ImageProvider,
+    Providers,
+    SpeechProvider,
+    TextProvider,
+    UpstreamError,
+)
+
+logger = logging.getLogger("lifecho.resilience")
+
+# google.api_core.exceptions / httpx names; matched by name so the SDKs stay lazily imported
+_RETRYABLE_NAMES = {
+    "ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "TooManyRequests",
+    "ResourceExhausted", "Aborted", "GatewayTimeout", "BadGateway", "Unknown",
+    "RetryError", "ConnectError", "ReadTimeout", "RemoteProtocolError",
+}
+
+
+class CircuitOpenError(Exception):
+    """The upstream is failing; calls are rejected without being attempted."""
+    retryable = False
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (UpstreamError, EmptyResponseError, ImageGenerationError,
+                        asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_NAMES for cls in type(exc).__mro__)
+
+
+def _is_outage(exc: BaseException) -> bool:
+    # empty / imageless answers mean the upstream is up; only transport-level failures trip the breaker
+    return is_retryable(exc) and not isinstance(exc, (EmptyResponseError, ImageGenerationError))
+
+
+class RetryPolicy:
+    def __init__(self, attempts: int = 3, base_delay: float = 0.25, max_delay: float = 4.0,
+                 attempt_timeout: Optional[float] = None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+
+    def backoff(self, retry: int) -> float:
+        """Full jitter: uniform(0, min(cap, base * 2**retry))."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+
+class RetryBudget:
+    """Each call earns `ratio` of a retry token; a retry or hedge spends one."""
+
+    def __init__(self, ratio: float = 0.2, initial: float = 10.0, cap: float = 50.0):
+        self.ratio = ratio
+        self.cap = cap
+        self._tokens = initial
+
+    def deposit(self):
+        self._tokens = min(self.cap, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    _STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        CIRCUIT_STATE.set(0, circuit=name)
+
+    def _set(self, state: str):
+        if state != self.state:
+            logger.warning("circuit %s: %s -> %s", self.name, self.state, state)
+            self.state = state
+            CIRCUIT_STATE.set(self._STATE_VALUE[state], circuit=self.name)
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set(self.HALF_OPEN)
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        CIRCUIT_REJECTIONS.inc(circuit=self.name)
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._probing = False
+        self._set(self.CLOSED)
+
+    def release_probe(self):
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set(self.OPEN)
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies; p95 drives the hedge delay."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self._samples: deque = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Concurrent do(key, fn) calls share one run of fn; the next call after it finishes runs it again.
+
+    fn runs as its own task and callers wait on it through asyncio.shield, so a
+    caller that is cancelled (client gone) only stops waiting: the others still
+    get the result, never its CancelledError. Exceptions from fn reach everyone.
+    """
+
+    def __init__(self):
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._tasks
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved: every caller may have left
+
+
+class ResilientCall:
+    """Retry + budget + breaker (+ optional hedging) for one upstream."""
+
+    def __init__(self, operation: str, policy: RetryPolicy, breaker: CircuitBreaker,
+                 budget: Optional[RetryBudget] = None, hedge_default: float = 3.0, hedge_min: float = 0.2):
+        self.operation = operation
+        self.policy = policy
+        self.breaker = breaker
+        self.budget = budget or RetryBudget()
+        self.latency = LatencyTracker()
+        self.hedge_default = hedge_default
+        self.hedge_min = hedge_min
+
+    def hedge_delay(self) -> float:
+        p95 = self.latency.quantile(0.95)
+        return max(self.hedge_min, p95 if p95 is not None else self.hedge_default)
+
+    async def _attempt(self, fn: Callable[[], Awaitable]):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.operation} circuit open")
+        t0 = time.perf_counter()
+        try:
+            if self.policy.attempt_timeout:
+                result = await asyncio.wait_for(fn(), self.policy.attempt_timeout)
+            else:
+                result = await fn()
+        except asyncio.CancelledError:
+            self.breaker.release_probe()  # the losing side of a hedge
+            raise
+        except Exception as e:
+            if _is_outage(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        self.latency.add(time.perf_counter() - t0)
+        return result
+
+    async def _hedged(self, fn: Callable[[], Awaitable], discard: Optional[Callable[[Any], None]] = None):
+        first = asyncio.ensure_future(self._attempt(fn))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay())
+        if done or not self.budget.withdraw():
+            return await first
+        second = asyncio.ensure_future(self._attempt(fn))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in (first, second) if task in done and task.exception() is None]
+                if winners:
+                    for loser in winners[1:]:  # both finished in the same step: release the extra result
+                        if discard is not None:
+                            discard(loser.result())
+                    HEDGES.inc(operation=self.operation, outcome="won" if winners[0] is second else "lost")
+                    return winners[0].result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __call__(self, fn: Callable[[], Awaitable], hedge: bool = False,
+                       discard: Optional[Callable[[Any], None]] = None):
+        """discard(result) releases a hedge's second successful result (an open stream) that nobody takes."""
+        self.budget.deposit()
+        retry = 0
+        while True:
+            try:
+                if hedge:
+                    return await self._hedged(fn, discard)
+                return await self._attempt(fn)
+            except Exception as e:
+                if not is_retryable(e) or retry + 1 >= self.policy.attempts or not self.budget.withdraw():
+                    raise
+                delay = self.policy.backoff(retry)
+                retry += 1
+                RETRIES.inc(operation=self.operation)
+                logger.info("%s 重试 %d/%d（%s: %s），%.2fs 后", self.operation, retry,
+                            self.policy.attempts - 1, type(e).__name__, e, delay)
+                await asyncio.sleep(delay)
+
+
+async def _aclose(chunks: AsyncIterator):
+    close = getattr(chunks, "aclose", None)
+    if close is not None:
+        await close()
+
+
+class ResilientTextProvider(TextProvider):
+    def __init__(self, inner: TextProvider, call: ResilientCall, stream_idle_timeout: Optional[float] = None):
+        self.inner = inner
+        self.call = call
+        self.stream_idle_timeout = stream_idle_timeout
+
+    async def generate(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        return await self.call(
+            lambda: self.inner.generate(contents, system_instruction=system_instruction,
+                                        history=history, json_mode=json_mode),
+            hedge=hedge,
+        )
+
+    async def stream(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        # retries, timeout, hedging and breaker cover the wait for the first chunk; once text
+        # is flowing to the caller a failure can no longer be retried transparently
+        async def first_chunk():
+            chunks = self.inner.stream(contents, system_instruction=system_instruction,
+                                       history=history, json_mode=json_mode).__aiter__()
+            try:
+                return chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                await _aclose(chunks)
+                raise EmptyResponseError("模型未返回有效文本（candidates 为空或被屏蔽）") from None
+            except BaseException:  # failed, timed out, or the losing side of a hedge
+                await _aclose(chunks)
+                raise
+
+        def discard(result):
+            asyncio.ensure_future(_aclose(result[0]))
+
+        chunks, chunk = await self.call(first_chunk, hedge=hedge, discard=discard)
+        try:
+            yield chunk
+            while True:
+                try:
+                    if self.stream_idle_timeout:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), self.stream_idle_timeout)
+                    else:
+                        chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self.call.breaker.record_failure()
+                    raise UpstreamError(
+                        f"{self.call.operation} stream stalled for {self.stream_idle_timeout}s") from None
+                except Exception as e:
+                    if _is_outage(e):
+                        self.call.breaker.record_failure()
+                    raise
+                yield chunk
+        finally:
+            await _aclose(chunks)
+
+    async def upload_file(self, path, mime_type=None):
+        return await self.call(lambda: self.inner.upload_file(path, mime_type))
+
+
+class ResilientImageProvider(ImageProvider):
+    def __init__(self, inner: ImageProvider, call: ResilientCall):
+        self.inner = inner
+        self.call = call
+
+    async def generate_image(self, prompt):
+        return await self.call(lambda: self.inner.generate_image(prompt))
+
+
+class ResilientSpeechProvider(SpeechProvider):
+    def __init__(self, inner: SpeechProvider, call: ResilientCall):
+        self.inner = inner
+        self.call = call
+        self.profile = inner.profile
+
+    async def synthesize(self, text, voice_name):
+        return await self.call(lambda: self.inner.synthesize(text, voice_name))
+
+
+def with_resilience(providers: Providers, attempts: int = 3, failure_threshold: int = 5,
+                    reset_timeout: float = 30.0, stream_idle_timeout: Optional[float] = 20.0) -> Providers:
+    def call(operation, timeout, hedge_default=3.0):
+        return ResilientCall(
+            operation,
+            RetryPolicy(attempts=attempts, attempt_timeout=timeout),
+            CircuitBreaker(operation, failure_threshold, reset_timeout),
+            hedge_default=hedge_default,
+        )
+
+    return Providers(
+        text=ResilientTextProvider(providers.text, call("gemini.text", 60.0), stream_idle_timeout),
+        image=ResilientImageProvider(providers.image, call("gemini.image", 120.0)),
+        speech=ResilientSpeechProvider(providers.speech, call("tts", 30.0)),
+    )
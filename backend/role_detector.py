@@ -0,0 +1,236 @@
+"""
+Local role detection for /api/detect_roles.
+
+An Aho-Corasick automaton over Chinese / Japanese / English relationship and
+title terms (老师, 店長, 先輩, boss, ...) plus honorific-suffix patterns for
+names (田中さん, 王老师, ゆきちゃん, Mr. Smith) answers in tens of
+microseconds. When nothing is found but the text clearly talks about
+someone (他/她, 彼女, と一緒に, 和…去, with ...), or names a word that could be
+a person (阿强, a capitalized word mid-sentence), the result is marked
+low-confidence and the route falls back to Gemini: only text with no such
+word counts as "no person mentioned".
+
+Two kanji before a job title (山田先輩, but also 昨日先輩 / 会社部長) are not
+reliably a name: time and other common words are stoplisted (the bare title
+is the role), and any other such match is reported but left to Gemini.
+"""
+import re
+from collections import deque
+from dataclasses import dataclass, field
+
+ZH_TERMS = """
+老师 班主任 教授 导师 同学 学长 学姐 学弟 学妹 室友 舍友 朋友 好朋友 闺蜜 发小 网友 笔友
+同事 前辈 后辈 上司 领导 老板 老板娘 店长 经理 主管 组长 部长 课长 社长 总监 面试官 客户 客人 顾客 店员 房东 邻居
+爸爸 妈妈 老爸 老妈 父亲 母亲 爸妈 父母 哥哥 姐姐 弟弟 妹妹 爷爷 奶奶 外公 外婆 姥姥 姥爷 叔叔 阿姨 舅舅 姑姑 表哥 表姐 表弟 表妹 堂哥 堂姐
+老公 老婆 丈夫 妻子 男朋友 女朋友 男友 女友 对象 儿子 女儿 孩子 宝宝
+医生 护士 司机 教练 师傅 保安 快递员 服务员 外卖员 警察
+""".split()
+
+JA_TERMS = """
+先生 先輩 後輩 同級生 クラスメート クラスメイト 友達 友だち 友人 親友 幼なじみ ルームメイト バイト仲間
+同僚 上司 部下 店長 部長 課長 係長 社長 専務 主任 マネージャー 店員 お客さん お客様 客 面接官 大家さん 隣人 お隣さん
+父 母 お父さん お母さん 父親 母親 両親 兄 姉 弟 妹 お兄さん お姉さん 兄弟 姉妹 祖父 祖母 おじいちゃん おばあちゃん
+おじさん おばさん いとこ 夫 妻 旦那 奥さん 彼氏 恋人 息子 娘 子供 子ども
+医者 お医者さん 看護師 運転手 コーチ 警察官
+""".split()
+
+EN_TERMS = """
+teacher, professor, tutor, classmate, roommate, friend, best friend, bestie, coworker, co-worker, colleague,
+boss, manager, supervisor, senpai, kouhai, customer, client, neighbor, neighbour, landlord, interviewer,
+mom, mum, dad, mother, father, parents, brother, sister, grandma, grandpa, grandmother, grandfather,
+aunt, uncle, cousin, husband, wife, boyfriend, girlfriend, partner, son, daughter, doctor, nurse, driver, coach
+""".replace("\n", " ").split(",")
+
+# a bare ambiguous kanji like 母/兄 is only a role as a whole word; these need the surrounding context
+_SINGLE_CHAR_JA = {"父", "母", "兄", "姉", "弟", "妹", "夫", "妻", "娘", "客"}
+
+# 我妈 / 他哥: a bare kin character is only a role right after a possessive pronoun
+# (not 妈妈, which the dictionary has, nor the curse 他妈的)
+_ZH_KIN = re.compile(r"(?:我|你|他|她|咱|俺)([妈爸哥姐弟妹爷奶姥舅叔婶姨姑嫂])(?!\1)(?!(?<=[他你]妈)的)")
+
+_ZH_SURNAMES = (
+    "王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈"
+    "姚卢姜崔钟谭陆汪范金石廖贾夏韦付方白邹孟熊秦邱江尹薛闫段雷侯龙史陶黎贺顾毛郝龚邵万钱严覃武戴莫孔向汤"
+)
+
+# two kanji before a title that are words, not surnames: 昨日先輩と… is 先輩
+_NOT_NAMES = set("""
+今日 昨日 明日 毎日 今朝 昨夜 今晩 今夜 毎朝 毎晩 先週 今週 来週 毎週 先月 今月 来月 毎月 去年 今年 来年 毎年
+週末 平日 午前 午後 最近 以前 今度 前回 次回 当日 翌日 前日 初日 一緒 全員 皆様 本当 結局 突然 久々
+会社 職場 学校 大学 高校 教室 担任 新人 新任 担当 数学 英語 国語 理科 体育 音楽
+""".split())
+
+# job titles say little about the two kanji before them; name suffixes (さん, 君...) do
+_JOB_TITLES = {"先輩", "先生", "部長", "課長", "店長", "社長"}
+
+_HONORIFIC_PATTERNS = [
+    # 田中さん / 山田先輩 / 佐藤部長: two kanji is by far the most common surname length
+    re.compile(r"([一-鿿]{2})(さん|くん|君|ちゃん|様|先輩|先生|部長|課長|店長|社長)"),
+    # カタカナ / ひらがな names: マイクさん, ゆきちゃん
+    re.compile(r"([ァ-ヺー]{2,8})(さん|くん|君|ちゃん|様|先輩|先生)"),
+    re.compile(r"(?<![ぁ-ゖ])([ぁ-ゖ]{2,4})(ちゃん|くん)"),
+    # 王老师 / 小李 / 老张 / 陈经理 / 刘阿姨
+    re.compile(rf"((?:[小老])?[{_ZH_SURNAMES}])(老师|同学|经理|总|医生|阿姨|叔叔|师傅|教练|主任|学长|学姐|哥|姐)"),
+    # 小李说 / 跟老张一起: only between particles / verbs / punctuation, so 小时 and 老高兴 stay out
+    re.compile(rf"(?:(?<![一-鿿])|(?<=[和跟给对问诉让被找见]))((?:小|老)[{_ZH_SURNAMES}])()"
+               rf"(?=[说讲告和跟也都在去来给问让请帮一了的，。、！？,.!?\s]|$)"),
+    # Mr. Smith / Ms Tanaka / Tanaka-san
+    re.compile(r"\b((?:Mr|Mrs|Ms|Miss|Dr|Prof)\.?\s+[A-Z][a-z]+)\b"),
+    re.compile(r"\b([A-Z][a-z]+)-(san|kun|chan|senpai|sensei)\b"),
+]
+_KANJI_NAME = _HONORIFIC_PATTERNS[0]
+
+# my friend Tom / our teacher Ms Lee: the capitalized word after a role term is who it is
+_EN_NAME_AFTER = re.compile(r"\s+([A-Z][a-z]+)\b")
+
+# someone is mentioned but we may not have caught who: worth asking the model
+_PERSON_CUES = re.compile(
+    r"他们|她们|他|她|大家|别人|有人|那个人|这个人|跟[一-鿿]{1,3}|"
+    r"(?<![不相共一如认赞合])[和同](?:(?!的)[一-鿿]){1,4}?(?:一起|一块|去|来|聊|说|吃|喝|玩|见|约|逛|吵)|"
+    r"彼ら|彼|あの人|その人|みんな|誰か|と一緒に|に会|と話|"
+    r"\b(?:he|she|they|him|her|them|someone|somebody|with [A-Z][a-z]+)\b"
+)
+# words that could be a name the patterns above do not know: 阿强, or "met Sarah" (capitalized mid-sentence)
+_NAME_CANDIDATES = re.compile(
+    r"阿[一-鿿]|(?<=[a-z,;]\s)(?!(?:Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday|January|February|"
+    r"March|April|May|June|July|August|September|October|November|December|English|Japanese|Chinese)\b)[A-Z][a-z]+"
+)
+_SELF_TERMS = {"我", "自己", "私", "僕", "俺", "I", "me", "myself"}
+
+
+class AhoCorasick:
+    """Leftmost-longest literal matching over a fixed dictionary."""
+
+    def __init__(self, words):
+        self._goto: list[dict] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[int] = [0]  # length of the longest word ending at this state
+        for word in words:
+            state = 0
+            for ch in word:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(0)
+                state = nxt
+            self._out[state] = max(self._out[state], len(word))
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = max(self._out[nxt], self._out[self._fail[nxt]])
+
+    def find_all(self, text: str) -> list[tuple[int, int]]:
+        """(start, end) spans, leftmost-longest, non-overlapping."""
+        goto, fail, out = self._goto, self._fail, self._out
+        hits = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                hits.append((i + 1 - out[state], i + 1))
+        hits.sort(key=lambda span: (span[0], -span[1]))
+        spans, last_end = [], 0
+        for start, end in hits:
+            if start >= last_end:
+                spans.append((start, end))
+                last_end = end
+        return spans
+
+
+@dataclass
+class RoleDetection:
+    roles: list[str] = field(default_factory=list)
+    confident: bool = True
+    reason: str = ""
+
+
+class RoleDetector:
+    def __init__(self, zh=ZH_TERMS, ja=JA_TERMS, en=EN_TERMS):
+        self._terms = set(zh) | set(ja)
+        self._cjk = AhoCorasick(list(zh) + list(ja))
+        self._en = AhoCorasick([w.strip().lower() for w in en if w.strip()])
+
+    def _en_words(self, text: str) -> list[tuple[int, int]]:
+        lowered = text.lower()
+        spans = []
+        for start, end in self._en.find_all(lowered):
+            # whole words only ("mom" not in "moment"); allow plural -s
+            if end < len(lowered) and lowered[end] == "s":
+                end += 1
+            if (start == 0 or not lowered[start - 1].isalpha()) and (end == len(lowered) or not lowered[end].isalpha()):
+                spans.append((start, end))
+        return spans
+
+    def detect(self, text: str, limit: int = 10) -> RoleDetection:
+        found: list[tuple[int, str]] = []
+        covered: list[tuple[int, int]] = []
+        uncertain: list[str] = []
+
+        for pattern in _HONORIFIC_PATTERNS:
+            for m in pattern.finditer(text):
+                if m.group(1) in self._terms or m.group(1) in _NOT_NAMES:
+                    continue  # 部長さん / 昨日先輩: the dictionary finds the bare title, which is the role
+                found.append((m.start(), m.group(0)))
+                covered.append(m.span())
+                if pattern is _KANJI_NAME and m.group(2) in _JOB_TITLES:
+                    uncertain.append(m.group(0))
+
+        for m in _ZH_KIN.finditer(text):
+            found.append((m.start(), m.group(0)))
+            covered.append(m.span())
+
+        def inside_name(start, end):
+            return any(s <= start and end <= e for s, e in covered)
+
+        for start, end in self._cjk.find_all(text):
+            term = text[start:end]
+            if inside_name(start, end):
+                continue
+            if term in _SINGLE_CHAR_JA and _embedded_in_word(text, start, end):
+                continue
+            found.append((start, term))
+        for start, end in self._en_words(text):
+            name = _EN_NAME_AFTER.match(text, end)
+            found.append((start, text[start:name.end()] if name else text[start:end]))
+
+        roles, seen = [], set()
+        for _, role in sorted(found):
+            key = role.lower()
+            if key not in seen and role not in _SELF_TERMS:
+                seen.add(key)
+                roles.append(role)
+        roles = roles[:limit]
+
+        if uncertain:
+            return RoleDetection(roles, False, f"ambiguous name {uncertain[0]!r}")
+        if roles:
+            return RoleDetection(roles, True, "matched")
+        cue = _PERSON_CUES.search(text)
+        if cue:
+            return RoleDetection([], False, f"person cue {cue.group(0)!r}")
+        candidate = _NAME_CANDIDATES.search(text)
+        if candidate:
+            return RoleDetection([], False, f"possible name {candidate.group(0)!r}")
+        return RoleDetection([], True, "no person mentioned")
+
+
+def _embedded_in_word(text: str, start: int, end: int) -> bool:
+    # 母 in 母国 / 分母: a CJK character glued on either side makes it part of another word
+    before = text[start - 1] if start > 0 else ""
+    after = text[end] if end < len(text) else ""
+    return bool(re.match(r"[一-鿿]", before) or re.match(r"[一-鿿]", after))
+
+
+detector = RoleDetector()
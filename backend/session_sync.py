@@ -0,0 +1,360 @@
+"""
+Chat session snapshot sync with JSON Patch deltas.
+
+The chat page keeps its progress (CachedSession: turns, history,
+communication_raw, base64 reply audio, summary...) in one JSON document.
+Upserting the whole document on every change rewrites a row that grows
+with every turn. Here the server keeps the document as a compacted
+snapshot plus a log of deltas:
+
+    GET    /api/session                 {"version", "snapshot"}
+    PUT    /api/session                 {"snapshot"}                   replace (first sync / after a 409)
+    PATCH  /api/session                 {"base_version", "ops"}        RFC 6902 operations
+    DELETE /api/session
+    GET    /api/session/media/{id}
+
+- A delta is applied to the current document (add / remove / replace /
+  move / copy / test, JSON Pointer paths) and stored as one small op-log
+  row; the version advances by compare-and-set, so a delta made against an
+  older version answers 409 with the current one and nothing is lost.
+- Strings of at least media_min_bytes that are base64 or data: URLs (reply
+  audio, scene images) are moved out of line into content-addressed files
+  and replaced by {"$media": id, "mime", "format"} handles: each clip is
+  written once, not on every sync. GET ?inline_media=1 expands them again.
+- After compact_every deltas (or compact_bytes of op log) the log is folded
+  into the stored snapshot and deleted, and media no longer referenced is
+  removed, so the stored rows stay bounded while sync writes stay the size
+  of the change.
+
+The materialized document is cached per user (keyed by version) so a delta
+does not re-read the snapshot; another worker's write shows up as a
+version mismatch and is reloaded.
+"""
+import asyncio
+import base64
+import binascii
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from journal_store import JournalRepository
+
+logger = logging.getLogger("lifecho.session_sync")
+
+_MEDIA_ID = re.compile(r"[0-9a-f]{32}")
+_DATA_URL = re.compile(r"data:([\w.+-]+/[\w.+-]+)?(?:;[\w-]+=[\w-]+)*;base64,", re.ASCII)
+_MISSING = object()
+
+
+class PatchError(ValueError):
+    """An operation is malformed or does not apply to the current document."""
+
+
+class SessionConflict(Exception):
+    def __init__(self, version: int):
+        super().__init__(f"session is at version {version}")
+        self.version = version
+
+
+# ------------------------------------------------------------
+# JSON Patch (RFC 6902) over plain JSON values
+# ------------------------------------------------------------
+
+def _pointer(path) -> list[str]:
+    if not isinstance(path, str) or (path and not path.startswith("/")):
+        raise PatchError(f"invalid JSON pointer: {path!r}")
+    return [t.replace("~1", "/").replace("~0", "~") for t in path.split("/")[1:]]
+
+
+def _index(container: list, token: str, allow_end: bool) -> int:
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise PatchError(f"invalid array index: {token!r}")
+    i = int(token)
+    if i > len(container) or (i == len(container) and not allow_end):
+        raise PatchError(f"array index out of range: {i}")
+    return i
+
+
+def _walk(doc, tokens: list[str]):
+    for token in tokens:
+        if isinstance(doc, dict) and token in doc:
+            doc = doc[token]
+        elif isinstance(doc, list):
+            doc = doc[_index(doc, token, allow_end=False)]
+        else:
+            raise PatchError(f"path not found: /{'/'.join(tokens)}")
+    return doc
+
+
+def _get(doc, path):
+    return _walk(doc, _pointer(path))
+
+
+def _add(doc, path, value):
+    tokens = _pointer(path)
+    if not tokens:
+        return value
+    parent = _walk(doc, tokens[:-1])
+    if isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, tokens[-1], allow_end=True), value)
+    else:
+        raise PatchError(f"cannot add to a scalar at {path}")
+    return doc
+
+
+def _remove(doc, path):
+    tokens = _pointer(path)
+    if not tokens:
+        raise PatchError("cannot remove the document root")
+    parent = _walk(doc, tokens[:-1])
+    if isinstance(parent, dict) and tokens[-1] in parent:
+        return parent.pop(tokens[-1])
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, tokens[-1], allow_end=False))
+    raise PatchError(f"path not found: {path}")
+
+
+def apply_patch(doc, ops: list) -> Any:
+    """A patched deep copy of doc; raises PatchError and leaves doc untouched if any op fails."""
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        if not isinstance(op, dict):
+            raise PatchError("operations must be objects")
+        kind, path = op.get("op"), op.get("path")
+        value = op.get("value", _MISSING)
+        if kind in ("add", "replace", "test") and value is _MISSING:
+            raise PatchError(f"{kind} needs a value")
+        if kind == "add":
+            doc = _add(doc, path, value)
+        elif kind == "remove":
+            _remove(doc, path)
+        elif kind == "replace":
+            if _pointer(path):
+                _remove(doc, path)
+            doc = _add(doc, path, value)
+        elif kind == "move":
+            moved = _remove(doc, op.get("from"))
+            doc = _add(doc, path, moved)
+        elif kind == "copy":
+            doc = _add(doc, path, copy.deepcopy(_get(doc, op.get("from"))))
+        elif kind == "test":
+            if _get(doc, path) != value:
+                raise PatchError(f"test failed at {path}")
+        else:
+            raise PatchError(f"unknown op: {kind!r}")
+    return doc
+
+
+# ------------------------------------------------------------
+# Out-of-line media
+# ------------------------------------------------------------
+
+def sniff_mime(data: bytes) -> str:
+    if data.startswith((b"ID3", b"\xff\xfb", b"\xff\xf3", b"\xff\xf2")):
+        return "audio/mpeg"
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def _is_handle(value) -> bool:
+    return isinstance(value, dict) and isinstance(value.get("$media"), str)
+
+
+def _handles(value, found: set) -> set:
+    if _is_handle(value):
+        found.add(value["$media"])
+    elif isinstance(value, dict):
+        for v in value.values():
+            _handles(v, found)
+    elif isinstance(value, list):
+        for v in value:
+            _handles(v, found)
+    return found
+
+
+@dataclass
+class _Session:
+    version: int
+    doc: Any
+    snapshot_version: int
+    log_ops: int
+    log_bytes: int
+
+
+class SessionSync:
+    def __init__(self, repo: Callable[[], JournalRepository], media_dir: Path, media_min_bytes: int = 8 * 1024,
+                 compact_every: int = 32, compact_bytes: int = 256 * 1024, cache_size: int = 256,
+                 media_grace_seconds: float = 600.0):
+        self.repo = repo  # a getter: benchmarks swap main1.journal_repo
+        self.media_dir = Path(media_dir)
+        self.media_min_bytes = media_min_bytes
+        self.compact_every = compact_every
+        self.compact_bytes = compact_bytes
+        self.cache_size = cache_size
+        self.media_grace_seconds = media_grace_seconds
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+
+    # --- media (sync, called via asyncio.to_thread) ---
+
+    def _user_dir(self, user_id: str) -> Path:
+        return self.media_dir / hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:24]
+
+    def media_path(self, user_id: str, media_id: str) -> Optional[Path]:
+        if not _MEDIA_ID.fullmatch(media_id):
+            return None
+        path = self._user_dir(user_id) / media_id
+        return path if path.exists() else None
+
+    def _store_media(self, user_id: str, text: str) -> Optional[dict]:
+        match = _DATA_URL.match(text)
+        payload = text[match.end():] if match else text
+        try:
+            data = base64.b64decode(payload, validate=True)
+        except (binascii.Error, ValueError):
+            return None  # long text, not media: stays inline
+        media_id = hashlib.sha256(data).hexdigest()[:32]
+        path = self._user_dir(user_id) / media_id
+        if path.exists():
+            os.utime(path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".{media_id}.{os.getpid()}")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        mime = (match.group(1) if match else None) or sniff_mime(data)
+        return {"$media": media_id, "mime": mime, "format": "data_url" if match else "base64"}
+
+    def _externalize(self, user_id: str, value):
+        if isinstance(value, str):
+            if len(value) >= self.media_min_bytes:
+                return self._store_media(user_id, value) or value
+            return value
+        if isinstance(value, dict):
+            return {k: self._externalize(user_id, v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._externalize(user_id, v) for v in value]
+        return value
+
+    def _inline(self, user_id: str, value):
+        if _is_handle(value):
+            path = self.media_path(user_id, value["$media"])
+            if path is None:
+                return None
+            encoded = base64.b64encode(path.read_bytes()).decode("ascii")
+            return f"data:{value.get('mime')};base64,{encoded}" if value.get("format") == "data_url" else encoded
+        if isinstance(value, dict):
+            return {k: self._inline(user_id, v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._inline(user_id, v) for v in value]
+        return value
+
+    def _collect_media(self, user_id: str, live: set):
+        """Remove media files no handle points to (older than the grace period: a delta may be in flight)."""
+        user_dir = self._user_dir(user_id)
+        if not user_dir.exists():
+            return
+        cutoff = time.time() - self.media_grace_seconds
+        removed = 0
+        for path in user_dir.iterdir():
+            if path.name not in live and not path.name.startswith(".") and path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+                removed += 1
+        if removed:
+            logger.info("session media collected: %d files", removed)
+
+    def _delete_media(self, user_id: str):
+        user_dir = self._user_dir(user_id)
+        if user_dir.exists():
+            for path in user_dir.iterdir():
+                path.unlink(missing_ok=True)
+            user_dir.rmdir()
+
+    # --- state ---
+
+    def _remember(self, user_id: str, session: _Session):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.cache_size:
+            self._sessions.popitem(last=False)
+
+    async def _load(self, user_id: str, cached: bool = True) -> _Session:
+        if cached and user_id in self._sessions:
+            return self._sessions[user_id]
+        row = await self.repo().load_chat_session(user_id)
+        if row is None:
+            session = _Session(0, None, 0, 0, 0)
+        else:
+            doc = json.loads(row["snapshot"])
+            log_bytes = 0
+            for _, ops in row["ops"]:
+                doc = apply_patch(doc, json.loads(ops))
+                log_bytes += len(ops)
+            session = _Session(row["version"], doc, row["snapshot_version"], len(row["ops"]), log_bytes)
+        self._remember(user_id, session)
+        return session
+
+    async def _compact(self, user_id: str, session: _Session):
+        snapshot = json.dumps(session.doc, ensure_ascii=False)
+        await self.repo().compact_chat_session(user_id, session.version, snapshot)
+        self._remember(user_id, _Session(session.version, session.doc, session.version, 0, 0))
+        await asyncio.to_thread(self._collect_media, user_id, _handles(session.doc, set()))
+        logger.info("session compacted at v%d: %d ops, %d bytes folded into %d bytes",
+                    session.version, session.log_ops, session.log_bytes, len(snapshot))
+
+    # --- API ---
+
+    async def get(self, user_id: str, inline_media: bool = False) -> dict:
+        session = await self._load(user_id, cached=False)
+        doc = session.doc
+        if inline_media and doc is not None:
+            doc = await asyncio.to_thread(self._inline, user_id, doc)
+        return {"version": session.version, "snapshot": doc}
+
+    async def put(self, user_id: str, snapshot) -> int:
+        doc = await asyncio.to_thread(self._externalize, user_id, snapshot)
+        version = await self.repo().replace_chat_session(
+            user_id, json.dumps(doc, ensure_ascii=False), datetime.now().isoformat())
+        self._remember(user_id, _Session(version, doc, version, 0, 0))
+        return version
+
+    async def patch(self, user_id: str, base_version: int, ops: list) -> int:
+        session = await self._load(user_id)
+        if session.version != base_version:
+            session = await self._load(user_id, cached=False)  # another worker may have moved it on
+            if session.version != base_version:
+                raise SessionConflict(session.version)
+        ops = await asyncio.to_thread(self._externalize, user_id, ops)
+        doc = apply_patch(session.doc, ops)
+        ops_json = json.dumps(ops, ensure_ascii=False)
+        if not await self.repo().append_chat_session_ops(user_id, base_version, ops_json, datetime.now().isoformat()):
+            self._sessions.pop(user_id, None)
+            raise SessionConflict((await self._load(user_id)).version)
+        session = _Session(base_version + 1, doc, session.snapshot_version,
+                           session.log_ops + 1, session.log_bytes + len(ops_json))
+        self._remember(user_id, session)
+        if session.log_ops >= self.compact_every or session.log_bytes >= self.compact_bytes:
+            await self._compact(user_id, session)
+        return session.version
+
+    async def delete(self, user_id: str):
+        await self.repo().delete_chat_session(user_id)
+        self._sessions.pop(user_id, None)
+        await asyncio.to_thread(self._delete_media, user_id)
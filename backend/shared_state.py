@@ -0,0 +1,164 @@
+"""
+Key-value state shared by every worker process.
+
+Module globals are per process: with `gunicorn -w 4` each worker would fetch
+its own JWKS, generate its own avatar for the same role and keep its own rate
+limit buckets. Small shared state goes here instead:
+
+    SHARED_STATE_URL=redis://...   Redis (several hosts / replicas)
+    otherwise                      SQLite file SHARED_STATE_PATH (one host, any number of workers)
+
+Values are bytes with an optional TTL. The API is synchronous so it can be
+used from sync code paths (JWT verification); async callers use the a*
+variants, which run the blocking call in a worker thread. A failing backend
+degrades to a cache miss, never to a failed request.
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("lifecho.shared_state")
+
+
+class SharedStore(ABC):
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """The value, or None when missing, expired or the backend is unavailable."""
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        """Store value, expiring after ttl seconds if given."""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Remove key; a missing key is not an error."""
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    def close(self):
+        pass
+
+
+class SqliteSharedStore(SharedStore):
+    """One WAL-mode SQLite file; each process keeps its own connection."""
+
+    def __init__(self, path: Path, max_value_bytes: int = 8 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_value_bytes = max_value_bytes
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS shared_state (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL
+                )
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        try:
+            with self._lock:
+                row = self._db().execute(
+                    "SELECT value, expires_at FROM shared_state WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("shared state read failed: %s", e)
+            return None
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return bytes(row[0])
+
+    def set(self, key, value, ttl=None):
+        if len(value) > self.max_value_bytes:
+            return
+        expires_at = time.time() + ttl if ttl else None
+        try:
+            with self._lock:
+                conn = self._db()
+                conn.execute(
+                    "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at),
+                )
+                self._writes += 1
+                if self._writes % 500 == 0:
+                    conn.execute("DELETE FROM shared_state WHERE expires_at < ?", (time.time(),))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("shared state write failed: %s", e)
+
+    def delete(self, key):
+        try:
+            with self._lock:
+                conn = self._db()
+                conn.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("shared state delete failed: %s", e)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RedisSharedStore(SharedStore):
+    def __init__(self, url: str, prefix: str = "lifecho:state:"):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+
+    def _redis(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url, socket_timeout=2)
+        return self._client
+
+    def get(self, key):
+        try:
+            return self._redis().get(self.prefix + key)
+        except Exception as e:
+            logger.warning("shared state read failed: %s: %s", type(e).__name__, e)
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            self._redis().set(self.prefix + key, value, ex=max(1, int(ttl)) if ttl else None)
+        except Exception as e:
+            logger.warning("shared state write failed: %s: %s", type(e).__name__, e)
+
+    def delete(self, key):
+        try:
+            self._redis().delete(self.prefix + key)
+        except Exception as e:
+            logger.warning("shared state delete failed: %s: %s", type(e).__name__, e)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+def create_shared_store(url: Optional[str], sqlite_path: Path) -> SharedStore:
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisSharedStore(url)
+    return SqliteSharedStore(sqlite_path)
@@ -0,0 +1,125 @@
+"""
+Speculative finalization: start the work a finished conversation needs
+before the client asks for it.
+
+When /api/chat answers FINISHED the server already holds the whole
+conversation, and the next requests are predictable: /api/summarize and
+(with images on) /api/generate_image over that same history. The chat turn
+starts them in the background:
+
+    speculator.start(owner, "summarize", key, compute)
+    ...
+    text = await speculator.take(owner, "summarize", key)   # None -> compute as usual
+
+- key is a hash of everything the result depends on (conversation_key); a
+  follow-up with the same key awaits the running task or takes its result
+- a follow-up with another key means the user changed something: the
+  owner's speculation of that kind is cancelled and the route computes
+- a new conversation (or a new FINISHED) from the same owner replaces the
+  older speculation; results expire after ttl, at most max_owners are kept
+
+Owners are the rate-limit identity (user id, else client IP). State is per
+process: a follow-up landing on another worker simply computes (summaries
+still come from the shared model output cache once written). Speculation is
+best effort; a failed task is logged and the route computes normally.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from metrics import SPECULATIVE
+
+logger = logging.getLogger("lifecho.speculative")
+
+
+def conversation_key(*fields: str, history: Iterable[tuple[str, str]]) -> str:
+    payload = json.dumps([list(fields), [list(m) for m in history]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Speculation:
+    key: str
+    task: asyncio.Task
+    started: float
+
+
+class Speculator:
+    def __init__(self, ttl: float = 600.0, max_owners: int = 1024, kinds: Iterable[str] = ()):
+        self.ttl = ttl
+        self.max_owners = max_owners
+        self.kinds = frozenset(kinds)
+        self._owners: "OrderedDict[str, dict[str, _Speculation]]" = OrderedDict()
+
+    def start(self, owner: str, kind: str, key: str, compute: Callable[[], Awaitable[Any]]):
+        """Run compute() in the background unless the same speculation is already there."""
+        if kind not in self.kinds:
+            return
+        entries = self._owners.pop(owner, {})
+        self._owners[owner] = entries  # most recently used last
+        old = entries.get(kind)
+        if old is not None and old.key == key and not old.task.cancelled():
+            return
+        if old is not None:
+            old.task.cancel()
+        entries[kind] = _Speculation(key, asyncio.ensure_future(self._run(kind, compute)), time.monotonic())
+        SPECULATIVE.inc(kind=kind, result="started")
+        while len(self._owners) > self.max_owners:
+            _, evicted = self._owners.popitem(last=False)
+            for spec in evicted.values():
+                spec.task.cancel()
+
+    async def _run(self, kind: str, compute: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        t0 = time.perf_counter()
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            SPECULATIVE.inc(kind=kind, result="failed")
+            logger.warning("speculative %s failed: %s: %s", kind, type(e).__name__, e)
+            return None
+        logger.info("speculative %s ready in %.2fs", kind, time.perf_counter() - t0)
+        return result
+
+    async def take(self, owner: str, kind: str, key: str) -> Optional[Any]:
+        """The speculative result for key, waiting for it if still running; None if there is none."""
+        entries = self._owners.get(owner)
+        spec = entries.get(kind) if entries else None
+        if spec is None:
+            return None
+        if spec.key != key or time.monotonic() - spec.started > self.ttl:
+            spec.task.cancel()
+            del entries[kind]
+            SPECULATIVE.inc(kind=kind, result="discarded")
+            return None
+        was_done = spec.task.done()
+        try:
+            result = await asyncio.shield(spec.task)
+        except asyncio.CancelledError:
+            if not spec.task.cancelled():
+                raise  # our caller went away; the speculation keeps running
+            return None
+        if result is None:
+            entries.pop(kind, None)
+            return None
+        SPECULATIVE.inc(kind=kind, result="hit" if was_done else "joined")
+        return result
+
+    def discard(self, owner: str):
+        """Cancel everything speculated for owner (a new conversation started)."""
+        for kind, spec in self._owners.pop(owner, {}).items():
+            if not spec.task.done():
+                spec.task.cancel()
+                SPECULATIVE.inc(kind=kind, result="discarded")
+
+    def close(self):
+        for entries in self._owners.values():
+            for spec in entries.values():
+                spec.task.cancel()
+        self._owners.clear()
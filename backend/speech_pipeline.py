@@ -0,0 +1,216 @@
+"""
+Sentence-level TTS that overlaps the chat turn's Gemini call.
+
+/api/chat used to wait for the whole JSON answer, parse it, and only then
+synthesize `reply` in one TTS call. With Gemini streaming, the reply field
+is decoded as it arrives (ReplyExtractor); every complete Japanese sentence
+(。！？) is handed to TTS right away, at most max_parallel at a time, while
+the model is still writing the rest:
+
+    pipeline = SpeechPipeline(lambda s: providers.speech.synthesize(s, voice), on_segment=send)
+    async for chunk in providers.text.stream(...):
+        pipeline.feed(extractor.feed(chunk))
+    audio = await pipeline.finish(final_reply)   # stitched MP3, segments in order
+
+With on_segment, each segment is also pushed out (in order) the moment it and
+everything before it are ready, so a streaming client can start playing the
+first sentence while later ones are still being synthesized.
+
+finish() takes the reply as the route finally decided it (the last round
+rewrites it): sentences already synthesized that are still a prefix of it are
+kept, the rest is cancelled and the remainder synthesized. MP3 frames
+concatenate, so the stitched clip is a plain MP3.
+"""
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger("lifecho.tts")
+
+# a sentence ends at 。！？ (or ! ?) plus any closing brackets / quotes right after it
+_SENTENCE_END = re.compile(r"[。！？!?]+[」』）)\"”]*")
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def split_sentences(text: str, final: bool = False) -> tuple[list[str], int]:
+    """Complete sentences in text and how many characters they consume.
+
+    While streaming (final=False) a terminator at the very end may still be
+    followed by another one or a closing quote, so it waits for the next chunk.
+    With final=True any trailing text without a terminator is a sentence too.
+    """
+    sentences, consumed = [], 0
+    for m in _SENTENCE_END.finditer(text):
+        if not final and m.end() == len(text):
+            break
+        sentence = text[consumed:m.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        consumed = m.end()
+    if final and text[consumed:].strip():
+        sentences.append(text[consumed:].strip())
+        consumed = len(text)
+    return sentences, consumed
+
+
+class ReplyExtractor:
+    """Decodes one string field of a JSON object while the object is still streaming in."""
+
+    def __init__(self, field: str = "reply"):
+        self._start = re.compile(rf'"{re.escape(field)}"\s*:\s*"')
+        self._buffer = ""
+        self._pos: Optional[int] = None
+        self.value = ""
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """Append a chunk of the raw model output; returns the field's value decoded so far."""
+        self._buffer += chunk
+        if self._pos is None:
+            m = self._start.search(self._buffer)
+            if m is None:
+                return self.value
+            self._pos = m.end()
+        buf, i, out = self._buffer, self._pos, []
+        while i < len(buf) and not self.done:
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break  # escape split across chunks
+            esc = buf[i + 1]
+            if esc != "u":
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            code = int(buf[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:  # surrogate pair: emoji and friends
+                if i + 12 > len(buf):
+                    break
+                low = int(buf[i + 8:i + 12], 16)
+                code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                i += 6
+            out.append(chr(code))
+            i += 6
+        self._pos = i
+        self.value += "".join(out)
+        return self.value
+
+
+def _without_spaces(text: str) -> str:
+    return re.sub(r"\s+", "", text)
+
+
+class SpeechPipeline:
+    def __init__(self, synthesize: Callable[[str], Awaitable[bytes]], max_parallel: int = 2,
+                 on_segment: Optional[Callable[[int, str, bytes], Awaitable[None]]] = None,
+                 min_chars: int = 4):
+        self.synthesize = synthesize
+        self.on_segment = on_segment
+        self.min_chars = min_chars
+        self._slots = asyncio.Semaphore(max_parallel)
+        self._segments: list[tuple[str, asyncio.Task]] = []
+        self._fed = 0           # characters of the streamed reply already split off
+        self._carry = ""        # a too-short sentence waiting to be joined with the next
+        self._emitted = 0
+        self._emit_lock = asyncio.Lock()
+        self._added = asyncio.Event()
+        self._emitter: Optional[asyncio.Task] = None
+        if on_segment is not None:
+            self._emitter = asyncio.ensure_future(self._stream_segments())
+
+    async def _synthesize(self, text: str) -> bytes:
+        async with self._slots:
+            return await self.synthesize(text)
+
+    def _start(self, sentence: str):
+        sentence = self._carry + sentence
+        if len(sentence) < self.min_chars:
+            self._carry = sentence  # "へえ。" alone is not worth a TTS round trip
+            return
+        self._carry = ""
+        self._segments.append((sentence, asyncio.ensure_future(self._synthesize(sentence))))
+        self._added.set()
+
+    def feed(self, reply_so_far: str):
+        """Start TTS for every sentence of the (partial) reply that is now complete."""
+        sentences, consumed = split_sentences(reply_so_far[self._fed:])
+        self._fed += consumed
+        for sentence in sentences:
+            self._start(sentence)
+
+    async def _emit_ready(self):
+        # segments go out strictly in order, each as soon as it and all before it are done
+        async with self._emit_lock:
+            while self.on_segment is not None and self._emitted < len(self._segments):
+                text, task = self._segments[self._emitted]
+                if not task.done() or task.cancelled() or task.exception() is not None:
+                    return  # a failed segment is reported by finish()
+                await self.on_segment(self._emitted, text, task.result())
+                self._emitted += 1
+
+    async def _stream_segments(self):
+        while True:
+            if self._emitted < len(self._segments):
+                await asyncio.wait({self._segments[self._emitted][1]})
+            else:
+                self._added.clear()
+                await self._added.wait()
+            await self._emit_ready()
+            if self._emitted < len(self._segments) and self._segments[self._emitted][1].done():
+                return  # stuck on a failed segment
+
+    async def finish(self, final_reply: str) -> bytes:
+        """Synthesize whatever of final_reply is not covered yet; returns all segments stitched in order."""
+        spoken = _without_spaces("".join(text for text, _ in self._segments))
+        target = _without_spaces(final_reply)
+        if not target.startswith(spoken):
+            # the route rewrote the reply (last round): drop what no longer matches
+            keep, covered = 0, ""
+            for text, _ in self._segments:
+                if not target.startswith(covered + _without_spaces(text)):
+                    break
+                covered += _without_spaces(text)
+                keep += 1
+            keep = max(keep, self._emitted)  # emitted audio was already heard; never take it back
+            for _, task in self._segments[keep:]:
+                task.cancel()
+            logger.debug("回复被改写，保留 %d/%d 段已合成语音", keep, len(self._segments))
+            self._segments = self._segments[:keep]
+            spoken = _without_spaces("".join(text for text, _ in self._segments))
+            self._carry = ""
+        # map the spoken prefix (spaces ignored) back onto final_reply
+        i = matched = 0
+        while i < len(final_reply) and matched < len(spoken):
+            if not final_reply[i].isspace():
+                matched += 1
+            i += 1
+        rest, _ = split_sentences(final_reply[i:], final=True)
+        for sentence in rest:
+            self._start(sentence)
+        if self._carry:
+            self._segments.append((self._carry, asyncio.ensure_future(self._synthesize(self._carry))))
+            self._carry = ""
+        try:
+            audio = [await task for _, task in self._segments]
+        except BaseException:
+            self.cancel()
+            raise
+        if self._emitter is not None:
+            self._emitter.cancel()
+        await self._emit_ready()
+        return b"".join(audio)
+
+    def cancel(self):
+        if self._emitter is not None:
+            self._emitter.cancel()
+        for _, task in self._segments:
+            task.cancel()
@@ -0,0 +1,234 @@
+"""
+One TTS front for /api/tts, /api/chat (whole reply or sentence segments) and
+podcast audio.
+
+Synthesis is a pure function of (provider profile, voice, text), and a lot of
+it repeats: the forced ending line closes every session, replayed turns and
+regenerated podcasts send the same lines again. SpeechService puts a
+content-addressed cache in front of providers.speech:
+
+    key  = sha256(provider profile, voice name, text)
+    disk = SPEECH_CACHE_DIR/ab/abcdef....mp3       (size-bounded, LRU by mtime)
+    RAM  = LRU of the hottest clips                 (memory_max_bytes)
+
+Lookups go memory -> disk -> provider; concurrent requests for the same key
+share one synthesis. Files are written to a temp name and renamed, so several
+workers can share the directory and a crash never leaves half an MP3 behind;
+each worker indexes the directory and adopts files the others wrote.
+Known fixed phrases are synthesized once at startup (prewarm) so even the
+first session of the day gets them from the cache.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from metrics import TTS_CACHE_BYTES, TTS_CACHE_HIT_RATIO, TTS_CACHE_REQUESTS, TTS_CACHE_SAVED_BYTES
+from providers import SpeechProvider
+from resilience import SingleFlight
+
+logger = logging.getLogger("lifecho.tts")
+
+
+def speech_key(profile: str, voice_name: str, text: str) -> str:
+    h = hashlib.sha256()
+    for item in (profile, voice_name, text):
+        data = item.encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+class SpeechCache:
+    def __init__(self, directory: Path, max_bytes: int = 256 * 1024 * 1024,
+                 memory_max_bytes: int = 16 * 1024 * 1024, enabled: bool = True):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_total = 0
+        self._index: Optional["OrderedDict[str, int]"] = None  # key -> size, oldest first
+        self._disk_total = 0
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.mp3"
+
+    # --- sync implementations, called via asyncio.to_thread ---
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        files = []
+        if self.directory.exists():
+            for path in self.directory.glob("*/*.mp3"):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, path.stem, st.st_size))
+        files.sort()
+        self._index = OrderedDict((key, size) for _, key, size in files)
+        self._disk_total = sum(self._index.values())
+        TTS_CACHE_BYTES.set(self._disk_total, tier="disk")
+
+    def _read(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._load_index()
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+                os.utime(path)  # mtime is the LRU clock across restarts and workers
+            except FileNotFoundError:
+                # never written, or another worker evicted it
+                self._disk_total -= self._index.pop(key, 0)
+                return None
+            if key not in self._index:
+                # written by another worker since the index was loaded
+                self._index[key] = len(data)
+                self._disk_total += len(data)
+            self._index.move_to_end(key)
+            return data
+
+    def _write(self, key: str, data: bytes):
+        if len(data) > self.max_bytes // 10:
+            return  # one clip may not take over the cache
+        with self._lock:
+            self._load_index()
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            self._disk_total += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            if self._disk_total > self.max_bytes:
+                self._evict()
+            TTS_CACHE_BYTES.set(self._disk_total, tier="disk")
+
+    def _evict(self):
+        """Least recently used files go first, down to 90% of max_bytes."""
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self._index and self._disk_total > target:
+            key, size = self._index.popitem(last=False)
+            self._path(key).unlink(missing_ok=True)
+            self._disk_total -= size
+            evicted += 1
+        logger.info("TTS 缓存淘汰 %d 个文件，剩余 %d 字节", evicted, self._disk_total)
+
+    # --- memory tier (event loop only) ---
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_max_bytes // 4:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_total += len(data)
+        while self._memory_total > self.memory_max_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_total -= len(old)
+        TTS_CACHE_BYTES.set(self._memory_total, tier="memory")
+
+    # --- async API ---
+
+    async def get(self, key: str) -> tuple[Optional[bytes], str]:
+        """(audio, tier): tier is "memory", "disk" or "miss"."""
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            return data, "memory"
+        try:
+            data = await asyncio.to_thread(self._read, key)
+        except OSError as e:
+            logger.warning("TTS 缓存读取失败: %s", e)
+            data = None
+        if data is None:
+            return None, "miss"
+        self._remember(key, data)
+        return data, "disk"
+
+    async def put(self, key: str, data: bytes):
+        self._remember(key, data)
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError as e:
+            logger.warning("TTS 缓存写入失败: %s", e)
+
+
+class SpeechService:
+    def __init__(self, provider: Callable[[], SpeechProvider], cache: SpeechCache):
+        self.provider = provider  # a getter: tests and load tests swap main1.providers
+        self.cache = cache
+        self._inflight = SingleFlight()
+        self.requests = 0
+        self.hits = 0
+        self.saved_bytes = 0
+
+    def _count(self, result: str, size: int = 0):
+        TTS_CACHE_REQUESTS.inc(result=result)
+        self.requests += 1
+        if result != "miss":
+            self.hits += 1
+            self.saved_bytes += size
+            TTS_CACHE_SAVED_BYTES.inc(size)
+        TTS_CACHE_HIT_RATIO.set(self.hits / self.requests)
+
+    async def synthesize(self, text: str, voice_name: str) -> bytes:
+        """MP3 bytes for text in voice_name, from the cache when this exact clip was made before."""
+        provider = self.provider()
+        if not self.cache.enabled:
+            return await provider.synthesize(text, voice_name)
+        key = speech_key(provider.profile, voice_name, text)
+        data, tier = await self.cache.get(key)
+        if data is not None:
+            self._count(tier, len(data))
+            return data
+        shared = key in self._inflight
+        if not shared:
+            self._count("miss")
+
+        async def fill() -> bytes:
+            # runs in the shared task: the clip is cached even if the request that started it is gone
+            clip = await provider.synthesize(text, voice_name)
+            await self.cache.put(key, clip)
+            return clip
+
+        data = await self._inflight.do(key, fill)
+        if shared:
+            self._count("shared", len(data))
+        return data
+
+    async def prewarm(self, phrases: Iterable[tuple[str, str]]):
+        """Synthesize (text, voice_name) pairs that are not cached yet; failures are only logged."""
+        if not self.cache.enabled:
+            return
+        t0 = time.perf_counter()
+        made = 0
+        for text, voice_name in phrases:
+            key = speech_key(self.provider().profile, voice_name, text)
+            data, _ = await self.cache.get(key)
+            if data is not None:
+                continue
+            try:
+                await self.cache.put(key, await self.provider().synthesize(text, voice_name))
+                made += 1
+            except Exception as e:
+                logger.warning("TTS 预热失败（%s）: %s", text[:20], e)
+        logger.info("TTS 预热完成: 新合成 %d 条, %.2fs", made, time.perf_counter() - t0)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.requests, 4) if self.requests else 0.0,
+            "saved_bytes": self.saved_bytes,
+        }
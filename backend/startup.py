@@ -0,0 +1,108 @@
+"""
+Lazy initialization helpers.
+
+Importing main1 must stay cheap: SDK modules are imported on first attribute
+access, API clients are built on first use (or by the warm-up task started
+from the app lifespan), and every resource records its state and timing so
+/readyz can report what is still cold or broken.
+"""
+import asyncio
+import importlib
+import threading
+import time
+from typing import Any, Callable, Optional
+
+
+class LazyModule:
+    """Stand-in for a module: imports it on first attribute access, then runs on_load once."""
+
+    def __init__(self, name: str, on_load: Optional[Callable[[Any], None]] = None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+        self._lock = threading.Lock()
+        self.load_ms: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    t0 = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    if self._on_load:
+                        self._on_load(module)
+                    self.load_ms = round((time.perf_counter() - t0) * 1000, 1)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, item):
+        return getattr(self.load(), item)
+
+    def status(self) -> dict:
+        return {"state": "ready" if self.loaded else "cold", "load_ms": self.load_ms}
+
+
+class LazyResource:
+    """A value built once on first get(). Failures are remembered and only retried after retry_after seconds."""
+
+    def __init__(self, name: str, factory: Callable[[], Any], required: bool = True, retry_after: float = 60.0):
+        self.name = name
+        self.required = required
+        self._factory = factory
+        self._retry_after = retry_after
+        self._lock = threading.Lock()
+        self._value = None
+        self._ready = False
+        self._failed_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.init_ms: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    def get(self):
+        if self._ready:
+            return self._value
+        with self._lock:
+            if self._ready:
+                return self._value
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self._retry_after:
+                raise RuntimeError(f"{self.name} unavailable: {self.error}")
+            t0 = time.perf_counter()
+            try:
+                self._value = self._factory()
+            except Exception as e:
+                self._failed_at = time.monotonic()
+                self.error = f"{type(e).__name__}: {e}"
+                raise
+            self.init_ms = round((time.perf_counter() - t0) * 1000, 1)
+            self._failed_at = None
+            self.error = None
+            self._ready = True
+            return self._value
+
+    def get_or_none(self):
+        try:
+            return self.get()
+        except Exception:
+            return None
+
+    async def aget_or_none(self):
+        """get_or_none() that never blocks the event loop on a cold build."""
+        if self._ready:
+            return self._value
+        return await asyncio.to_thread(self.get_or_none)
+
+    def status(self) -> dict:
+        if self._ready:
+            state = "ready"
+        elif self.error:
+            state = "failed"
+        else:
+            state = "cold"
+        return {"state": state, "required": self.required, "init_ms": self.init_ms, "error": self.error}
@@ -0,0 +1,302 @@
+"""Retry, hedging, circuit breaking and stream timeouts in resilience.py."""
+import asyncio
+import time
+
+import pytest
+
+from providers import EmptyResponseError, TextProvider, UpstreamError
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ResilientCall,
+    ResilientTextProvider,
+    RetryBudget,
+    RetryPolicy,
+    SingleFlight,
+)
+
+
+def make_call(attempts=3, threshold=5, reset_timeout=30.0, attempt_timeout=None, hedge_default=3.0,
+              budget=None) -> ResilientCall:
+    return ResilientCall(
+        "test",
+        RetryPolicy(attempts=attempts, base_delay=0.0, max_delay=0.0, attempt_timeout=attempt_timeout),
+        CircuitBreaker("test", threshold, reset_timeout),
+        budget=budget,
+        hedge_default=hedge_default,
+        hedge_min=0.0,
+    )
+
+
+class Flaky:
+    """Fails with the given exceptions in order, then answers "ok"."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+# --- retry ---
+
+def test_retries_retryable_errors_until_success():
+    fn = Flaky(UpstreamError("503"), UpstreamError("503"))
+    assert asyncio.run(make_call()(fn)) == "ok"
+    assert fn.calls == 3
+
+
+def test_gives_up_after_the_last_attempt():
+    fn = Flaky(*[UpstreamError("503")] * 3)
+    with pytest.raises(UpstreamError):
+        asyncio.run(make_call(attempts=3)(fn))
+    assert fn.calls == 3
+
+
+def test_does_not_retry_other_errors():
+    fn = Flaky(KeyError("bad input"))
+    with pytest.raises(KeyError):
+        asyncio.run(make_call()(fn))
+    assert fn.calls == 1
+
+
+def test_empty_retry_budget_stops_retries():
+    fn = Flaky(UpstreamError("503"))
+    with pytest.raises(UpstreamError):
+        asyncio.run(make_call(budget=RetryBudget(ratio=0.0, initial=0.0))(fn))
+    assert fn.calls == 1
+
+
+def test_attempt_timeout_is_retried():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(5)
+        return "ok"
+
+    assert asyncio.run(make_call(attempt_timeout=0.05)(fn)) == "ok"
+    assert len(calls) == 2
+
+
+# --- circuit breaker ---
+
+def test_breaker_opens_and_fails_fast():
+    call = make_call(attempts=1, threshold=2)
+    fn = Flaky(*[UpstreamError("503")] * 2)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                await call(fn)
+        with pytest.raises(CircuitOpenError):
+            await call(fn)
+
+    asyncio.run(scenario())
+    assert call.breaker.state == CircuitBreaker.OPEN
+    assert fn.calls == 2  # the rejected call never reached the upstream
+
+
+def test_breaker_half_open_probe_closes_it():
+    call = make_call(attempts=1, threshold=1, reset_timeout=0.05)
+    fn = Flaky(UpstreamError("503"))
+
+    async def scenario():
+        with pytest.raises(UpstreamError):
+            await call(fn)
+        assert call.breaker.state == CircuitBreaker.OPEN
+        await asyncio.sleep(0.06)
+        assert await call(fn) == "ok"
+
+    asyncio.run(scenario())
+    assert call.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_empty_answers_do_not_trip_the_breaker():
+    call = make_call(attempts=1, threshold=1)
+    with pytest.raises(EmptyResponseError):
+        asyncio.run(call(Flaky(EmptyResponseError("blocked"))))
+    assert call.breaker.state == CircuitBreaker.CLOSED
+
+
+# --- hedging ---
+
+def test_hedge_takes_the_faster_request_and_cancels_the_other():
+    started, cancelled = [], []
+
+    async def fn():
+        started.append(1)
+        if len(started) == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+        return f"attempt {len(started)}"
+
+    async def scenario():
+        t0 = time.perf_counter()
+        result = await make_call(hedge_default=0.05)(fn, hedge=True)
+        await asyncio.sleep(0)  # let the cancellation land
+        return result, time.perf_counter() - t0
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == "attempt 2"
+    assert elapsed < 1
+    assert cancelled == [1]
+
+
+def test_no_hedge_without_the_flag():
+    started = []
+
+    async def fn():
+        started.append(1)
+        await asyncio.sleep(0.1)
+        return "ok"
+
+    assert asyncio.run(make_call(hedge_default=0.01)(fn)) == "ok"
+    assert len(started) == 1
+
+
+# --- streams ---
+
+class StreamProvider(TextProvider):
+    """Each stream() call follows the next script: (delay before first chunk, chunks, stall after first)."""
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.opened = 0
+        self.closed = 0
+
+    async def generate(self, contents, **kwargs):
+        raise NotImplementedError
+
+    async def stream(self, contents, *, system_instruction=None, history=None, json_mode=False, hedge=False):
+        first_delay, chunks, stall = self.scripts[min(self.opened, len(self.scripts) - 1)]
+        self.opened += 1
+        try:
+            await asyncio.sleep(first_delay)
+            for i, chunk in enumerate(chunks):
+                if i == 1 and stall:
+                    await asyncio.sleep(stall)
+                yield chunk
+        finally:
+            self.closed += 1
+
+
+async def collect(stream) -> list[str]:
+    return [chunk async for chunk in stream]
+
+
+def test_stream_hedge_keeps_the_faster_stream_and_closes_the_slow_one():
+    inner = StreamProvider((5.0, ["slow"], 0), (0.0, ["fast ", "reply"], 0))
+    provider = ResilientTextProvider(inner, make_call(hedge_default=0.05))
+
+    async def scenario():
+        chunks = await collect(provider.stream(["hi"], hedge=True))
+        await asyncio.sleep(0)
+        return chunks
+
+    assert asyncio.run(scenario()) == ["fast ", "reply"]
+    assert inner.opened == 2
+    assert inner.closed == 2
+
+
+def test_stream_retries_before_the_first_chunk():
+    inner = StreamProvider((0.0, [], 0), (0.0, ["ok"], 0))  # the first stream ends without text
+    provider = ResilientTextProvider(inner, make_call())
+    assert asyncio.run(collect(provider.stream(["hi"]))) == ["ok"]
+    assert inner.opened == 2
+
+
+def test_stream_stall_after_the_first_chunk_times_out():
+    inner = StreamProvider((0.0, ["one ", "two"], 5.0))
+    call = make_call(threshold=1)
+    provider = ResilientTextProvider(inner, call, stream_idle_timeout=0.05)
+    received = []
+
+    async def scenario():
+        async for chunk in provider.stream(["hi"]):
+            received.append(chunk)
+
+    t0 = time.perf_counter()
+    with pytest.raises(UpstreamError):
+        asyncio.run(scenario())
+    assert time.perf_counter() - t0 < 1
+    assert received == ["one "]
+    assert inner.opened == 1  # text already reached the caller: not retried
+    assert inner.closed == 1
+    assert call.breaker.state == CircuitBreaker.OPEN
+
+
+def test_stream_closed_when_the_caller_stops_early():
+    inner = StreamProvider((0.0, ["a", "b", "c"], 0))
+    provider = ResilientTextProvider(inner, make_call())
+
+    async def scenario():
+        stream = provider.stream(["hi"])
+        async for _ in stream:
+            break
+        await stream.aclose()
+
+    asyncio.run(scenario())
+    assert inner.closed == 1
+
+
+# --- single flight ---
+
+def test_single_flight_shares_one_run():
+    flight = SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return "clip"
+
+    async def scenario():
+        return await asyncio.gather(*(flight.do("k", work) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == ["clip"] * 3
+    assert runs == [1]
+
+
+def test_single_flight_cancelled_caller_does_not_cancel_the_others():
+    flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "clip"
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do("k", work))
+        second = asyncio.ensure_future(flight.do("k", work))
+        await asyncio.sleep(0.01)
+        first.cancel()  # the client that started the work disconnects
+        assert await second == "clip"
+        assert first.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_errors_reach_every_caller_and_free_the_key():
+    flight = SingleFlight()
+    fn = Flaky(UpstreamError("503"))
+
+    async def work():
+        await asyncio.sleep(0.01)
+        return await fn()
+
+    async def scenario():
+        results = await asyncio.gather(flight.do("k", work), flight.do("k", work), return_exceptions=True)
+        assert all(isinstance(r, UpstreamError) for r in results)
+        assert "k" not in flight
+        assert await flight.do("k", work) == "ok"  # the next call runs the work again
+
+    asyncio.run(scenario())
+    assert fn.calls == 2
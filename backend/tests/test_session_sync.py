@@ -0,0 +1,176 @@
+"""JSON Patch operations, version conflicts and out-of-line media in session_sync.py."""
+import asyncio
+import base64
+
+import pytest
+
+from journal_store import SqliteJournalRepository
+from session_sync import PatchError, SessionConflict, SessionSync, apply_patch
+
+DOC = {"turns": [{"text": "a"}, {"text": "b"}], "summary": "s", "meta": {"round": 1}}
+
+
+# --- RFC 6902 operations ---
+
+def test_add_sets_a_member_and_inserts_into_a_list():
+    doc = apply_patch(DOC, [
+        {"op": "add", "path": "/tone", "value": "casual"},
+        {"op": "add", "path": "/turns/1", "value": {"text": "x"}},
+    ])
+    assert doc["tone"] == "casual"
+    assert [t["text"] for t in doc["turns"]] == ["a", "x", "b"]
+
+
+def test_add_with_dash_appends_to_a_list():
+    doc = apply_patch(DOC, [{"op": "add", "path": "/turns/-", "value": {"text": "c"}}])
+    assert [t["text"] for t in doc["turns"]] == ["a", "b", "c"]
+
+
+def test_remove():
+    doc = apply_patch(DOC, [{"op": "remove", "path": "/turns/0"}, {"op": "remove", "path": "/summary"}])
+    assert doc["turns"] == [{"text": "b"}]
+    assert "summary" not in doc
+
+
+def test_replace_a_member_and_the_root():
+    assert apply_patch(DOC, [{"op": "replace", "path": "/meta/round", "value": 2}])["meta"] == {"round": 2}
+    assert apply_patch(DOC, [{"op": "replace", "path": "", "value": {"new": True}}]) == {"new": True}
+
+
+def test_move_and_copy():
+    doc = apply_patch(DOC, [
+        {"op": "move", "from": "/summary", "path": "/meta/summary"},
+        {"op": "copy", "from": "/turns/0", "path": "/turns/-"},
+    ])
+    assert "summary" not in doc and doc["meta"]["summary"] == "s"
+    assert doc["turns"][-1] == {"text": "a"}
+    doc["turns"][-1]["text"] = "changed"
+    assert doc["turns"][0] == {"text": "a"}  # a copy, not the same object
+
+
+def test_test_op_guards_the_patch():
+    assert apply_patch(DOC, [{"op": "test", "path": "/meta/round", "value": 1}]) == DOC
+    with pytest.raises(PatchError):
+        apply_patch(DOC, [{"op": "test", "path": "/meta/round", "value": 2}])
+
+
+def test_escaped_pointer_tokens():
+    doc = apply_patch({"a/b": 1, "m~n": 2}, [
+        {"op": "replace", "path": "/a~1b", "value": 10},
+        {"op": "remove", "path": "/m~0n"},
+    ])
+    assert doc == {"a/b": 10}
+
+
+def test_failed_patch_leaves_the_document_untouched():
+    doc = {"turns": []}
+    with pytest.raises(PatchError):
+        apply_patch(doc, [{"op": "add", "path": "/turns/-", "value": 1}, {"op": "remove", "path": "/missing"}])
+    assert doc == {"turns": []}
+
+
+@pytest.mark.parametrize("op", [
+    {"op": "add", "path": "turns/0", "value": 1},          # not a JSON pointer
+    {"op": "add", "path": "/missing/x", "value": 1},       # parent does not exist
+    {"op": "add", "path": "/turns/5", "value": 1},         # past the end of the list
+    {"op": "add", "path": "/turns/01", "value": 1},        # leading zero
+    {"op": "add", "path": "/summary/x", "value": 1},       # into a scalar
+    {"op": "remove", "path": "/turns/-"},                  # "-" only names a new element
+    {"op": "remove", "path": "/nothing"},
+    {"op": "remove", "path": ""},                          # the root
+    {"op": "replace", "path": "/turns/2", "value": 1},
+    {"op": "replace", "path": "/summary"},                 # no value
+    {"op": "move", "from": "/nothing", "path": "/x"},
+    {"op": "copy", "from": "/turns/9", "path": "/x"},
+    {"op": "merge", "path": "/summary", "value": 1},       # unknown op
+    "not an object",
+])
+def test_invalid_operations_raise_patch_error(op):
+    with pytest.raises(PatchError):
+        apply_patch(DOC, [op])
+
+
+# --- SessionSync against a SQLite repository ---
+
+def make_sync(tmp_path, **kwargs) -> SessionSync:
+    repo = SqliteJournalRepository(tmp_path / "journals.db")
+    return SessionSync(lambda: repo, tmp_path / "media", media_min_bytes=64, **kwargs)
+
+
+def run(sync: SessionSync, scenario):
+    async def main():
+        try:
+            return await scenario(sync)
+        finally:
+            await sync.repo().close()
+
+    return asyncio.run(main())
+
+
+def test_patches_advance_the_version(tmp_path):
+    async def scenario(sync):
+        assert await sync.put("u1", {"turns": []}) == 1
+        assert await sync.patch("u1", 1, [{"op": "add", "path": "/turns/-", "value": "hi"}]) == 2
+        assert await sync.patch("u1", 2, [{"op": "add", "path": "/turns/-", "value": "again"}]) == 3
+        sync._sessions.clear()  # another worker: rebuilt from snapshot + op log
+        return await sync.get("u1")
+
+    assert run(make_sync(tmp_path), scenario) == {"version": 3, "snapshot": {"turns": ["hi", "again"]}}
+
+
+def test_stale_base_version_conflicts(tmp_path):
+    async def scenario(sync):
+        await sync.put("u1", {"turns": []})
+        await sync.patch("u1", 1, [{"op": "add", "path": "/turns/-", "value": "first"}])
+        with pytest.raises(SessionConflict) as conflict:
+            await sync.patch("u1", 1, [{"op": "add", "path": "/turns/-", "value": "stale"}])
+        return conflict.value.version, await sync.get("u1")
+
+    version, session = run(make_sync(tmp_path), scenario)
+    assert version == 2
+    assert session["snapshot"] == {"turns": ["first"]}  # the stale delta was not applied
+
+
+def test_invalid_patch_is_not_stored(tmp_path):
+    async def scenario(sync):
+        await sync.put("u1", {"turns": []})
+        with pytest.raises(PatchError):
+            await sync.patch("u1", 1, [{"op": "remove", "path": "/turns/0"}])
+        return await sync.get("u1")
+
+    assert run(make_sync(tmp_path), scenario) == {"version": 1, "snapshot": {"turns": []}}
+
+
+def test_media_is_stored_once_and_read_back(tmp_path):
+    audio = b"ID3" + bytes(range(256)) * 4
+    encoded = base64.b64encode(audio).decode("ascii")
+    data_url = "data:image/png;base64," + base64.b64encode(b"\x89PNG" + bytes(200)).decode("ascii")
+
+    async def scenario(sync):
+        await sync.put("u1", {"turns": [{"audio": encoded}]})
+        await sync.patch("u1", 1, [{"op": "add", "path": "/scene", "value": data_url}])
+        return await sync.get("u1"), await sync.get("u1", inline_media=True)
+
+    sync = make_sync(tmp_path)
+    stored, inlined = run(sync, scenario)
+    handle = stored["snapshot"]["turns"][0]["audio"]
+    assert handle["mime"] == "audio/mpeg" and handle["format"] == "base64"
+    assert sync.media_path("u1", handle["$media"]).read_bytes() == audio
+    assert stored["snapshot"]["scene"]["format"] == "data_url"
+    assert inlined["snapshot"] == {"turns": [{"audio": encoded}], "scene": data_url}
+    assert sync.media_path("u2", handle["$media"]) is None  # media is per user
+    assert sync.media_path("u1", "../journals.db") is None
+
+
+def test_compaction_keeps_the_document(tmp_path):
+    async def scenario(sync):
+        await sync.put("u1", {"turns": []})
+        for version in range(1, 6):
+            await sync.patch("u1", version, [{"op": "add", "path": "/turns/-", "value": version}])
+        row = await sync.repo().load_chat_session("u1")
+        sync._sessions.clear()
+        return row, await sync.get("u1")
+
+    row, session = run(make_sync(tmp_path, compact_every=2), scenario)
+    assert session == {"version": 6, "snapshot": {"turns": [1, 2, 3, 4, 5]}}
+    assert row["snapshot_version"] == 5 and len(row["ops"]) == 1
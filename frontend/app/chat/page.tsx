@@ -182,7 +182,7 @@ export default function LifeCHOPage() {
 
   // 对话轮次：先转写确认再发送
   const [pendingUserText, setPendingUserText] = useState<string | null>(null);
-  const [pendingAudioData, setPendingAudioData] = useState<{ base64: string; mimeType: string } | null>(null);
+  const [pendingAudioData, setPendingAudioData] = useState<{ base64: string; mimeType: string; audioId?: string } | null>(null);
   const [isTranscribingChat, setIsTranscribingChat] = useState(false);
 
   // 获取支持的 mimeType
@@ -366,7 +366,7 @@ export default function LifeCHOPage() {
       if (response.ok) {
         const data = await response.json();
         if (data.status === 'SUCCESS' && data.image_base64) {
-          setAiAvatar(`data:image/png;base64,${data.image_base64}`);
+          setAiAvatar(`data:${data.mime_type || 'image/png'};base64,${data.image_base64}`);
         } else if (data.status === 'ERROR') {
           console.error('API returned error:', data.error);
           setAiAvatar(null);
@@ -738,7 +738,8 @@ export default function LifeCHOPage() {
             
             // 2. 生成播客音频
             if (podcastData.script && podcastData.script.length > 0) {
-              const audioResponse = await backend(`/api/generate_podcast_audio`, {
+              // 后端边合成边写，返回的地址可以直接给 <audio> 流式播放
+              const audioResponse = await backend(`/api/podcast_audio`, {
                 method: 'POST',
                 headers: {
                   'Content-Type': 'application/json',
@@ -747,14 +748,11 @@ export default function LifeCHOPage() {
                   script: podcastData.script
                 }),
               });
-              
+
               if (audioResponse.ok) {
                 const audioData = await audioResponse.json();
-                if (audioData.audio_base64) {
-                  // 将base64转换为blob URL
-                  const audioBlob = await fetch(`data:audio/mp3;base64,${audioData.audio_base64}`).then(res => res.blob());
-                  const audioUrl = URL.createObjectURL(audioBlob);
-                  setPodcastAudioUrl(audioUrl);
+                if (audioData.url) {
+                  setPodcastAudioUrl(`${API_BASE_URL}${audioData.url}`);
                 }
               }
             }
@@ -789,13 +787,13 @@ export default function LifeCHOPage() {
                     const scene2 = imageData.scenes[1];
                     
                     if (scene1.image_base64) {
-                      const imgBlob1 = await fetch(`data:image/png;base64,${scene1.image_base64}`).then(res => res.blob());
+                      const imgBlob1 = await fetch(`data:${scene1.mime_type || 'image/png'};base64,${scene1.image_base64}`).then(res => res.blob());
                       const imgUrl1 = URL.createObjectURL(imgBlob1);
                       setSceneImages(prev => ({...prev, scene_1: imgUrl1}));
                     }
                     
                     if (scene2.image_base64) {
-                      const imgBlob2 = await fetch(`data:image/png;base64,${scene2.image_base64}`).then(res => res.blob());
+                      const imgBlob2 = await fetch(`data:${scene2.mime_type || 'image/png'};base64,${scene2.image_base64}`).then(res => res.blob());
                       const imgUrl2 = URL.createObjectURL(imgBlob2);
                       setSceneImages(prev => ({...prev, scene_2: imgUrl2}));
                     }
@@ -931,6 +929,50 @@ export default function LifeCHOPage() {
     }
   };
 
+  // /api/chat 的流式模式（NDJSON）：回复语音按句推送，到一段播一段；返回最后一行的完整结果
+  const readChatStream = async (response: Response, onSegment: (audioBase64: string) => void) => {
+    if (!(response.headers.get('content-type') || '').includes('application/x-ndjson') || !response.body) {
+      return response.json();
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result: any = null;
+    for (;;) {
+      const { done, value } = await reader.read();
+      buffer += decoder.decode(value, { stream: !done });
+      let newline: number;
+      while ((newline = buffer.indexOf('\n')) >= 0) {
+        const line = buffer.slice(0, newline).trim();
+        buffer = buffer.slice(newline + 1);
+        if (!line) continue;
+        const event = JSON.parse(line);
+        if (event.type === 'audio') onSegment(event.audio_base64);
+        else if (event.type === 'result') result = event;
+      }
+      if (done) break;
+    }
+    if (!result) throw new Error('API返回数据格式错误');
+    return result;
+  };
+
+  // 按顺序播放语音片段：前一段播完再播下一段
+  const createSegmentPlayer = () => {
+    let queue: Promise<void> = Promise.resolve();
+    let played = 0;
+    const enqueue = (audioBase64: string) => {
+      played++;
+      queue = queue.then(() => new Promise<void>((resolve) => {
+        if (currentReplyAudio) currentReplyAudio.pause();
+        const audio = new Audio(`data:audio/mp3;base64,${audioBase64}`);
+        audio.onended = () => resolve();
+        audio.onerror = () => resolve();
+        audio.play().catch(() => resolve());
+      }));
+    };
+    return { enqueue, get played() { return played; } };
+  };
+
   const toggleReplyAudioForTurn = async (idx: number) => {
     // 如果当前正在播放这一轮，暂停
     if (playingReplyIdx === idx && currentReplyAudio) {
@@ -1184,7 +1226,8 @@ export default function LifeCHOPage() {
       const data = await res.json();
       if (data.status === 'SUCCESS' && data.text && data.text.trim()) {
         setPendingUserText(data.text);
-        setPendingAudioData(audioData);
+        // 转写时后端已接入这段录音，发送时只传 audio_id
+        setPendingAudioData({ ...audioData, audioId: data.audio_id });
       } else {
         setVoiceError('没有识别到语音内容，请再说一遍');
         setTimeout(() => setVoiceError(null), 3000);
@@ -1216,9 +1259,10 @@ export default function LifeCHOPage() {
         '严肃/工作': 'Serious'
       };
       
-      const response = await backend(`/api/chat`, {
+      const segments = createSegmentPlayer();
+      const sendChat = (withAudioBytes: boolean) => backend(`/api/chat`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Accept': 'application/x-ndjson' },
         body: JSON.stringify({
           context: entryText,
           tone: toneMap[tone] || 'Gentle',
@@ -1229,13 +1273,21 @@ export default function LifeCHOPage() {
             { role: 'user', content: confirmedText }
           ],
           previous_communication_raw: communicationRaw,
-          audio_base64: audioData.base64,
+          audio_id: audioData.audioId || '',
+          audio_base64: withAudioBytes ? audioData.base64 : '',
           audio_mime_type: audioData.mimeType
         }),
       });
-        
+
+      let response = await sendChat(!audioData.audioId);
+      let data: any = response.ok ? await readChatStream(response, segments.enqueue) : null;
+      if (data?.error === 'audio_expired') {
+        // 后端的录音已过期（或请求落到了别的实例）：带上录音重发一次
+        response = await sendChat(true);
+        data = response.ok ? await readChatStream(response, segments.enqueue) : null;
+      }
+
       if (response.ok) {
-        const data = await response.json();
         
         if (data.status === 'ERROR') {
           console.error('Backend returned ERROR:', data.error || data.reply);
@@ -1301,10 +1353,15 @@ export default function LifeCHOPage() {
           setChatTurns(processed);
           
           if (data.reply_audio) {
-            await playReplyVoice(data.reply_audio, processed.length - 1);
+            if (segments.played > 0) {
+              // 已经逐句播放过了，只保存整段音频供重放
+              setReplyAudios(prev => ({ ...prev, [processed.length - 1]: data.reply_audio }));
+            } else {
+              await playReplyVoice(data.reply_audio, processed.length - 1);
+            }
           }
         }
-        
+
         if (data.status === 'FINISHED') {
           setCurrentRound(prev => Math.max(prev + 1, chatTurns.length - 1));
           setTimeout(() => { setSubStage('summarizing'); }, 2000);